@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Cost in time and memory of RPHandler.init_client.
+
+Usage: PYTHONPATH=src python3 benchmarks/bench_init_client.py [-n ROUNDS]
+"""
+import argparse
+import time
+import tracemalloc
+
+from cryptojwt.key_jar import build_keyjar
+
+from oidcrp import RPHandler
+
+SERVICES = {
+    'discovery': {
+        'class': 'oidcservice.oidc.provider_info_discovery.ProviderInfoDiscovery'
+    },
+    'registration': {'class': 'oidcservice.oidc.registration.Registration'},
+    'authorization': {'class': 'oidcservice.oidc.authorization.Authorization'},
+    'accesstoken': {'class': 'oidcservice.oidc.access_token.AccessToken'},
+    'refresh_accesstoken': {
+        'class': 'oidcservice.oidc.refresh_access_token.RefreshAccessToken'
+    },
+    'userinfo': {'class': 'oidcservice.oidc.userinfo.UserInfo'},
+    'end_session': {'class': 'oidcservice.oidc.end_session.EndSession'},
+    'check_session': {'class': 'oidcservice.oidc.check_session.CheckSession'},
+    'check_id': {'class': 'oidcservice.oidc.check_id.CheckID'},
+    'webfinger': {'class': 'oidcservice.oidc.webfinger.WebFinger'}
+}
+
+CLIENT_CONFIG = {
+    'op': {
+        'issuer': 'https://op.example.org',
+        'client_id': 'client',
+        'client_secret': 'abcdefghijklmnopqrstuvwxyz',
+        'redirect_uris': ['https://rp.example.com/authz_cb/op'],
+        'behaviour': {'response_types': ['code'], 'scope': ['openid']},
+        'add_ons': {
+            'pkce': {
+                'function': 'oidcservice.oidc.add_on.pkce.add_pkce_support',
+                'kwargs': {'code_challenge_length': 64,
+                           'code_challenge_method': 'S256'}
+            }
+        },
+        'services': SERVICES
+    }
+}
+
+KEYDEFS = [{"type": "RSA", "use": ["sig"]},
+           {"type": "EC", "crv": "P-256", "use": ["sig"]}]
+
+
+def run(rph, rounds, touch_all):
+    clients = []
+    tracemalloc.start()
+    _start_mem = tracemalloc.get_traced_memory()[0]
+    _start = time.perf_counter()
+    for _ in range(rounds):
+        client = rph.init_client('op')
+        if touch_all:
+            client.service.instantiate_all()
+        clients.append(client)
+    _time = time.perf_counter() - _start
+    _mem = tracemalloc.get_traced_memory()[0] - _start_mem
+    tracemalloc.stop()
+    return _time / rounds, _mem / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    rph = RPHandler(base_url='https://rp.example.com',
+                    keyjar=build_keyjar(KEYDEFS), client_configs=CLIENT_CONFIG)
+    # warm up module imports
+    run(rph, 5, True)
+
+    for label, touch_all in [('lazy services', False),
+                             ('all services', True)]:
+        _time, _mem = run(rph, args.rounds, touch_all)
+        print('{:<14} {:8.1f} us/client {:10.0f} bytes/client'.format(
+            label, _time * 1e6, _mem))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+What logging costs per login when the log level is INFO.
+
+A login here is begin(), finalize_auth() on the authorization response
+and parsing a token response. It is run with logging configured at INFO
+and with logging disabled, the difference is the cost of logging.
+
+Usage: PYTHONPATH=src python3 benchmarks/bench_logging.py [-n ROUNDS]
+"""
+import argparse
+import io
+import json
+import logging
+import time
+
+from cryptojwt.key_jar import build_keyjar
+
+from oidcrp import RPHandler
+
+CLIENT_CONFIG = {
+    'op': {
+        'issuer': 'https://op.example.org',
+        'client_id': 'client',
+        'client_secret': 'abcdefghijklmnopqrstuvwxyz',
+        'redirect_uris': ['https://rp.example.com/authz_cb/op'],
+        'behaviour': {'response_types': ['code'],
+                      'scope': ['openid', 'profile', 'email']},
+        'provider_info': {
+            'authorization_endpoint': 'https://op.example.org/authorization',
+            'token_endpoint': 'https://op.example.org/token'
+        },
+        'services': {
+            'authorization': {
+                'class': 'oidcservice.oidc.authorization.Authorization'
+            },
+            'accesstoken': {
+                'class': 'oidcservice.oidc.access_token.AccessToken'
+            }
+        }
+    }
+}
+
+KEYDEFS = [{"type": "RSA", "use": ["sig"]}]
+
+TOKEN_RESPONSE = json.dumps({
+    'access_token': 'Z0FBQUFBQmFkdFF' * 8,
+    'token_type': 'Bearer',
+    'expires_in': 3600,
+    'refresh_token': 'ZEZaU2hkMjRTQ2xMU' * 4
+})
+
+
+class Response(object):
+    status_code = 200
+    url = 'https://op.example.org/token'
+    headers = {'content-type': 'application/json'}
+    text = TOKEN_RESPONSE
+
+
+def login(rph):
+    _info = rph.begin('op')
+    client = rph.get_client_by_issuer('https://op.example.org')
+    rph.finalize_auth(client, 'https://op.example.org',
+                      {'code': 'abcdefghijklmnop', 'state': _info['state']})
+    client.parse_request_response(client.service['accesstoken'], Response(),
+                                  'json', state=_info['state'])
+
+
+def run(rounds, keyjar):
+    # A fresh handler so both runs start with an empty state database
+    rph = RPHandler(base_url='https://rp.example.com', keyjar=keyjar,
+                    client_configs=CLIENT_CONFIG)
+    login(rph)
+    _start = time.perf_counter()
+    for _ in range(rounds):
+        login(rph)
+    return (time.perf_counter() - _start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    keyjar = build_keyjar(KEYDEFS)
+    logging.basicConfig(level=logging.INFO, stream=io.StringIO())
+
+    logged = silent = float('inf')
+    for _ in range(3):
+        logged = min(logged, run(args.rounds, keyjar))
+        logging.disable(logging.CRITICAL)
+        silent = min(silent, run(args.rounds, keyjar))
+        logging.disable(logging.NOTSET)
+
+    print('login, INFO       {:8.1f} us'.format(logged * 1e6))
+    print('login, no logging {:8.1f} us'.format(silent * 1e6))
+    print('logging cost      {:8.1f} us/login'.format((logged - silent) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Calls per second of the functions that look at the Content-Type and the
+body of a HTTP response: util.verify_header,
+util.get_deserialization_method and the whole of
+Client.parse_request_response.
+
+The responses are real requests.Response instances so decoding the body
+costs what it does in production. For comparison the body is also decoded
+the way it used to be, using Response.text which has to guess the encoding
+when the Content-Type does not name one. Last, the JSON codecs that are
+installed are compared.
+
+Usage: PYTHONPATH=src python3 benchmarks/bench_parse.py [-n ROUNDS]
+"""
+import argparse
+import json
+import time
+
+from oidcservice.state_interface import InMemoryStateDataBase
+from requests.models import Response
+
+from oidcrp import json_codec
+from oidcrp import util
+from oidcrp.oidc import RP
+
+ISS = 'https://op.example.org'
+
+PROVIDER_INFO = {
+    'issuer': ISS,
+    'authorization_endpoint': '{}/authorization'.format(ISS),
+    'token_endpoint': '{}/token'.format(ISS),
+    'userinfo_endpoint': '{}/userinfo'.format(ISS),
+    'jwks_uri': '{}/jwks.json'.format(ISS),
+    'response_types_supported': ['code'],
+    'subject_types_supported': ['public'],
+    'id_token_signing_alg_values_supported': ['RS256']
+}
+
+
+def response(ctype, body):
+    _resp = Response()
+    _resp.status_code = 200
+    _resp.headers['Content-Type'] = ctype
+    _resp._content = body.encode('utf-8')
+    _resp.url = ISS
+    return _resp
+
+
+def rate(func, rounds):
+    _start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return rounds / (time.perf_counter() - _start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='rounds', type=int, default=20000)
+    args = parser.parse_args()
+
+    client = RP(InMemoryStateDataBase(),
+                config={'issuer': ISS, 'client_id': 'client'})
+    _srv = client.service['provider_info']
+    _json = response('application/json', json.dumps(PROVIDER_INFO))
+    _utf8 = response('application/json; charset=utf-8',
+                     json.dumps(PROVIDER_INFO))
+
+    cases = [
+        ('verify_header', lambda: util.verify_header(_utf8, 'json')),
+        ('get_deserialization_method',
+         lambda: util.get_deserialization_method(_utf8)),
+        ('body, Response.text', lambda: _json.text),
+        ('body, response_body', lambda: util.response_body(_json)),
+        ('parse_request_response',
+         lambda: client.parse_request_response(_srv, _json, 'json')),
+    ]
+    for label, func in cases:
+        _rounds = args.rounds
+        if label == 'parse_request_response':
+            # Verifying the provider info dominates, fewer rounds will do
+            _rounds = max(1, _rounds // 10)
+        print('{:<27} {:10.0f} calls/s'.format(label, rate(func, _rounds)))
+
+    _default = json_codec.codec_name()
+    for name in sorted(json_codec.CODECS):
+        json_codec.use_codec(name)
+        print('{:<27} {:10.0f} calls/s'.format(
+            'json_codec.loads, ' + name,
+            rate(lambda: json_codec.loads(_json.content), args.rounds)))
+    json_codec.use_codec(_default)
+
+
+if __name__ == '__main__':
+    main()
@@ -113,6 +113,20 @@ class Root(object):
         return '\n'.join(response)
 
 
+class JWKS(object):
+    def __init__(self, rph):
+        self.rph = rph
+
+    @cherrypy.expose
+    def index(self):
+        _body, _headers = self.rph.jwks()
+        cherrypy.response.headers.update(_headers)
+        if cherrypy.request.headers.get('If-None-Match') == _headers['ETag']:
+            cherrypy.response.status = 304
+            return b''
+        return as_bytes(_body)
+
+
 class Consumer(Root):
     _cp_config = {'request.error_response': handle_error}
 
@@ -146,17 +160,11 @@ class Consumer(Root):
 
     def get_rp(self, op_hash):
         try:
-            _iss = self.rph.hash2issuer[op_hash]
+            rp = self.rph.get_client_by_hash(op_hash)
         except KeyError:
             logger.error('Unkown issuer: {} not among {}'.format(
                 op_hash, list(self.rph.hash2issuer.keys())))
             raise cherrypy.HTTPError(400, "Unknown hash: {}".format(op_hash))
-        else:
-            try:
-                rp = self.rph.issuer2rp[_iss]
-            except KeyError:
-                raise cherrypy.HTTPError(
-                    400, "Couldn't find client for {}".format(_iss))
         return rp
 
     @cherrypy.expose
@@ -91,9 +91,12 @@ if __name__ == '__main__':
     rph = RPHandler(base_url=_base_url, hash_seed="BabyHoldOn", keyjar=_kj,
                     jwks_path=config.PUBLIC_JWKS_PATH,
                     client_configs=config.CLIENTS,
-                    services=config.SERVICES, verify_ssl=_verify_ssl)
+                    services=config.SERVICES, verify_ssl=_verify_ssl,
+                    private_jwks_path=config.PRIVATE_JWKS_PATH)
 
     cherrypy.tree.mount(cprp.Consumer(rph, 'html'), '/', provider_config)
+    # Served from the key jar, not from the file, to pick up key rotations
+    cherrypy.tree.mount(cprp.JWKS(rph), '/' + config.PUBLIC_JWKS_PATH)
 
     # If HTTPS
     if args.tls:
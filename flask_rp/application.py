@@ -7,6 +7,7 @@ from flask.app import Flask
 
 from oidcrp import RPHandler
 from oidcrp.configure import Configuration
+from oidcrp.metrics import Metrics
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -19,15 +20,18 @@ def init_oidc_rp_handler(app):
         _path = _rp_conf.rp_keys['public_path']
         # removes ./ and / from the begin of the string
         _path = re.sub('^(.)/', '', _path)
+        _private_path = _rp_conf.rp_keys.get('private_path', '')
     else:
         _kj = KeyJar()
         _path = ''
+        _private_path = ''
     _kj.httpc_params = _rp_conf.httpc_params
 
     rph = RPHandler(base_url=_rp_conf.base_url,
                     hash_seed=_rp_conf.hash_seed, keyjar=_kj, jwks_path=_path,
                     client_configs=_rp_conf.clients,
-                    services=_rp_conf.services, httpc_params=_rp_conf.httpc_params)
+                    services=_rp_conf.services, httpc_params=_rp_conf.httpc_params,
+                    private_jwks_path=_private_path, metrics=Metrics())
 
     return rph
 
@@ -1,5 +1,7 @@
 import logging
+import queue
 from urllib.parse import parse_qs
+from urllib.parse import urlsplit
 
 import werkzeug
 from flask import Blueprint
@@ -12,8 +14,6 @@ from flask.helpers import make_response
 from flask.helpers import send_from_directory
 from oidcservice.exception import OidcServiceError
 
-import oidcrp
-
 logger = logging.getLogger(__name__)
 
 oidc_rp_views = Blueprint('oidc_rp', __name__, url_prefix='')
@@ -31,9 +31,23 @@ def compact(qsdict):
 
 @oidc_rp_views.route('/static/<path:path>')
 def send_js(path):
+    _rph = current_app.rph
+    if _rph.jwks_uri and request.path == urlsplit(_rph.jwks_uri).path:
+        _body, _headers = _rph.jwks()
+        if request.headers.get('If-None-Match') == _headers['ETag']:
+            return make_response('', 304, _headers)
+        return make_response(_body, 200, _headers)
     return send_from_directory('static', path)
 
 
+@oidc_rp_views.route('/metrics')
+def metrics():
+    # Only back-channel requests to OPs/ASs. Redirects of the user's browser,
+    # to the authorization and end session endpoints, are not included.
+    return make_response(current_app.rph.metrics.exposition(), 200,
+                         {'Content-Type': 'text/plain; version=0.0.4'})
+
+
 @oidc_rp_views.route('/')
 def index():
     _providers = current_app.rp_config.clients.keys()
@@ -74,17 +88,11 @@ def rp():
 
 def get_rp(op_hash):
     try:
-        _iss = current_app.rph.hash2issuer[op_hash]
+        rp = current_app.rph.get_client_by_hash(op_hash)
     except KeyError:
         logger.error('Unkown issuer: {} not among {}'.format(
             op_hash, list(current_app.rph.hash2issuer.keys())))
         return make_response("Unknown hash: {}".format(op_hash), 400)
-    else:
-        try:
-            rp = current_app.rph.issuer2rp[_iss]
-        except KeyError:
-            return make_response("Couldn't find client for {}".format(_iss),
-                                 400)
 
     return rp
 
@@ -228,23 +236,24 @@ def logout():
 @oidc_rp_views.route('/bc_logout/<op_hash>', methods=['GET', 'POST'])
 def backchannel_logout(op_hash):
     _rp = get_rp(op_hash)
+    if hasattr(_rp, 'status_code'):
+        return _rp
     try:
-        _state = oidcrp.backchannel_logout(request.data, _rp)
-    except Exception as err:
-        logger.error('Exception: {}'.format(err))
-        return 'System error!', 400
-    else:
-        _rp.session_interface.remove_state(_state)
-        return "OK"
+        current_app.rph.submit_backchannel_logout(_rp, request.data)
+    except queue.Full:
+        return 'Too many logout requests', 503
+    return "OK"
 
 
 @oidc_rp_views.route('/fc_logout/<op_hash>', methods=['GET', 'POST'])
 def frontchannel_logout(op_hash):
     _rp = get_rp(op_hash)
+    if hasattr(_rp, 'status_code'):
+        return _rp
     sid = request.args['sid']
     _iss = request.args['iss']
     if _iss != _rp.service_context.issuer:
         return 'Bad request', 400
-    _state = _rp.session_interface.get_state_by_sid(sid)
-    _rp.session_interface.remove_state(_state)
+    _states = _rp.session_interface.get_states_by_sid(sid)
+    _rp.session_interface.remove_states(_states)
     return "OK"
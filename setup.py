@@ -69,6 +69,9 @@ setup(
         'oidcmsg>=0.6.6',
         'pyyaml'
     ],
+    extras_require={
+        'fast_json': ['orjson'],
+    },
     tests_require=[
         'pytest',
         'pytest-localserver',
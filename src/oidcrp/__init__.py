@@ -1,12 +1,15 @@
+import copy
 import hashlib
 import logging
 import sys
 import traceback
+import weakref
 
 from cryptojwt.key_bundle import keybundle_from_local_file
 from cryptojwt.utils import as_bytes
 from cryptojwt.utils import as_unicode
 from oidcmsg.exception import MessageException
+from oidcmsg.exception import MissingRequiredAttribute
 from oidcmsg.exception import NotForMe
 from oidcmsg.oauth2 import ResponseMessage
 from oidcmsg.oauth2 import is_error_message
@@ -21,11 +24,23 @@ from oidcmsg.time_util import time_sans_frac
 from oidcservice import rndstr
 from oidcservice.exception import OidcServiceError
 from oidcservice.state_interface import InMemoryStateDataBase
-from oidcservice.state_interface import StateInterface
 
 from oidcrp import oauth2
 from oidcrp import oidc
 from oidcrp import provider
+from oidcrp.client_cache import ClientCache
+from oidcrp.issuer_registry import IssuerRegistry
+from oidcrp.key_refresh import KeyRefresher
+from oidcrp.key_refresh import RefreshingKeyJar
+from oidcrp.key_rotation import KeyRotation
+from oidcrp.logout_queue import BackChannelLogoutQueue
+from oidcrp.metrics import NO_METRICS
+from oidcrp.provider_refresh import ProviderInfoRefresher
+from oidcrp.state_interface import StateInterface
+from oidcrp.state_lock import StateLock
+from oidcrp.userinfo_cache import UserInfoCache
+from oidcrp.webfinger_cache import WebFingerCache
+from oidcrp.webfinger_cache import resource_domain
 
 __author__ = 'Roland Hedberg'
 __version__ = '0.6.5'
@@ -54,6 +69,11 @@ def token_secret_key(sid):
 SERVICE_NAME = "OIC"
 CLIENT_CONFIG = {}
 
+# Service context attributes needed to recreate an evicted client
+SNAPSHOT_ATTRIBUTES = ['issuer', 'provider_info', 'registration_response',
+                       'client_id', 'client_secret', 'redirect_uris',
+                       'callbacks', 'post_logout_redirect_uris', 'behaviour']
+
 
 def add_path(url, path):
     if url.endswith('/'):
@@ -127,7 +147,10 @@ class RPHandler(object):
         else:
             self.state_db = InMemoryStateDataBase()
 
-        self.session_interface = StateInterface(self.state_db)
+        self.state_lock = StateLock(
+            self.state_db, lifetime=kwargs.get('state_lock_lifetime', 30))
+        self.session_interface = StateInterface(self.state_db,
+                                                lock=self.state_lock)
 
         try:
             self.jwks_uri = add_path(base_url, kwargs['jwks_path'])
@@ -142,8 +165,15 @@ class RPHandler(object):
         self.client_configs = client_configs
 
         # keep track on which RP instance that serves with OP
-        self.issuer2rp = {}
+        self.issuer2rp = ClientCache(
+            snapshot=self.client_snapshot, rehydrate=self.rehydrate_client,
+            max_size=kwargs.get('client_cache_size', 0),
+            max_idle=kwargs.get('client_max_idle', 0))
+        # which client configuration that was used for which OP
+        self.issuer2config = {}
         self.hash2issuer = {}
+        # client -> precompiled authorization request arguments
+        self.authorization_templates = weakref.WeakKeyDictionary()
         self.httplib = http_lib
         if not httpc_params:
             self.httpc_params = {'verify': verify_ssl}
@@ -153,6 +183,78 @@ class RPHandler(object):
         if not getattr(self.keyjar, 'httpc_params', None):
             self.keyjar.httpc_params = self.httpc_params
 
+        if kwargs.get('userinfo_cache_size'):
+            self.userinfo_cache = UserInfoCache(
+                max_size=kwargs['userinfo_cache_size'],
+                max_age=kwargs.get('userinfo_max_age', 0))
+        else:
+            self.userinfo_cache = None
+
+        self.logout_queue = None
+        if kwargs.get('provider_info_refresh'):
+            self.provider_info_refresher = ProviderInfoRefresher(
+                self.issuer2rp, interval=kwargs['provider_info_refresh'])
+        else:
+            self.provider_info_refresher = None
+        if kwargs.get('jwks_refresh'):
+            self.key_refresher = KeyRefresher(
+                self.issuer2rp, tick=kwargs['jwks_refresh'])
+        else:
+            self.key_refresher = None
+        if kwargs.get('registry_db') is not None:
+            self.issuer_registry = IssuerRegistry(kwargs['registry_db'])
+        else:
+            self.issuer_registry = None
+        self.webfinger_cache = WebFingerCache(
+            ttl=kwargs.get('webfinger_cache_ttl', 3600),
+            negative_ttl=kwargs.get('webfinger_negative_ttl', 300))
+        self.metrics = kwargs.get('metrics') or NO_METRICS
+        self.key_rotation = KeyRotation(
+            self.keyjar, client_keyjars=self.live_keyjars,
+            overlap=kwargs.get('key_overlap', 86400),
+            max_age=kwargs.get('jwks_max_age', 3600),
+            private_path=kwargs.get('private_jwks_path', ''))
+        # Keys of the issuers of aggregated claims, shared by all clients
+        self.claims_keyjar = RefreshingKeyJar(
+            min_interval=kwargs.get('jwks_min_refetch', 30),
+            verify_ssl=self.keyjar.verify_ssl)
+
+        self.build_callback_routing()
+
+    def build_callback_routing(self):
+        """
+        Precompute which issuer a callback URL path element points to for
+        all configured clients that have a known issuer ID. That way a
+        callback can be routed even if the client it belongs to has not
+        been set up yet by this process.
+        """
+        if not self.client_configs:
+            return
+
+        for key, cnf in self.client_configs.items():
+            _iss = cnf.get('issuer')
+            if not key or not _iss:
+                continue
+
+            self.issuer2config.setdefault(_iss, key)
+            if cnf.get('redirect_uris'):
+                self.hash2issuer[key] = _iss
+            else:
+                self.hash2issuer[self.issuer_hash(_iss)] = _iss
+
+    def configured_issuer(self, key):
+        """
+        The issuer ID a client configuration is for. If the configuration
+        does not name one the key is assumed to be the issuer ID.
+
+        :param key: Client configuration key
+        :return: Issuer ID
+        """
+        try:
+            return self.client_configs[key]['issuer'] or key
+        except (KeyError, TypeError):
+            return key
+
     def state2issuer(self, state):
         """
         Given the state value find the Issuer ID of the OP/AS that state value
@@ -205,16 +307,60 @@ class RPHandler(object):
                 services=_services, config=_cnf, httplib=self.httplib,
                 httpc_params=self.httpc_params)
         except Exception as err:
-            logger.error('Failed initiating client: {}'.format(err))
+            logger.error('Failed initiating client: %s', err)
             message = traceback.format_exception(*sys.exc_info())
             logger.error(message)
             raise
 
-        client.service_context.keyjar = self.keyjar.copy()
+        client.service_context.keyjar = self.client_keyjar()
+        client.session_interface.lock = self.state_lock
+        client.metrics = self.metrics
+        if isinstance(client, oidc.RP):
+            client.claims_keyjar = self.claims_keyjar
         client.service_context.base_url = self.base_url
         client.service_context.jwks_uri = self.jwks_uri
         return client
 
+    def live_keyjars(self):
+        return [client.service_context.keyjar
+                for _, client in self.issuer2rp.live_items()]
+
+    def rotate_keys(self, key_defs=None, jwks=None):
+        """
+        Replace the RP's own keys without a restart. The new keys are
+        published at once, the old ones are removed after the overlap
+        period, given by the key_overlap argument.
+
+        :param key_defs: Definitions of the keys to create
+        :param jwks: A private JWKS with the new keys, for when several
+            nodes must use the same keys.
+        :return: The KeyBundle with the new keys
+        """
+        return self.key_rotation.rotate(key_defs=key_defs, jwks=jwks)
+
+    def jwks(self):
+        """
+        The RP's public JWKS, as it should be served at the jwks_uri.
+
+        :return: A (JSON document, HTTP headers) tuple
+        """
+        return self.key_rotation.jwks()
+
+    def client_keyjar(self):
+        """
+        A copy of the RP's key jar for a client to keep the keys of its
+        OP/AS in. Remote keys are only fetched again when they are stale or
+        when a JWT signed with an unknown key arrives.
+
+        :return: A :py:class:`oidcrp.key_refresh.RefreshingKeyJar` instance
+        """
+        _kj = RefreshingKeyJar(
+            min_interval=self.extra.get('jwks_min_refetch', 30),
+            verify_ssl=self.keyjar.verify_ssl)
+        for owner in self.keyjar.owners():
+            _kj[owner] = [kb.copy() for kb in self.keyjar[owner]]
+        return _kj
+
     def do_provider_info(self, client=None, state=''):
         """
         Either get the provider info from configuration or through dynamic
@@ -324,31 +470,71 @@ class RPHandler(object):
         :return: A :py:class:`oidcservice.oidc.Client` instance
         """
 
-        logger.info('client_setup: iss_id={}, user={}'.format(iss_id, user))
+        logger.info('client_setup: iss_id=%s, user=%s', iss_id, user)
 
         if not iss_id:
             if not user:
                 raise ValueError('Need issuer or user')
 
-            logger.debug("Connecting to previously unknown OP")
-            temporary_client = self.init_client('')
-            temporary_client.do_request('webfinger', resource=user)
+            _issuer, temporary_client = self.webfinger(user)
         else:
+            # iss_id may be a configuration key, use the client already
+            # bound to the issuer it is configured for
+            _issuer = self.configured_issuer(iss_id)
             temporary_client = None
 
         try:
-            client = self.issuer2rp[iss_id]
+            return self.issuer2rp[_issuer]
         except KeyError:
-            if temporary_client:
-                client = temporary_client
-            else:
-                logger.debug("Creating new client: %s", iss_id)
-                client = self.init_client(iss_id)
+            pass
+
+        if self.issuer_registry is None:
+            return self.new_client(iss_id, user, _issuer, temporary_client)
+
+        # Only one worker at the time sets up a client for an OP/AS
+        with self.issuer_registry.hold(_issuer):
+            try:
+                # Done by another thread while waiting for the lock
+                return self.issuer2rp[_issuer]
+            except KeyError:
+                pass
+
+            _snapshot = self.issuer_registry.get(_issuer)
+            if _snapshot:
+                logger.debug('Client for %s from the issuer registry', _issuer)
+                return self.client_from_registry(_snapshot)
+
+            client = self.new_client(iss_id, user, _issuer, temporary_client)
+            self.add_to_registry(client, _issuer)
+        return client
+
+    def new_client(self, iss_id, user, issuer_id, temporary_client=None):
+        """
+        Create a client, do provider info discovery and client registration
+        if needed.
+
+        :param iss_id: The configuration key, empty if the issuer was found
+            using webfinger
+        :param user: A user identifier
+        :param issuer_id: The issuer ID
+        :param temporary_client: The client that did the webfinger request
+        :return: A :py:class:`oidcservice.oidc.Client` instance
+        """
+        if temporary_client:
+            client = temporary_client
+        elif not iss_id:
+            logger.debug("Creating new client: %s", issuer_id)
+            client = self.init_client('')
+            client.service_context.issuer = issuer_id
         else:
-            return client
+            logger.debug("Creating new client: %s", iss_id)
+            client = self.init_client(iss_id)
 
         logger.debug("Get provider info")
         issuer = self.do_provider_info(client)
+        if user and not iss_id and issuer != issuer_id:
+            # Next time go directly to the issuer ID the OP/AS uses
+            self.webfinger_cache.set(resource_domain(user), issuer)
         _sc = client.service_context
         try:
             _fe = _sc.federation_entity
@@ -372,9 +558,164 @@ class RPHandler(object):
             logger.debug("Do client registration")
             self.do_client_registration(client, iss_id)
 
+        if temporary_client or not iss_id:
+            self.issuer2config[issuer] = ''
+        else:
+            self.issuer2config[issuer] = iss_id
+        self.issuer2rp[issuer] = client
+
+        # Started here and not when the handler is created so that it runs
+        # in the worker processes of a pre-forking server.
+        if self.provider_info_refresher is not None:
+            self.provider_info_refresher.start()
+        if self.key_refresher is not None:
+            self.key_refresher.start()
+        return client
+
+    @staticmethod
+    def snapshot_issuer(snapshot):
+        try:
+            return snapshot['provider_info']['issuer']
+        except KeyError:
+            return snapshot['issuer']
+
+    def add_to_registry(self, client, issuer_id):
+        """
+        Make a newly set up client known to the other workers.
+
+        :param client: A Client instance
+        :param issuer_id: The issuer ID or configuration key the client was
+            looked for with
+        """
+        _sc = client.service_context
+        _issuer = _sc.provider_info.get('issuer') or _sc.issuer
+        _snapshot = self.client_snapshot(_issuer, client)
+        self.issuer_registry.set(issuer_id, _snapshot)
+        if _issuer != issuer_id:
+            self.issuer_registry.set(_issuer, _snapshot)
+
+        _callbacks = getattr(_sc, 'callbacks', None)
+        if _callbacks and '__hex' in _callbacks:
+            self.issuer_registry.set_callback_issuer(_callbacks['__hex'],
+                                                     _issuer)
+
+    def client_from_registry(self, snapshot):
+        """
+        Set up a client from what another worker stored in the issuer
+        registry.
+
+        :param snapshot: A client snapshot
+        :return: A Client instance
+        """
+        issuer = self.snapshot_issuer(snapshot)
+        client = self.rehydrate_client(issuer, snapshot)
+        self.issuer2config[issuer] = snapshot['config']
+        _callbacks = snapshot.get('callbacks')
+        if _callbacks and '__hex' in _callbacks:
+            self.hash2issuer[_callbacks['__hex']] = issuer
         self.issuer2rp[issuer] = client
         return client
 
+    def webfinger(self, user):
+        """
+        Find the issuer ID of the OP/AS a user belongs to. What was found
+        for the user's domain earlier is used if it has not expired,
+        otherwise a webfinger request is sent.
+
+        :param user: A user identifier
+        :return: A tuple of the issuer ID and the client that did the
+            webfinger request, None if no request was needed.
+        """
+        _domain = resource_domain(user)
+        try:
+            _issuer = self.webfinger_cache.get(_domain)
+        except KeyError:
+            pass
+        else:
+            if _issuer is None:
+                raise OidcServiceError(
+                    'No OP/AS found for {}'.format(_domain))
+            return _issuer, None
+
+        logger.debug("Connecting to previously unknown OP")
+        client = self.init_client('')
+        try:
+            client.do_request('webfinger', resource=user)
+        except MissingRequiredAttribute:
+            # An answer without links
+            pass
+        except Exception:
+            # Only a 404 says the domain has no OP/AS, anything else may
+            # be a passing failure and must not keep the users out.
+            if client.http_status_code() == 404:
+                self.webfinger_cache.set(_domain, None)
+            raise
+        else:
+            _status = client.http_status_code()
+            if _status and 400 <= _status < 500 and _status != 404:
+                raise OidcServiceError('Webfinger request for {} failed '
+                                       '({})'.format(_domain, _status))
+
+        _issuer = client.service_context.issuer
+        self.webfinger_cache.set(_domain, _issuer or None)
+        if not _issuer:
+            raise OidcServiceError('No OP/AS found for {}'.format(_domain))
+        return _issuer, client
+
+    def client_snapshot(self, issuer, client):
+        """
+        Collect what is needed to recreate a client without doing provider
+        info discovery or client registration again.
+
+        :param issuer: Issuer ID
+        :param client: A Client instance
+        :return: A dictionary
+        """
+        _sc = client.service_context
+        snapshot = {'config': self.issuer2config.get(issuer, issuer)}
+        for attr in SNAPSHOT_ATTRIBUTES:
+            _val = getattr(_sc, attr, None)
+            if _val:
+                try:
+                    snapshot[attr] = _val.to_dict()
+                except AttributeError:
+                    snapshot[attr] = copy.copy(_val)
+        return snapshot
+
+    def rehydrate_client(self, issuer, snapshot):
+        """
+        Recreate a client from a snapshot made by :py:meth:`client_snapshot`.
+
+        :param issuer: Issuer ID
+        :param snapshot: The snapshot
+        :return: A Client instance
+        """
+        client = self.init_client(snapshot['config'])
+        _sc = client.service_context
+        for attr in SNAPSHOT_ATTRIBUTES:
+            if attr in snapshot:
+                setattr(_sc, attr, copy.copy(snapshot[attr]))
+        if _sc.client_id:
+            client.client_id = _sc.client_id
+
+        self.do_provider_info(client)
+        _jwks_uri = _sc.provider_info.get('jwks_uri')
+        if _jwks_uri and issuer not in _sc.keyjar.owners():
+            _sc.keyjar.add_url(issuer, _jwks_uri)
+        return client
+
+    def issuer_hash(self, issuer):
+        """
+        The issuer specific part of the callback URLs.
+
+        :param issuer: Issuer ID
+        :return: A hex digest
+        """
+        _hash = hashlib.sha256()
+        _hash.update(self.hash_seed)
+        _hash.update(as_bytes(issuer))
+        return _hash.hexdigest()
+
     def create_callbacks(self, issuer):
         """
         To mitigate some security issues the redirect_uris should be OP/AS
@@ -384,10 +725,7 @@ class RPHandler(object):
         :param issuer: Issuer ID
         :return: A set of redirect_uris
         """
-        _hash = hashlib.sha256()
-        _hash.update(self.hash_seed)
-        _hash.update(as_bytes(issuer))
-        _hex = _hash.hexdigest()
+        _hex = self.issuer_hash(issuer)
         self.hash2issuer[_hex] = issuer
         return {
             'code': "{}/authz_cb/{}".format(self.base_url, _hex),
@@ -396,6 +734,51 @@ class RPHandler(object):
             '__hex': _hex
         }
 
+    def authorization_template(self, client):
+        """
+        The request arguments that are the same for every authorization
+        request a client makes. They are gathered the first time they are
+        needed and again if the client's redirect URIs or behaviour changes.
+
+        This only saves collecting the static arguments. The request is still
+        constructed, run through the add-ons and serialized per request since
+        the result depends on nonce, state and PKCE values that are new
+        every time.
+
+        :param client: A Client instance
+        :return: A deep copy of the request arguments in the template. The
+            services and add-ons modify the arguments they are given.
+        """
+        service_context = client.service_context
+        _behaviour = service_context.behaviour
+        _signature = (service_context.redirect_uris[0],
+                      tuple(_behaviour['scope']),
+                      _behaviour['response_types'][0])
+
+        try:
+            _template = self.authorization_templates[client]
+        except KeyError:
+            _template = None
+
+        if _template is None or _template[0] != _signature:
+            request_args = {
+                'redirect_uri': _signature[0],
+                'scope': list(_signature[1]),
+                'response_type': _signature[2]
+            }
+
+            _req_args = service_context.config.get("request_args")
+            if _req_args:
+                request_args.update(_req_args)
+                if 'claims' in _req_args:
+                    # Leave the configuration as it is
+                    request_args["claims"] = Claims(**_req_args["claims"])
+
+            _template = (_signature, request_args)
+            self.authorization_templates[client] = _template
+
+        return copy.deepcopy(_template[1])
+
     def init_authorization(self, client=None, state='', req_args=None):
         """
         Constructs the URL that will redirect the user to the authorization
@@ -415,19 +798,9 @@ class RPHandler(object):
 
         service_context = client.service_context
 
+        request_args = self.authorization_template(client)
         _nonce = rndstr(24)
-        request_args = {
-            'redirect_uri': service_context.redirect_uris[0],
-            'scope': service_context.behaviour['scope'],
-            'response_type': service_context.behaviour['response_types'][0],
-            'nonce': _nonce
-        }
-
-        _req_args = service_context.config.get("request_args")
-        if _req_args:
-            if 'claims' in _req_args:
-                _req_args["claims"] = Claims(**_req_args["claims"])
-            request_args.update(_req_args)
+        request_args['nonce'] = _nonce
 
         if req_args is not None:
             request_args.update(req_args)
@@ -437,11 +810,11 @@ class RPHandler(object):
         request_args['state'] = _state
         self.session_interface.store_nonce2state(_nonce, _state)
 
-        logger.debug('Authorization request args: {}'.format(request_args))
+        logger.debug('Authorization request args: %s', request_args)
 
         _srv = client.service['authorization']
         _info = _srv.get_request_parameters(request_args=request_args)
-        logger.debug('Authorization info: {}'.format(_info))
+        logger.debug('Authorization info: %s', _info)
         return {'url': _info['url'], 'state': _state}
 
     def begin(self, issuer_id='', user_id=''):
@@ -475,7 +848,55 @@ class RPHandler(object):
     # ----------------------------------------------------------------------
 
     def get_client_from_session_key(self, state):
-        return self.issuer2rp[self.state2issuer(state)]
+        return self.get_client_by_issuer(self.state2issuer(state))
+
+    def get_client_by_issuer(self, issuer):
+        """
+        Return the client that serves an OP/AS. If there is none but the
+        issuer is a configured one a client is set up.
+        Will raise a KeyError if the issuer is unknown.
+
+        :param issuer: Issuer ID
+        :return: A Client instance
+        """
+        try:
+            return self.issuer2rp[issuer]
+        except KeyError:
+            try:
+                _conf = self.issuer2config[issuer]
+            except KeyError:
+                _snapshot = None
+                if self.issuer_registry is not None:
+                    _snapshot = self.issuer_registry.get(issuer)
+                if not _snapshot:
+                    raise KeyError(issuer)
+                return self.client_from_registry(_snapshot)
+
+        logger.debug('Setting up client for %s on demand', issuer)
+        client = self.client_setup(_conf)
+        if issuer not in self.issuer2rp:
+            # provider info discovery may have normalized the issuer ID
+            self.issuer2rp[issuer] = client
+        return client
+
+    def get_client_by_hash(self, op_hash):
+        """
+        Return the client that a callback URL path element points to.
+        Will raise a KeyError if the path element is unknown.
+
+        :param op_hash: The issuer specific part of the callback URL
+        :return: A Client instance
+        """
+        try:
+            _issuer = self.hash2issuer[op_hash]
+        except KeyError:
+            _issuer = None
+            if self.issuer_registry is not None:
+                _issuer = self.issuer_registry.get_callback_issuer(op_hash)
+            if not _issuer:
+                raise KeyError(op_hash)
+            self.hash2issuer[op_hash] = _issuer
+        return self.get_client_by_issuer(_issuer)
 
     @staticmethod
     def get_response_type(client):
@@ -537,7 +958,7 @@ class RPHandler(object):
             'client_id': client.service_context.client_id,
             'client_secret': client.service_context.client_secret
         }
-        logger.debug('request_args: {}'.format(req_args))
+        logger.debug('request_args: %s', req_args)
         try:
             tokenresp = client.do_request(
                 'accesstoken', request_args=req_args,
@@ -560,6 +981,11 @@ class RPHandler(object):
         Refresh an access token using a refresh_token. When asking for a new
         access token the RP can ask for another scope for the new token.
 
+        Only one refresh per state is done at any given time. Callers that
+        arrive while a refresh is in flight, in this process or in another
+        one sharing the state database, wait for it to finish and get the
+        response it produced instead of doing their own refresh.
+
         :param client: A Client instance
         :param state: The state key (the state parameter in the
             authorization request)
@@ -574,27 +1000,56 @@ class RPHandler(object):
         if client is None:
             client = self.get_client_from_session_key(state)
 
-        try:
-            tokenresp = client.do_request(
-                'refresh_token',
-                authn_method=self.get_client_authn_method(client,
-                                                          "token_endpoint"),
-                state=state, request_args=req_args
-            )
-        except Exception as err:
-            message = traceback.format_exception(*sys.exc_info())
-            logger.error(message)
-            raise
-        else:
-            if is_error_message(tokenresp):
-                raise OidcServiceError(tokenresp['error'])
+        _before = self._token_responses(state)
+        with self.state_lock.hold(state):
+            for typ, _resp in self._token_responses(state).items():
+                if _resp and _resp != _before[typ]:
+                    logger.debug('Refresh already done by someone else')
+                    return self.session_interface.get_item(
+                        AccessTokenResponse, typ, state)
+
+            try:
+                tokenresp = client.do_request(
+                    'refresh_token',
+                    authn_method=self.get_client_authn_method(client,
+                                                              "token_endpoint"),
+                    state=state, request_args=req_args
+                )
+            except Exception as err:
+                message = traceback.format_exception(*sys.exc_info())
+                logger.error(message)
+                raise
+            else:
+                if is_error_message(tokenresp):
+                    raise OidcServiceError(tokenresp['error'])
+
+            if self.userinfo_cache is not None:
+                self.userinfo_cache.invalidate(state)
 
         return tokenresp
 
+    def _token_responses(self, state):
+        """
+        The token responses stored for a state. Depending on the version of
+        the refresh token service the response to a refresh is stored
+        as either the token response or the refresh token response.
+
+        :param state: The state key
+        :return: A dictionary with the stored responses
+        """
+        try:
+            _state = self.session_interface.get_state(state)
+        except KeyError:
+            _state = {}
+        return {typ: _state.get(typ) for typ in
+                ['refresh_token_response', 'token_response']}
+
     def get_user_info(self, state, client=None, access_token='',
                       **kwargs):
         """
-        use the access token previously acquired to get some userinfo
+        use the access token previously acquired to get some userinfo.
+        If there is a user info cache a response fetched earlier with the
+        same access token is returned if it has not expired.
 
         :param client: A Client instance
         :param state: The state value, this is the key into the session
@@ -603,21 +1058,36 @@ class RPHandler(object):
         :param kwargs: Extra keyword arguments
         :return: A :py:class:`oidcmsg.oidc.OpenIDSchema` instance
         """
-        if not access_token:
-            _arg = self.session_interface.multiple_extend_request_args(
-                {}, state, ['access_token'],
-                ['auth_response', 'token_response', 'refresh_token_response'])
+        _exp = 0
+        if self.userinfo_cache is not None:
+            if access_token:
+                _exp = self.access_token_expiry(state, access_token)
+            else:
+                try:
+                    access_token, _exp = self.get_valid_access_token(state)
+                except OidcServiceError:
+                    pass
 
         request_args = {'access_token': access_token}
 
         if client is None:
             client = self.get_client_from_session_key(state)
 
+        if self.userinfo_cache is not None and access_token:
+            _issuer = client.service_context.issuer
+            resp = self.userinfo_cache.get(_issuer, access_token)
+            if resp is not None:
+                return resp
+
         resp = client.do_request('userinfo', state=state,
                                  request_args=request_args, **kwargs)
         if is_error_message(resp):
             raise OidcServiceError(resp['error'])
 
+        if self.userinfo_cache is not None and access_token:
+            self.userinfo_cache.set(_issuer, access_token, resp,
+                                    expires_at=_exp, state=state)
+
         return resp
 
     @staticmethod
@@ -649,13 +1119,12 @@ class RPHandler(object):
             authorization_response = _srv.parse_response(response,
                                                          sformat='dict')
         except Exception as err:
-            logger.error('Parsing authorization_response: {}'.format(err))
+            logger.error('Parsing authorization_response: %s', err)
             message = traceback.format_exception(*sys.exc_info())
             logger.error(message)
             raise
         else:
-            logger.debug(
-                'Authz response: {}'.format(authorization_response.to_dict()))
+            logger.debug('Authz response: %s', authorization_response)
 
         if is_error_message(authorization_response):
             return authorization_response
@@ -667,7 +1136,7 @@ class RPHandler(object):
             raise KeyError('Unknown state value')
 
         if _iss != issuer:
-            logger.error('Issuer problem: {} != {}'.format(_iss, issuer))
+            logger.error('Issuer problem: %s != %s', _iss, issuer)
             # got it from the wrong bloke
             raise ValueError('Impersonator {}'.format(issuer))
 
@@ -752,7 +1221,7 @@ class RPHandler(object):
             **userinfo** The collected user information
         """
 
-        client = self.issuer2rp[issuer]
+        client = self.get_client_by_issuer(issuer)
 
         authorization_response = self.finalize_auth(client, issuer, response)
         if is_error_message(authorization_response):
@@ -831,6 +1300,26 @@ class RPHandler(object):
         else:
             return False
 
+    def access_token_expiry(self, state, access_token):
+        """
+        Find out when an access token that was received in a session
+        expires.
+
+        :param state: The state value of the session
+        :param access_token: The access token
+        :return: When the token expires, 0 if it never does or is unknown
+        """
+        for cls, typ in [(AccessTokenResponse, 'refresh_token_response'),
+                         (AccessTokenResponse, 'token_response'),
+                         (AuthorizationResponse, 'auth_response')]:
+            try:
+                response = self.session_interface.get_item(cls, typ, state)
+            except KeyError:
+                continue
+            if response.get('access_token') == access_token:
+                return response.get('__expires_at', 0)
+        return 0
+
     def get_valid_access_token(self, state):
         """
         Find a valid access token.
@@ -901,18 +1390,56 @@ class RPHandler(object):
         resp = srv.get_request_parameters(state=state,
                                           request_args=request_args)
 
+        if self.userinfo_cache is not None:
+            self.userinfo_cache.invalidate(state)
+
         return resp
 
+    def submit_backchannel_logout(self, client, request):
+        """
+        Queue a back channel logout request. The logout token is verified
+        and the sessions it is about are removed by a pool of worker
+        threads so this returns before that has happened.
+        Will raise :py:class:`queue.Full` if too many requests are waiting.
+
+        :param client: The Client instance the request was sent to
+        :param request: URL encoded logout request
+        """
+        if self.logout_queue is None:
+            self.logout_queue = BackChannelLogoutQueue(
+                self.clear_sessions,
+                workers=self.extra.get('logout_workers', 4),
+                max_queue=self.extra.get('logout_queue_size', 10000),
+                replay_cache_size=self.extra.get('logout_replay_cache_size',
+                                                 10000))
+        self.logout_queue.submit(client, request)
+
     def clear_session(self, state):
         client = self.get_client_from_session_key(state)
         client.session_interface.remove_state(state)
+        if self.userinfo_cache is not None:
+            self.userinfo_cache.invalidate(state)
+
+    def clear_sessions(self, states):
+        """
+        Remove a number of sessions in one go.
 
+        :param states: A list of state values
+        """
+        self.session_interface.remove_states(states)
+        if self.userinfo_cache is not None:
+            for state in states:
+                self.userinfo_cache.invalidate(state)
 
-def backchannel_logout(client, request='', request_args=None):
+
+def verify_logout_request(client, request='', request_args=None):
     """
+    Parse and verify a back channel logout request.
 
+    :param client: A Client instance
     :param request: URL encoded logout request
-    :return:
+    :param request_args: The logout request as a dictionary
+    :return: The verified logout token
     """
 
     if request:
@@ -931,13 +1458,25 @@ def backchannel_logout(client, request='', request_args=None):
     except (MessageException, ValueError, NotForMe) as err:
         raise MessageException('Bogus logout request: {}'.format(err))
 
+    return req[verified_claim_name('logout_token')]
+
+
+def backchannel_logout(client, request='', request_args=None):
+    """
+
+    :param request: URL encoded logout request
+    :return:
+    """
+
+    _token = verify_logout_request(client, request, request_args)
+
     # Find the subject through 'sid' or 'sub'
 
     try:
-        sub = req[verified_claim_name('logout_token')]['sub']
+        sub = _token['sub']
     except KeyError:
         try:
-            sid = req[verified_claim_name('logout_token')]['sid']
+            sid = _token['sid']
         except KeyError:
             raise MessageException('Neither "sid" nor "sub"')
         else:
@@ -946,3 +1485,35 @@ def backchannel_logout(client, request='', request_args=None):
         _state = client.session_interface.get_state_by_sub(sub)
 
     return _state
+
+
+def backchannel_logout_states(client, request='', request_args=None):
+    """
+    Find all the sessions a logout request is about. If the logout token
+    carries a 'sid' only the sessions bound to that session ID are returned
+    otherwise all the sessions of the subject.
+
+    :param client: A Client instance
+    :param request: URL encoded logout request
+    :param request_args: The logout request as a dictionary
+    :return: A list of state values
+    """
+
+    _token = verify_logout_request(client, request, request_args)
+    return logout_token_states(client, _token)
+
+
+def logout_token_states(client, logout_token):
+    """
+    Find all the sessions a verified logout token is about.
+
+    :param client: A Client instance
+    :param logout_token: A verified logout token
+    :return: A list of state values
+    """
+    if 'sid' in logout_token:
+        return client.session_interface.get_states_by_sid(logout_token['sid'])
+    elif 'sub' in logout_token:
+        return client.session_interface.get_states_by_sub(logout_token['sub'])
+    else:
+        raise MessageException('Neither "sid" nor "sub"')
@@ -0,0 +1,77 @@
+"""A cache for the responses from distributed claims sources.
+
+Claims kept by third parties seldom change, so there is no need to ask for
+them on every login or every userinfo request. Responses are kept under the
+claims source endpoint and a hash of the access token used, never the token
+itself. How long a response is kept can be configured per endpoint, the
+number of responses kept is bounded.
+
+The same cache can hold verified aggregated claims, kept under a hash of
+the JWT until the JWT expires.
+"""
+import logging
+import time
+
+from oidcrp.ttl_cache import TTLCache
+from oidcrp.userinfo_cache import token_hash
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+class ClaimsCache(TTLCache):
+    def __init__(self, max_size=1000, ttl=300, source_ttl=None):
+        """
+        :param max_size: Maximum number of cached responses. When there are
+            more the least recently used are removed.
+        :param ttl: Number of seconds a response is kept
+        :param source_ttl: Dictionary with the number of seconds responses
+            from a specific endpoint are kept, overrides ttl. 0 means
+            responses from that endpoint are not cached.
+        """
+        TTLCache.__init__(self, max_size)
+        self.ttl = ttl
+        self.source_ttl = source_ttl or {}
+
+    def ttl_for(self, endpoint):
+        """
+        :param endpoint: Claims source endpoint
+        :return: Number of seconds responses from the endpoint are kept
+        """
+        return self.source_ttl.get(endpoint, self.ttl)
+
+    @staticmethod
+    def _key(endpoint, token):
+        return endpoint, token_hash(token or '')
+
+    def get(self, endpoint, token=None):
+        """
+        Find a cached response.
+
+        :param endpoint: Claims source endpoint
+        :param token: The access token the claims were fetched with
+        :return: The claims or None if there were none or they have expired
+        """
+        try:
+            return self.lookup(self._key(endpoint, token))
+        except KeyError:
+            return None
+
+    def set(self, endpoint, token, claims, expires_at=0):
+        """
+        Cache a response.
+
+        :param endpoint: Claims source endpoint
+        :param token: The access token the claims were fetched with
+        :param claims: The claims
+        :param expires_at: When the claims expire, if not given the time to
+            live of the endpoint is used.
+        """
+        if not expires_at:
+            _ttl = self.ttl_for(endpoint)
+            if not _ttl:
+                return
+            expires_at = time.time() + _ttl
+
+        self.store(self._key(endpoint, token), claims, expires_at)
@@ -0,0 +1,205 @@
+"""Keeps track of which Client instance serves which OP/AS.
+
+Clients that have not been used for a while, or that are the least recently
+used ones when there are too many, are evicted. What is needed to recreate
+an evicted client, like the provider info and the registration response,
+is kept as a small snapshot and the client is rebuilt from that the next
+time it is asked for. Rebuilding a client only blocks those asking for a
+client for the same OP/AS.
+
+Only :py:meth:`ClientCache.keys` covers evicted clients. items() and
+values() return the live clients and never rebuild one.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+class ClientCache(object):
+    def __init__(self, snapshot=None, rehydrate=None, max_size=0, max_idle=0):
+        """
+        :param snapshot: A callable that given an issuer ID and a client
+            returns the information needed to recreate the client.
+        :param rehydrate: A callable that given an issuer ID and a snapshot
+            returns a client.
+        :param max_size: Maximum number of live clients, 0 means no limit
+        :param max_idle: Number of seconds a client may stay unused before it
+            is evicted, 0 means for ever.
+        """
+        self.snapshot = snapshot
+        self.rehydrate = rehydrate
+        self.max_size = max_size
+        self.max_idle = max_idle
+        # issuer -> [client, last used], least recently used first
+        self._live = OrderedDict()
+        # issuer -> snapshot
+        self._dormant = {}
+        self._lock = threading.RLock()
+        # issuer -> [threading.Lock, number of threads using it], held
+        # while a client is rehydrated
+        self._loading = {}
+
+    def _touch(self, issuer, now):
+        # Must be called with the lock held
+        _entry = self._live[issuer]
+        _entry[1] = now
+        self._live.move_to_end(issuer)
+        return _entry[0]
+
+    def _issuer_lock(self, issuer):
+        with self._lock:
+            try:
+                _entry = self._loading[issuer]
+            except KeyError:
+                _entry = self._loading[issuer] = [threading.Lock(), 0]
+            _entry[1] += 1
+        return _entry[0]
+
+    def _issuer_release(self, issuer):
+        with self._lock:
+            _entry = self._loading[issuer]
+            _entry[1] -= 1
+            if _entry[1] == 0:
+                del self._loading[issuer]
+
+    def __getitem__(self, issuer):
+        _now = time.time()
+        with self._lock:
+            try:
+                return self._touch(issuer, _now)
+            except KeyError:
+                if issuer not in self._dormant:
+                    raise KeyError(issuer)
+
+        # Rehydrating may take a while, only hold up those that want a
+        # client for the same issuer.
+        _issuer_lock = self._issuer_lock(issuer)
+        try:
+            with _issuer_lock:
+                with self._lock:
+                    try:
+                        # Someone else got here first
+                        return self._touch(issuer, _now)
+                    except KeyError:
+                        try:
+                            _snapshot = self._dormant[issuer]
+                        except KeyError:
+                            raise KeyError(issuer)
+
+                logger.debug('Rehydrating client for %s', issuer)
+                _client = self.rehydrate(issuer, _snapshot)
+
+                with self._lock:
+                    if self._dormant.get(issuer) is not _snapshot:
+                        # Replaced or removed while rehydrating
+                        try:
+                            return self._touch(issuer, _now)
+                        except KeyError:
+                            raise KeyError(issuer)
+                    del self._dormant[issuer]
+                    self._live[issuer] = [_client, _now]
+                    self.expire(_now)
+                    return _client
+        finally:
+            self._issuer_release(issuer)
+
+    def __setitem__(self, issuer, client):
+        with self._lock:
+            self._dormant.pop(issuer, None)
+            self._live[issuer] = [client, time.time()]
+            self._live.move_to_end(issuer)
+            self.expire()
+
+    def __delitem__(self, issuer):
+        with self._lock:
+            try:
+                del self._live[issuer]
+            except KeyError:
+                del self._dormant[issuer]
+
+    def __contains__(self, issuer):
+        return issuer in self._live or issuer in self._dormant
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        with self._lock:
+            return list(self._live.keys()) + list(self._dormant.keys())
+
+    def items(self):
+        """
+        Same as :py:meth:`live_items`. Evicted clients are not rehydrated
+        to be listed, ask for them one by one for that.
+        """
+        return self.live_items()
+
+    def values(self):
+        """
+        The instantiated clients. Like :py:meth:`items` this leaves
+        evicted clients as they are.
+        """
+        return [client for _, client in self.live_items()]
+
+    def live_items(self):
+        """
+        The instantiated clients and their issuer IDs. Does not rehydrate
+        evicted clients or count as use.
+        """
+        with self._lock:
+            return [(issuer, entry[0]) for issuer, entry in self._live.items()]
+
+    def get(self, issuer, default=None):
+        try:
+            return self[issuer]
+        except KeyError:
+            return default
+
+    def is_live(self, issuer):
+        """
+        Whether there is an instantiated client for an issuer.
+
+        :param issuer: Issuer ID
+        :return: True/False
+        """
+        return issuer in self._live
+
+    def evict(self, issuer):
+        """
+        Replace a live client with its snapshot.
+
+        :param issuer: Issuer ID
+        """
+        with self._lock:
+            _client = self._live.pop(issuer)[0]
+            if self.snapshot:
+                self._dormant[issuer] = self.snapshot(issuer, _client)
+            logger.debug('Evicted client for %s', issuer)
+
+    def expire(self, now=0):
+        """
+        Evict clients that have been idle for too long or that are too
+        many.
+
+        :param now: Current time in seconds since the epoch
+        """
+        with self._lock:
+            if self.max_idle:
+                _limit = (now or time.time()) - self.max_idle
+                # least recently used come first
+                for issuer, (_, last_used) in list(self._live.items()):
+                    if last_used >= _limit:
+                        break
+                    self.evict(issuer)
+
+            if self.max_size:
+                while len(self._live) > self.max_size:
+                    self.evict(next(iter(self._live)))
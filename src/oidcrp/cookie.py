@@ -1,13 +1,19 @@
 import base64
+import functools
 import hashlib
 import hmac
 import logging
 import os
+import re
+import struct
 import sys
 import time
+import zlib
+from collections import OrderedDict
 
 from http.cookies import SimpleCookie
 
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 from cryptojwt.utils import as_bytes
@@ -35,6 +41,26 @@ class InvalidCookieSign(Exception):
     pass
 
 
+# The compact cookie format. The cookie value is one URL-safe base64 blob,
+# without padding, of a header followed by the payload. The header holds
+# the format version, flags, the timestamp and the key identifier.
+# Encrypted cookies continue with the IV and the AES-GCM ciphertext and tag,
+# the header is the associated data. Signed cookies continue with the
+# payload and a truncated HMAC-SHA256 over header and payload.
+#
+# Both formats are always parsed, but cookies are created in the legacy
+# format unless compact is asked for. Older versions can not parse compact
+# cookies, so turn it on, with CookieDealer(..., compact=True), only when
+# every node that may get the cookies runs a version that can.
+COMPACT_VERSION = 1
+FLAG_ENCRYPTED = 0x01
+FLAG_COMPRESSED = 0x02
+# version, flags, timestamp, length of the key identifier
+_COMPACT_HEADER = struct.Struct('>BBIB')
+IV_LENGTH = 12
+SIGNATURE_LENGTH = 16
+
+
 # 'Stolen' from Werkzeug
 def safe_str_cmp(a, b):
     """Compare two strings in constant time."""
@@ -107,8 +133,31 @@ def _make_hashed_key(parts, hashfunc='sha256'):
     return h.digest()
 
 
+@functools.lru_cache(maxsize=32)
+def _cookie_cipher(enc_key, seed):
+    """
+    The cipher used for encrypted cookies. Deriving the key and setting up
+    the cipher is done once per (enc_key, seed) pair.
+
+    :param enc_key: The key used for cookie encryption, as bytes
+    :param seed: The seed, as bytes
+    :return: An :py:class:`AESGCM` instance
+    """
+    return AESGCM(_make_hashed_key((enc_key, seed)))
+
+
+def cookie_cipher(enc_key, seed):
+    """
+    :param enc_key: The key used for cookie encryption
+    :param seed: The seed
+    :return: A, possibly cached, :py:class:`AESGCM` instance
+    """
+    return _cookie_cipher(as_bytes(enc_key), as_bytes(seed or b''))
+
+
 def make_cookie(name, load, seed, expire=0, domain="", path="", timestamp="",
-                enc_key=None, secure=True, http_only=True, same_site=""):
+                enc_key=None, secure=True, http_only=True, same_site="",
+                kid="", compact=False, compress=False):
     """
     Create and return a cookie
 
@@ -145,24 +194,36 @@ def make_cookie(name, load, seed, expire=0, domain="", path="", timestamp="",
     :type http_only: boolean
     :param same_site: Whether SameSite (None,Strict or Lax) should be added to the cookie
     :type same_site: byte string
+    :param kid: If given, an identifier of the keys used, that is added to
+        the cookie
+    :type kid: text
+    :param compact: Whether to use the compact format or the legacy one.
+        The legacy format is the default since older versions can not
+        parse the compact one.
+    :type compact: boolean
+    :param compress: Whether to compress the load, if that makes it
+        smaller. Only with the compact format. Compressing a load part of
+        which an attacker can choose may leak the rest through its length.
+    :type compress: boolean
     :return: A tuple to be added to headers
     """
     cookie = SimpleCookie()
     if not timestamp:
         timestamp = str(int(time.time()))
 
+    if compact:
+        cookie[name] = compact_cookie_value(load, seed, int(timestamp),
+                                            enc_key=enc_key, kid=kid,
+                                            compress=compress)
+        return _cookie_output(cookie, name, expire, domain, path, secure,
+                              http_only, same_site)
+
     bytes_load = load.encode("utf-8")
     bytes_timestamp = timestamp.encode("utf-8")
 
     if enc_key:
-        # Make sure the key is 256-bit long, for AES-128-SIV
-        #
-        # This should go away once we push the keysize requirements up
-        # to the top level APIs.
-        key = _make_hashed_key((enc_key, seed))
-
-        #key = AESGCM.generate_key(bit_length=128)
-        aesgcm = AESGCM(key)
+        # The key is made 256-bit long by hashing.
+        aesgcm = cookie_cipher(enc_key, seed)
         iv = os.urandom(12)
 
         # timestamp does not need to be encrypted, just MAC'ed,
@@ -179,8 +240,16 @@ def make_cookie(name, load, seed, expire=0, domain="", path="", timestamp="",
             bytes_load, bytes_timestamp,
             cookie_signature(seed, load, timestamp).encode('utf-8')]
 
+    if kid:
+        cookie_payload.insert(0, kid.encode('utf-8'))
+
     cookie[name] = (b"|".join(cookie_payload)).decode('utf-8')
+    return _cookie_output(cookie, name, expire, domain, path, secure,
+                          http_only, same_site)
 
+
+def _cookie_output(cookie, name, expire, domain, path, secure, http_only,
+                   same_site):
     # Necessary if Python version < 3.8
     if sys.version_info[:2] <= (3, 8):
         cookie[name]._reserved[str("samesite")] = str("SameSite")
@@ -210,7 +279,8 @@ def parse_cookie(name, seed, kaka, enc_key=None):
 
     You need to provide the same `seed` and `enc_key`
     used when creating the cookie, otherwise the verification
-    fails. See `make_cookie` for details about the verification.
+    fails. See `make_cookie` for details about the verification. A key
+    identifier in the cookie is not used, the keys given are.
 
     :param seed: A seed key used for the HMAC signature
     :type seed: bytes
@@ -223,12 +293,156 @@ def parse_cookie(name, seed, kaka, enc_key=None):
     if not kaka:
         return None
 
-    seed = as_unicode(seed)
-
     parts = cookie_parts(name, kaka)
     if parts is None:
         return None
-    elif len(parts) == 3:
+    elif len(parts) == 1:
+        unpacked = unpack_compact_cookie(parts[0])
+        if unpacked is None:
+            return None
+        return verify_compact_cookie(unpacked, seed, enc_key)
+    return verify_cookie_parts(split_kid(parts)[1], seed, enc_key)
+
+
+def _b64url_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64url_decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def compact_cookie_value(load, seed, timestamp, enc_key=None, kid="",
+                         compress=False):
+    """
+    Create a cookie value in the compact format.
+
+    :param load: Cookie load
+    :type load: text
+    :param seed: A seed key for the HMAC function
+    :param timestamp: Seconds since the epoch
+    :type timestamp: int
+    :param enc_key: The key to use for cookie encryption, if any
+    :param kid: An identifier of the keys used
+    :param compress: Whether to compress the load if that makes it smaller
+    :return: The cookie value
+    """
+    body = load.encode('utf-8')
+    flags = 0
+    if compress:
+        _compressed = zlib.compress(body)
+        if len(_compressed) < len(body):
+            body = _compressed
+            flags |= FLAG_COMPRESSED
+    if enc_key:
+        flags |= FLAG_ENCRYPTED
+
+    bytes_kid = kid.encode('utf-8')
+    header = _COMPACT_HEADER.pack(COMPACT_VERSION, flags, timestamp,
+                                  len(bytes_kid)) + bytes_kid
+
+    if enc_key:
+        iv = os.urandom(IV_LENGTH)
+        blob = header + iv + cookie_cipher(enc_key, seed).encrypt(
+            iv, body, header)
+    else:
+        blob = header + body + hmac.new(
+            as_bytes(seed), header + body,
+            digestmod=hashlib.sha256).digest()[:SIGNATURE_LENGTH]
+    return _b64url_encode(blob)
+
+
+def unpack_compact_cookie(value):
+    """
+    Decode a cookie value in the compact format without verifying it.
+
+    :param value: The cookie value
+    :return: A (flags, timestamp, kid, header, rest) tuple or None if the
+        value is not in a known compact format.
+    """
+    try:
+        blob = _b64url_decode(value)
+        version, flags, timestamp, kid_len = _COMPACT_HEADER.unpack_from(blob)
+    except (ValueError, TypeError, struct.error):
+        return None
+    if version != COMPACT_VERSION:
+        return None
+
+    _end = _COMPACT_HEADER.size + kid_len
+    if len(blob) < _end:
+        return None
+    try:
+        kid = blob[_COMPACT_HEADER.size:_end].decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    return flags, timestamp, kid, blob[:_end], blob[_end:]
+
+
+def verify_compact_cookie(unpacked, seed, enc_key=None):
+    """
+    Verify a cookie in the compact format.
+
+    :param unpacked: What :py:func:`unpack_compact_cookie` returned
+    :param seed: A seed key used for the HMAC signature
+    :param enc_key: The encryption key used, if any
+    :raises InvalidCookieSign: When verification fails.
+    :return: A tuple consisting of (payload, timestamp)
+    """
+    flags, timestamp, _, header, rest = unpacked
+    if flags & FLAG_ENCRYPTED:
+        if not enc_key or len(rest) < IV_LENGTH:
+            raise InvalidCookieSign()
+        try:
+            body = cookie_cipher(enc_key, seed).decrypt(
+                rest[:IV_LENGTH], rest[IV_LENGTH:], header)
+        except InvalidTag:
+            raise InvalidCookieSign()
+    else:
+        body, sig = rest[:-SIGNATURE_LENGTH], rest[-SIGNATURE_LENGTH:]
+        _sig = hmac.new(as_bytes(seed), header + body,
+                        digestmod=hashlib.sha256).digest()[:SIGNATURE_LENGTH]
+        if len(sig) != SIGNATURE_LENGTH or not hmac.compare_digest(sig, _sig):
+            raise InvalidCookieSign()
+
+    if flags & FLAG_COMPRESSED:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error:
+            raise InvalidCookieSign()
+    return body.decode('utf-8'), str(timestamp)
+
+
+def split_kid(parts):
+    """
+    Separate the key identifier from the other parts of a cookie in the
+    legacy format. A signed cookie has 3 other parts, an encrypted one 4,
+    the last being the base64 encoded tag, which a signature never is.
+
+    :param parts: The parts of the cookie payload
+    :return: A tuple of the key identifier, or None if there is none, and
+        the other parts
+    """
+    if len(parts) == 5 or (len(parts) == 4 and not parts[3].endswith('=')):
+        return parts[0], parts[1:]
+    return None, parts
+
+
+def verify_cookie_parts(parts, seed, enc_key=None):
+    """
+    Verifies the parts of a cookie created by `make_cookie` without a key
+    identifier, or with the key identifier removed.
+
+    :param parts: The parts of the cookie payload
+    :param seed: A seed key used for the HMAC signature
+    :type seed: bytes
+    :param enc_key: The encryption key used.
+    :type enc_key: bytes or None
+    :raises InvalidCookieSign: When verification fails.
+    :return: A tuple consisting of (payload, timestamp) or None if parsing fails
+    """
+    seed = as_unicode(seed)
+
+    if len(parts) == 3:
         # verify the cookie signature
         cleartext, timestamp, sig = parts
         if not verify_cookie_signature(sig, seed, cleartext, timestamp):
@@ -242,16 +456,14 @@ def parse_cookie(name, seed, kaka, enc_key=None):
         tag = base64.b64decode(parts[3])
         ct = ciphertext + tag
 
-        # Make sure the key is 32-Bytes long
-        key = _make_hashed_key((enc_key, seed))
-        aesgcm = AESGCM(key)
+        aesgcm = cookie_cipher(enc_key, seed)
 
         # timestamp does not need to be encrypted, just MAC'ed,
         # so we add it to 'Associated Data' only.
         aad = timestamp.encode('utf-8')
         try:
             cleartext = aesgcm.decrypt(iv, ct, aad)
-        except JWEException:
+        except (InvalidTag, JWEException):
             raise InvalidCookieSign()
         return cleartext.decode('utf-8'), timestamp
     return None
@@ -266,12 +478,138 @@ def cookie_parts(name, kaka):
     :return: A list of parts or None if there is no cookie object with the
         given name
     """
-    cookie_obj = SimpleCookie(as_unicode(kaka))
-    morsel = cookie_obj.get(name)
-    if morsel:
-        return morsel.value.split("|")
-    else:
+    value = parse_cookie_header(kaka, [name]).get(name)
+    if value is None:
         return None
+    return value.split("|")
+
+
+# Backslash escapes used by SimpleCookie when quoting a value
+_ESCAPE_PATTERN = re.compile(r'\\(?:([0-3][0-7][0-7])|(.))')
+
+
+def _unescape(match):
+    if match.group(1):
+        return chr(int(match.group(1), 8))
+    return match.group(2)
+
+
+def _unquote(value):
+    if len(value) < 2 or value[0] != '"' or value[-1] != '"':
+        return value
+    value = value[1:-1]
+    if '\\' in value:
+        value = _ESCAPE_PATTERN.sub(_unescape, value)
+    return value
+
+
+def parse_cookie_header(kaka, names=None):
+    """
+    Find cookie values in a Cookie header, or in a Set-Cookie header value,
+    in one pass. Stops as soon as all the cookies asked for are found.
+
+    :param kaka: The header value
+    :param names: Names of the cookies to look for, all if None
+    :return: A dictionary of cookie name and value. If there is more than
+        one cookie with the same name the first one is used.
+    """
+    res = {}
+    if not kaka:
+        return res
+
+    if names is not None:
+        names = set(names)
+    for item in as_unicode(kaka).split(";"):
+        name, sep, value = item.partition("=")
+        if not sep:
+            continue
+        name = name.strip()
+        if name in res or (names is not None and name not in names):
+            continue
+        res[name] = _unquote(value.strip())
+        if names is not None and len(res) == len(names):
+            break
+    return res
+
+
+def make_kid(seed, enc_key=None):
+    """
+    A short identifier of a pair of cookie keys. The same keys always get
+    the same identifier, so all nodes that share keys agree on it.
+
+    :param seed: The seed
+    :param enc_key: The encryption key, if any
+    :return: An 8 character identifier
+    """
+    _digest = _make_hashed_key((b'kid', seed, enc_key))
+    return as_unicode(base64.urlsafe_b64encode(_digest[:6]))
+
+
+class CookieKeys(object):
+    """
+    An ordered ring of cookie keys. The newest pair of keys is used to
+    create cookies, all of them to parse cookies.
+    """
+
+    def __init__(self):
+        # kid -> (seed, enc_key), oldest first
+        self._keys = OrderedDict()
+
+    def add(self, seed, enc_key=None, kid=""):
+        """
+        Add a pair of keys, they will be used to create cookies from now on.
+
+        :param seed: The seed
+        :param enc_key: The encryption key, None if cookies are only signed
+        :param kid: Identifier of the keys, derived from the keys if not
+            given
+        :return: The key identifier
+        """
+        kid = kid or make_kid(seed, enc_key)
+        self._keys.pop(kid, None)
+        self._keys[kid] = (seed, enc_key)
+        return kid
+
+    def remove(self, kid):
+        """
+        Remove a pair of keys. Cookies created with them will not be
+        accepted anymore.
+
+        :param kid: The key identifier
+        """
+        if kid == self.current()[0]:
+            raise ValueError('Can not remove the keys in use')
+        del self._keys[kid]
+
+    def current(self):
+        """
+        :return: A (kid, seed, enc_key) tuple with the keys used to create
+            cookies
+        """
+        try:
+            kid = next(reversed(self._keys))
+        except StopIteration:
+            raise ImproperlyConfigured('There are no cookie keys')
+        return (kid,) + self._keys[kid]
+
+    def get(self, kid):
+        """
+        :param kid: The key identifier
+        :return: A (seed, enc_key) tuple or None if there are no such keys
+        """
+        return self._keys.get(kid)
+
+    def kids(self):
+        """
+        :return: The key identifiers, the oldest first
+        """
+        return list(self._keys.keys())
+
+    def __contains__(self, kid):
+        return kid in self._keys
+
+    def __len__(self):
+        return len(self._keys)
 
 
 class CookieDealer(object):
@@ -283,15 +621,24 @@ class CookieDealer(object):
         return self._srv
 
     def _set_server(self, server):
+        if server is not None and server is not getattr(self, '_srv', None):
+            # The keys of a new server replace those used so far
+            self.keys = self._server_keys(server)
         self._srv = server
 
     srv = property(_get_server, _set_server)
 
-    def __init__(self, srv, ttl=5):
+    def __init__(self, srv, ttl=5, compact=False, compress=False):
+        self.keys = CookieKeys()
         self.srv = None
         self.init_srv(srv)
         # minutes before the interaction should be completed
         self.cookie_ttl = ttl  # N minutes
+        # Whether cookies are created in the compact format. Both formats
+        # are always accepted, but older versions only accept the legacy
+        # one, so only switch once all nodes run this version.
+        self.compact = compact
+        self.compress = compress
 
     def init_srv(self, srv):
         """
@@ -303,8 +650,17 @@ class CookieDealer(object):
             return
         self.srv = srv
 
+    @staticmethod
+    def _server_keys(srv):
+        """
+        Make sure the server has the necessary attributes and create a key
+        ring with its keys.
+
+        :param srv: A server instance
+        :return: A :py:class:`CookieKeys` instance
+        """
         # verify that the server instance has a cymkey attribute
-        symkey = getattr(self.srv, 'symkey', None)
+        symkey = getattr(srv, 'symkey', None)
         if symkey is not None and symkey == "":
             msg = "CookieDealer.srv.symkey can not be an empty value"
             raise ImproperlyConfigured(msg)
@@ -313,6 +669,41 @@ class CookieDealer(object):
         if not getattr(srv, 'seed', None):
             setattr(srv, 'seed', rndstr().encode("utf-8"))
 
+        keys = CookieKeys()
+        keys.add(srv.seed, symkey)
+        return keys
+
+    def rotate_keys(self, seed=None, symkey=None, kid=""):
+        """
+        Start creating cookies with new keys. Cookies created with the
+        keys used so far are still accepted until those keys are retired.
+
+        :param seed: The new seed, a random one is created if not given
+        :param symkey: The new encryption key. If not given and cookies are
+            encrypted a random one is created.
+        :param kid: Identifier of the new keys
+        :return: The key identifier
+        """
+        if symkey is not None and symkey == "":
+            msg = "CookieDealer symkey can not be an empty value"
+            raise ImproperlyConfigured(msg)
+
+        if symkey is None and self.keys.current()[2]:
+            symkey = os.urandom(32)
+        seed = seed or rndstr().encode("utf-8")
+        kid = self.keys.add(seed, symkey, kid)
+        self.srv.seed = seed
+        self.srv.symkey = symkey
+        return kid
+
+    def retire_keys(self, kid):
+        """
+        Stop accepting cookies created with some keys.
+
+        :param kid: The key identifier
+        """
+        self.keys.remove(kid)
+
     def delete_cookie(self, cookie_name=None):
         """
         Create a cookie that will immediately expire when it hits the other
@@ -357,21 +748,28 @@ class CookieDealer(object):
         # now
         timestamp = str(int(time.time()))
 
-        # create cookie payload
-        try:
+        if not isinstance(value, str):
+            value = value[0]
+
+        # create cookie payload. The compact format already carries the
+        # timestamp.
+        if self.compact:
+            cookie_payload = "::".join([value, typ])
+        else:
             cookie_payload = "::".join([value, timestamp, typ])
-        except TypeError:
-            cookie_payload = "::".join([value[0], timestamp, typ])
 
-        cookie = make_cookie(cookie_name, cookie_payload, self.srv.seed,
+        kid, seed, symkey = self.keys.current()
+        cookie = make_cookie(cookie_name, cookie_payload, seed,
                              expire=ttl, domain=cookie_domain, path=cookie_path,
-                             timestamp=timestamp,
-                             enc_key=self.srv.symkey)
+                             timestamp=timestamp, enc_key=symkey, kid=kid,
+                             compact=self.compact, compress=self.compress)
         return cookie
 
     def get_cookie_value(self, cookie=None, cookie_name=None):
         """
-        Return information stored in a Cookie
+        Return information stored in a Cookie. The keys used to verify the
+        cookie are picked by the key identifier in the cookie. Cookies
+        without one are verified with the keys in use.
 
         :param cookie: A cookie instance
         :param cookie_name: The name of the cookie I'm looking for
@@ -380,14 +778,76 @@ class CookieDealer(object):
         if cookie is None or cookie_name is None:
             return None
         else:
-            try:
-                info, timestamp = parse_cookie(cookie_name,
-                                               self.srv.seed, cookie,
-                                               self.srv.symkey)
-            except (TypeError, AssertionError):
+            parts = cookie_parts(cookie_name, cookie)
+            if not parts:
                 return None
-            else:
-                value, _ts, typ = info.split("::")
-                if timestamp == _ts:
-                    return value, _ts, typ
+            return self._cookie_value(parts)
+
+    def _cookie_value(self, parts):
+        if len(parts) == 1:
+            return self._compact_cookie_value(parts[0])
+
+        kid, parts = split_kid(parts)
+        if kid is None:
+            _, seed, symkey = self.keys.current()
+        else:
+            _keys = self.keys.get(kid)
+            if _keys is None:
+                # Made with keys that are no longer in the ring
+                return None
+            seed, symkey = _keys
+
+        try:
+            info, timestamp = verify_cookie_parts(parts, seed, symkey)
+            value, _ts, typ = info.split("::")
+        except (TypeError, ValueError, AssertionError):
+            # Not a cookie of ours, or a mangled one
+            return None
+        if timestamp == _ts:
+            return value, _ts, typ
         return None
+
+    def get_cookie_values(self, cookie=None, cookie_names=None):
+        """
+        Return the information stored in several cookies, reading the
+        Cookie header only once.
+
+        :param cookie: The Cookie header value
+        :param cookie_names: The names of the cookies I'm looking for
+        :return: A dictionary of cookie name and (value, timestamp, type)
+            tuple. Cookies that are missing or can not be used are left out.
+        """
+        if not cookie or not cookie_names:
+            return {}
+
+        res = {}
+        for name, value in parse_cookie_header(cookie, cookie_names).items():
+            try:
+                _info = self._cookie_value(value.split("|"))
+            except InvalidCookieSign:
+                logger.warning('Cookie %s failed verification', name)
+                continue
+            if _info is not None:
+                res[name] = _info
+        return res
+
+    def _compact_cookie_value(self, value):
+        unpacked = unpack_compact_cookie(value)
+        if unpacked is None:
+            return None
+
+        kid = unpacked[2]
+        if kid:
+            _keys = self.keys.get(kid)
+            if _keys is None:
+                return None
+            seed, symkey = _keys
+        else:
+            _, seed, symkey = self.keys.current()
+
+        info, timestamp = verify_compact_cookie(unpacked, seed, symkey)
+        try:
+            value, typ = info.rsplit("::", 1)
+        except ValueError:
+            return None
+        return value, timestamp, typ
@@ -6,9 +6,9 @@ from http.cookiejar import FileCookieJar
 from http.cookies import CookieError
 from http.cookies import SimpleCookie
 
-from oidcservice import sanitize
 from oidcservice.exception import NonFatalException
 
+from oidcrp.util import Sanitized
 from oidcrp.util import set_cookie
 
 __author__ = 'roland'
@@ -51,7 +51,7 @@ class HTTPLib(object):
     def add_cookies(self, kwargs):
         if self.cookiejar:
             kwargs["cookies"] = self._cookies()
-            logger.debug("SENT {} COOKIES".format(len(kwargs["cookies"])))
+            logger.debug("SENT %d COOKIES", len(kwargs["cookies"]))
         return kwargs
 
     def run_req_callback(self, url, method, kwargs):
@@ -99,8 +99,8 @@ class HTTPLib(object):
             r = requests.request(method, url, **_kwargs)
         except Exception as err:
             logger.error(
-                "http_request failed: %s, url: %s, htargs: %s, method: %s" % (
-                    err, url, sanitize(_kwargs), method))
+                "http_request failed: %s, url: %s, htargs: %s, method: %s",
+                err, url, Sanitized(_kwargs), method)
             raise
 
         if self.events is not None:
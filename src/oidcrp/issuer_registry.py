@@ -0,0 +1,91 @@
+"""What worker processes know about the OPs/ASs they have set up clients for.
+
+Under a pre-forking server every worker process has its own RPHandler. If
+they share an :py:class:`IssuerRegistry` only the first worker that needs a
+client for an OP/AS does provider info discovery and client registration.
+The others recreate the client from the provider info, registration
+response and callback URLs that worker stored in the registry.
+
+The registry keeps its information in a database with the same interface as
+the state database, often the very same database. Only one worker at a time
+sets up a client for an OP/AS if that database has an atomic *add* method,
+see :py:class:`oidcrp.state_lock.StateLock`, which also explains when locks
+left by a dead worker are broken. Without it workers may do discovery and
+registration in parallel.
+"""
+import json
+import logging
+
+from oidcrp.state_lock import StateLock
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+ISSUER_PATTERN = 'registry{}registry'
+CALLBACK_PATTERN = 'callback{}callback'
+
+
+class IssuerRegistry(object):
+    def __init__(self, db, lock=None):
+        """
+        :param db: A database with set, get and delete methods that all
+            worker processes can reach.
+        :param lock: A :py:class:`oidcrp.state_lock.StateLock` instance
+            working on the same database. One is created if not given.
+        """
+        self.db = db
+        self.lock = lock or StateLock(db)
+
+    def _get(self, key):
+        try:
+            _val = self.db.get(key)
+        except KeyError:
+            return None
+        if _val:
+            return json.loads(_val)
+        return None
+
+    def get(self, issuer):
+        """
+        Find what is known about an OP/AS.
+
+        :param issuer: The issuer ID or the configuration key used to set up
+            the client
+        :return: A client snapshot or None if nothing is known
+        """
+        return self._get(ISSUER_PATTERN.format(issuer))
+
+    def set(self, issuer, snapshot):
+        """
+        Store what is known about an OP/AS.
+
+        :param issuer: The issuer ID or the configuration key used to set up
+            the client
+        :param snapshot: A client snapshot, must be JSON serializable
+        """
+        self.db.set(ISSUER_PATTERN.format(issuer), json.dumps(snapshot))
+
+    def delete(self, issuer):
+        self.db.delete(ISSUER_PATTERN.format(issuer))
+
+    def get_callback_issuer(self, op_hash):
+        """
+        Find which OP/AS a callback URL path element belongs to.
+
+        :param op_hash: The issuer specific part of the callback URL
+        :return: Issuer ID or None if unknown
+        """
+        return self._get(CALLBACK_PATTERN.format(op_hash))
+
+    def set_callback_issuer(self, op_hash, issuer):
+        self.db.set(CALLBACK_PATTERN.format(op_hash), json.dumps(issuer))
+
+    def hold(self, issuer):
+        """
+        Lock an OP/AS, among all workers, while a client for it is being set
+        up.
+
+        :param issuer: The issuer ID or the configuration key
+        """
+        return self.lock.hold(ISSUER_PATTERN.format(issuer))
@@ -0,0 +1,131 @@
+"""JSON encoding and decoding with the fastest library available.
+
+Codecs are registered by name. orjson and ujson are used if they are
+installed, otherwise the standard library json module. Which one is used
+can be changed with :py:func:`use_codec`.
+
+:py:func:`loads` accepts str as well as bytes so a HTTP response body can be
+decoded without first being turned into a string. If the chosen codec
+refuses a document the standard library gets a go at it, so errors are
+always raised as :py:class:`json.JSONDecodeError`. :py:func:`dumps` falls
+back in the same way for objects the chosen codec can not encode.
+
+orjson turns integers that do not fit in 64 bits into floats. Documents
+with numbers that long are therefore left to the standard library.
+"""
+import json
+import logging
+import re
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+# name -> (loads, dumps)
+CODECS = {}
+
+# In order of preference
+PREFERENCE = ['orjson', 'ujson', 'json']
+
+_current = {}
+
+
+def register_codec(name, loads, dumps):
+    """
+    Register a JSON codec.
+
+    :param name: Name of the codec
+    :param loads: Function that decodes a JSON document, given as str or
+        bytes. Must raise ValueError, or a subclass of it, if the document
+        is not proper JSON.
+    :param dumps: Function that encodes an object into a JSON document,
+        returned as a str.
+    """
+    CODECS[name] = (loads, dumps)
+
+
+def use_codec(name):
+    """
+    Select which JSON codec to use.
+
+    :param name: Name of a registered codec
+    """
+    try:
+        _current['loads'], _current['dumps'] = CODECS[name]
+    except KeyError:
+        raise ValueError('Unknown JSON codec: {}'.format(name))
+    _current['name'] = name
+    logger.debug('Using JSON codec %s', name)
+
+
+def codec_name():
+    """
+    :return: The name of the JSON codec in use
+    """
+    return _current['name']
+
+
+def loads(doc):
+    """
+    Decode a JSON document.
+
+    :param doc: The document as str or bytes
+    :return: The decoded object
+    """
+    try:
+        return _current['loads'](doc)
+    except ValueError:
+        if _current['name'] == 'json':
+            raise
+    return json.loads(doc)
+
+
+def dumps(obj):
+    """
+    Encode an object as a JSON document.
+
+    :param obj: The object
+    :return: The document as a str
+    """
+    try:
+        return _current['dumps'](obj)
+    except TypeError:
+        if _current['name'] == 'json':
+            raise
+    return json.dumps(obj)
+
+
+register_codec('json', json.loads, json.dumps)
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    # A run of digits long enough to be an integer that does not fit in
+    # 64 bits. May also be in a string, then the document is decoded by the
+    # standard library for nothing.
+    _LONG_NUMBER = re.compile(r'\d{19}')
+    _LONG_NUMBER_BYTES = re.compile(rb'\d{19}')
+
+    def _orjson_loads(doc):
+        if isinstance(doc, str):
+            _long = _LONG_NUMBER.search(doc)
+        else:
+            _long = _LONG_NUMBER_BYTES.search(doc)
+        if _long:
+            return json.loads(doc)
+        return orjson.loads(doc)
+
+    register_codec('orjson', _orjson_loads,
+                   lambda obj: orjson.dumps(obj).decode('utf-8'))
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    register_codec('ujson', ujson.loads,
+                   lambda obj: ujson.dumps(obj, escape_forward_slashes=False))
+
+use_codec([n for n in PREFERENCE if n in CODECS][0])
@@ -0,0 +1,272 @@
+"""Fetching the keys of OPs/ASs without fetch storms.
+
+A :py:class:`cryptojwt.key_bundle.KeyBundle` with a remote source fetches
+the JWKS again every time its keys are used. :py:class:`CachedKeyBundle`
+only does so when what it has is older than the cache time and then only
+one thread does the fetch while the others go on using the keys they have.
+The fetched keys replace the old ones in one go, the bundle is never empty
+while a fetch is going on.
+
+:py:class:`RefreshingKeyJar` deals with a key ID that is not among the keys
+it has, which is what happens when an OP/AS has rotated its keys. It fetches
+the issuer's keys again, but not more than once per interval. Callers that
+arrive while a fetch is going on wait for it and then use its result.
+
+:py:class:`KeyRefresher` is a background thread that fetches keys before
+they become stale so that requests never have to.
+"""
+import copy
+import logging
+import threading
+import time
+
+from cryptojwt.key_bundle import KeyBundle
+from cryptojwt.key_jar import KeyJar
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before trying again after a failed fetch
+RETRY_AFTER = 30
+
+
+class CachedKeyBundle(KeyBundle):
+    def __init__(self, *args, **kwargs):
+        self._update_lock = threading.Lock()
+        KeyBundle.__init__(self, *args, **kwargs)
+
+    def stale(self, now=0):
+        return self.remote and (now or time.time()) > self.time_out
+
+    def _uptodate(self):
+        if not self.stale():
+            return False
+
+        if self._keys:
+            if not self._update_lock.acquire(blocking=False):
+                # Someone else is fetching, use what we have
+                return False
+        else:
+            self._update_lock.acquire()
+            if not self.stale():
+                self._update_lock.release()
+                return False
+
+        try:
+            return self.refetch()
+        finally:
+            self._update_lock.release()
+
+    def update(self):
+        """
+        Reload the keys. Unlike :py:meth:`KeyBundle.update` the keys in use
+        are left alone while the new ones are read, the new list is put in
+        place with one assignment. Readers never find the bundle empty.
+
+        :return: True if the keys were read otherwise False
+        """
+        if not self.source:
+            return True
+
+        # A copy of the bundle reads the keys, into a list of its own
+        _loader = copy.copy(self)
+        _loader._keys = []
+        res = True
+        try:
+            if self.remote is False:
+                if self.fileformat in ['jwks', 'jwk']:
+                    _loader.do_local_jwk(self.source)
+                elif self.fileformat == 'der':
+                    _loader.do_local_der(self.source, self.keytype,
+                                         self.keyusage)
+            else:
+                res = _loader.do_remote()
+        except Exception as err:
+            logger.error('Key bundle update failed: %s', err)
+            return False
+
+        _keys = _loader._keys
+        _replaced = [k for k in self._keys if k not in _keys]
+        for attr in ['time_out', 'last_updated', 'imp_jwks']:
+            if attr in _loader.__dict__:
+                setattr(self, attr, getattr(_loader, attr))
+        self._keys = _keys + _replaced
+
+        now = time.time()
+        for _key in _replaced:
+            if not _key.inactive_since:
+                _key.inactive_since = now
+        return res
+
+    def refetch(self):
+        """
+        Fetch the keys from the remote source.
+
+        :return: True if the fetch succeeded otherwise False
+        """
+        if self.update():
+            return True
+        self.time_out = time.time() + RETRY_AFTER
+        return False
+
+    def copy(self):
+        _bundle = CachedKeyBundle()
+        _bundle.set(self._keys[:])
+        for attr in ['cache_time', 'verify_ssl', 'httpc', 'time_out']:
+            setattr(_bundle, attr, getattr(self, attr))
+        if self.source:
+            for attr in ['source', 'fileformat', 'keytype', 'keyusage',
+                         'remote']:
+                setattr(_bundle, attr, getattr(self, attr))
+        return _bundle
+
+
+class RefreshingKeyJar(KeyJar):
+    def __init__(self, min_interval=30, **kwargs):
+        """
+        :param min_interval: Minimum number of seconds between two fetches
+            of an issuer's keys caused by an unknown key ID.
+        :param kwargs: Arguments for :py:class:`cryptojwt.key_jar.KeyJar`
+        """
+        kwargs.setdefault('keybundle_cls', CachedKeyBundle)
+        KeyJar.__init__(self, **kwargs)
+        self.min_interval = min_interval
+        # issuer -> when the keys were last fetched
+        self._fetched = {}
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def _issuer_lock(self, issuer):
+        with self._guard:
+            try:
+                return self._locks[issuer]
+            except KeyError:
+                _lock = self._locks[issuer] = threading.Lock()
+                return _lock
+
+    def refresh(self, issuer, force=False):
+        """
+        Fetch an issuer's keys from their remote sources. Unless forced
+        this happens at most once every min_interval seconds. Blocks while
+        someone else is fetching the same issuer's keys.
+
+        :param issuer: Issuer ID
+        :param force: Disregard when the keys were last fetched
+        :return: True if the keys were fetched, by this or another caller,
+            since this method was called.
+        """
+        _start = time.time()
+        with self._issuer_lock(issuer):
+            _last = self._fetched.get(issuer, 0)
+            if _last >= _start:
+                return True
+            if not force and _start - _last < self.min_interval:
+                return False
+
+            res = False
+            for _bundle in self.issuer_keys.get(issuer, []):
+                if not _bundle.remote:
+                    continue
+                if isinstance(_bundle, CachedKeyBundle):
+                    res = _bundle.refetch() or res
+                else:
+                    res = _bundle.update() or res
+            self._fetched[issuer] = time.time()
+            return res
+
+    def load_issuer(self, issuer, find_url):
+        """
+        Fetch the keys of an issuer the key jar has no keys for. Only one
+        caller at a time does this for an issuer.
+
+        :param issuer: Issuer ID
+        :param find_url: Callable that given the issuer ID returns where
+            the issuer's JWKS is published
+        """
+        if issuer in self:
+            return
+
+        with self._issuer_lock(issuer):
+            if issuer not in self:
+                self.add_url(issuer, find_url(issuer))
+                self._fetched[issuer] = time.time()
+
+    def refresh_stale(self, ahead=0):
+        """
+        Fetch the keys of issuers that have keys that will be stale within
+        a given number of seconds.
+
+        :param ahead: Number of seconds
+        """
+        _when = time.time() + ahead
+        for issuer, bundles in list(self.issuer_keys.items()):
+            if any(isinstance(kb, CachedKeyBundle) and kb.stale(_when)
+                   for kb in bundles):
+                logger.debug('Fetching keys for %s', issuer)
+                self.refresh(issuer, force=True)
+
+    def get_jwt_verify_keys(self, jwt, **kwargs):
+        keys = KeyJar.get_jwt_verify_keys(self, jwt, **kwargs)
+        if keys or 'kid' not in jwt.headers:
+            return keys
+
+        _iss = jwt.payload().get('iss') or kwargs.get('iss')
+        if _iss and _iss in self:
+            logger.debug('Unknown kid %s from %s', jwt.headers['kid'], _iss)
+            if self.refresh(_iss):
+                keys = KeyJar.get_jwt_verify_keys(self, jwt, **kwargs)
+        return keys
+
+    def copy(self):
+        kj = RefreshingKeyJar(min_interval=self.min_interval,
+                              keybundle_cls=self.keybundle_cls)
+        for issuer in self.owners():
+            kj[issuer] = [kb.copy() for kb in self[issuer]]
+
+        kj.verify_ssl = self.verify_ssl
+        return kj
+
+
+class KeyRefresher(object):
+    def __init__(self, client_cache, tick=60):
+        """
+        :param client_cache: A :py:class:`oidcrp.client_cache.ClientCache`
+            instance
+        :param tick: Number of seconds between checks for keys that are
+            about to become stale.
+        """
+        self.client_cache = client_cache
+        self.tick = tick
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the background thread if it is not already running.
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def refresh_stale(self):
+        """
+        Fetch the keys that will be stale before the next check.
+        """
+        for issuer, client in self.client_cache.live_items():
+            _kj = client.service_context.keyjar
+            if isinstance(_kj, RefreshingKeyJar):
+                _kj.refresh_stale(ahead=self.tick)
+
+    def _run(self):
+        while not self._stop.wait(self.tick):
+            try:
+                self.refresh_stale()
+            except Exception as err:
+                logger.error('Key refresh: %s', err)
@@ -0,0 +1,196 @@
+"""Rotation of the RP's own keys while it is running.
+
+New keys are added to the RP's key jar and to the key jars of all live
+clients and are published at once. The keys they replace stay in use and
+stay published for an overlap period, which should be longer than the time
+OPs/ASs may cache the RP's JWKS. When it has passed the old keys are removed
+and the new keys take over signing. Clients that are created later copy the
+RP's key jar and so get the new keys too.
+
+The published JWKS is serialized once per change and served with an ETag
+and a max-age so OPs/ASs do not have to fetch it over and over again.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from cryptojwt.key_bundle import KeyBundle
+from cryptojwt.key_bundle import build_key_bundle
+from cryptojwt.utils import as_bytes
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+class KeyRotation(object):
+    def __init__(self, keyjar, client_keyjars=None, overlap=86400,
+                 max_age=3600, private_path=''):
+        """
+        :param keyjar: The RP's key jar, the RP's own keys are the ones
+            with owner ''
+        :param client_keyjars: A callable returning the key jars of the
+            live clients
+        :param overlap: Number of seconds old keys are kept after new keys
+            have been added
+        :param max_age: Number of seconds OPs/ASs may cache the JWKS
+        :param private_path: If given, the private keys are written to this
+            file after every change so they survive a restart.
+        """
+        self.keyjar = keyjar
+        self.client_keyjars = client_keyjars
+        self.overlap = overlap
+        self.max_age = max_age
+        self.private_path = private_path
+        # [(retire at, [keys]), ..] earliest first
+        self._retiring = []
+        self._published = None
+        self._lock = threading.RLock()
+
+    def own_keys(self):
+        """
+        :return: The RP's own keys
+        """
+        try:
+            _bundles = self.keyjar.issuer_keys['']
+        except KeyError:
+            return []
+        return [k for kb in _bundles for k in kb.keys()]
+
+    def _keyjars(self):
+        _kjs = [self.keyjar]
+        if self.client_keyjars:
+            _kjs.extend(self.client_keyjars())
+        return _kjs
+
+    def rotate(self, key_defs=None, jwks=None, now=0):
+        """
+        Add new keys and schedule the present ones to be retired.
+
+        :param key_defs: Key definitions, as used by
+            :py:func:`cryptojwt.key_bundle.build_key_bundle`
+        :param jwks: A private JWKS, for when all nodes should get the same
+            keys.
+        :param now: Current time in seconds since the epoch
+        :return: The KeyBundle with the new keys
+        """
+        if jwks:
+            _bundle = KeyBundle(keys=jwks['keys'])
+        elif key_defs:
+            _bundle = build_key_bundle(key_defs)
+        else:
+            raise ValueError('Need key definitions or a JWKS')
+
+        _now = now or time.time()
+        with self._lock:
+            _scheduled = [k for _, keys in self._retiring for k in keys]
+            _old = [k for k in self.own_keys() if k not in _scheduled]
+            if _old:
+                self._retiring.append((_now + self.overlap, _old))
+
+            # The same bundle instance goes into all key jars
+            for _kj in self._keyjars():
+                _kj.issuer_keys[''] = _kj.issuer_keys.get('', []) + [_bundle]
+
+            self._changed()
+
+        if _old and not now:
+            _timer = threading.Timer(self.overlap, self.retire_due)
+            _timer.daemon = True
+            _timer.start()
+
+        logger.info('Added keys %s, retiring %s', _bundle.kids(),
+                    [k.kid for k in _old])
+        return _bundle
+
+    def retire_due(self, now=0):
+        """
+        Remove the old keys whose overlap period has passed.
+
+        :param now: Current time in seconds since the epoch
+        :return: The keys that were removed
+        """
+        _now = now or time.time()
+        with self._lock:
+            _due = []
+            while self._retiring and self._retiring[0][0] <= _now:
+                _due.extend(self._retiring.pop(0)[1])
+            if not _due:
+                return []
+
+            for _kj in self._keyjars():
+                _bundles = []
+                for kb in _kj.issuer_keys.get('', []):
+                    for _key in [k for k in kb.keys() if k in _due]:
+                        kb.remove(_key)
+                    if len(kb):
+                        _bundles.append(kb)
+                _kj.issuer_keys[''] = _bundles
+
+            self._changed()
+
+        logger.info('Retired keys %s', [k.kid for k in _due])
+        return _due
+
+    def next_retirement(self):
+        """
+        :return: When the next keys are due to be retired, 0 if none are.
+        """
+        with self._lock:
+            if self._retiring:
+                return self._retiring[0][0]
+            return 0
+
+    def _changed(self):
+        self._published = None
+        if self.private_path:
+            self._write_private(json.dumps(
+                self.keyjar.export_jwks(private=True, issuer='')))
+
+    def _write_private(self, content):
+        """
+        Replace the private JWKS file in one go, so a crash half way never
+        leaves it truncated. The file is only readable by its owner.
+
+        :param content: The serialized private JWKS
+        """
+        _dir = os.path.dirname(os.path.abspath(self.private_path))
+        # mkstemp creates the file with mode 0600
+        _fd, _tmp = tempfile.mkstemp(dir=_dir, prefix='.jwks-')
+        try:
+            with os.fdopen(_fd, 'w') as fp:
+                fp.write(content)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(_tmp, self.private_path)
+        except Exception:
+            os.unlink(_tmp)
+            raise
+
+    def jwks(self, now=0):
+        """
+        The RP's public JWKS together with the HTTP headers it should be
+        served with.
+
+        :param now: Current time in seconds since the epoch
+        :return: A (JSON document, headers dictionary) tuple
+        """
+        self.retire_due(now)
+        _published = self._published
+        if _published is None:
+            with self._lock:
+                _body = json.dumps(self.keyjar.export_jwks(issuer=''))
+                _etag = '"{}"'.format(
+                    hashlib.sha256(as_bytes(_body)).hexdigest()[:32])
+                _published = self._published = (_body, _etag)
+
+        _body, _etag = _published
+        return _body, {
+            'Content-Type': 'application/json',
+            'Cache-Control': 'public, max-age={}'.format(self.max_age),
+            'ETag': _etag
+        }
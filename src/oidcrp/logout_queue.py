@@ -0,0 +1,144 @@
+"""Back channel logout requests handled off the request thread.
+
+When an OP/AS ends many sessions at once it will send a burst of back
+channel logout requests. Instead of verifying each logout token while the
+OP/AS is waiting for the response, :py:class:`BackChannelLogoutQueue` puts
+the request on a queue and returns. A pool of worker threads verifies the
+logout tokens, drops tokens that have been seen before and hands the
+sessions that should end over to a single thread that removes them in
+batches.
+"""
+import logging
+import queue
+import threading
+import time
+
+from oidcmsg.exception import MessageException
+
+from oidcrp.ttl_cache import TTLCache
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayCache(TTLCache):
+    def __init__(self, max_size=10000):
+        """
+        :param max_size: How many logout tokens to remember. When there are
+            more the oldest are forgotten.
+        """
+        TTLCache.__init__(self, max_size)
+
+    def seen(self, issuer, jti):
+        """
+        Check if a logout token has been seen before and remember it if it
+        has not.
+
+        :param issuer: The issuer of the logout token
+        :param jti: The JWT ID of the logout token
+        :return: True if the token has been seen before otherwise False
+        """
+        return not self.add((issuer, jti), True)
+
+
+class BackChannelLogoutQueue(object):
+    def __init__(self, remove_states, workers=4, max_queue=10000,
+                 replay_cache_size=10000, batch_size=100, batch_interval=0.1):
+        """
+        :param remove_states: Callable that given a list of state values
+            ends those sessions.
+        :param workers: Number of threads that verify logout tokens
+        :param max_queue: Maximum number of logout requests waiting to be
+            verified
+        :param replay_cache_size: Number of logout token IDs to remember
+        :param batch_size: Maximum number of sessions removed in one go
+        :param batch_interval: Maximum number of seconds a session waits
+            to be removed.
+        """
+        self.remove_states = remove_states
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.replay_cache = ReplayCache(replay_cache_size)
+        self._requests = queue.Queue(max_queue)
+        self._removals = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self.workers):
+                self._threads.append(
+                    threading.Thread(target=self._verify, daemon=True))
+            self._threads.append(
+                threading.Thread(target=self._remove, daemon=True))
+            for _thread in self._threads:
+                _thread.start()
+
+    def submit(self, client, request):
+        """
+        Queue a back channel logout request. Will raise :py:class:`queue.Full`
+        if the queue is full.
+
+        :param client: The Client instance the request was sent to
+        :param request: URL encoded logout request
+        """
+        if not self._threads:
+            self._start()
+        self._requests.put_nowait((client, request))
+
+    def _verify(self):
+        # Here to avoid a circular import
+        from oidcrp import logout_token_states
+        from oidcrp import verify_logout_request
+
+        while True:
+            client, request = self._requests.get()
+            try:
+                _token = verify_logout_request(client, request)
+                if self.replay_cache.seen(_token['iss'], _token['jti']):
+                    logger.info('Replayed logout token from %s',
+                                _token['iss'])
+                    continue
+
+                for _state in logout_token_states(client, _token):
+                    self._removals.put(_state)
+            except (MessageException, KeyError) as err:
+                logger.warning('Logout request rejected: %s', err)
+            except Exception as err:
+                logger.error('Failed processing logout request: %s', err)
+            finally:
+                self._requests.task_done()
+
+    def _remove(self):
+        while True:
+            _batch = [self._removals.get()]
+            _limit = time.time() + self.batch_interval
+            while len(_batch) < self.batch_size:
+                _timeout = _limit - time.time()
+                if _timeout <= 0:
+                    break
+                try:
+                    _batch.append(self._removals.get(timeout=_timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                self.remove_states(_batch)
+                logger.debug('Removed %d sessions', len(_batch))
+            except Exception as err:
+                logger.error('Failed removing sessions: %s', err)
+            finally:
+                for _ in _batch:
+                    self._removals.task_done()
+
+    def join(self):
+        """
+        Wait until all queued logout requests have been processed and the
+        sessions they were about have been removed.
+        """
+        self._requests.join()
+        self._removals.join()
@@ -0,0 +1,157 @@
+"""Metrics on the requests clients send to their OPs/ASs.
+
+For every issuer and service (accesstoken, refresh_token, userinfo,
+provider_info, registration, webfinger, ..) the number of requests per HTTP
+status class, the latency and the number of responses that could not be
+parsed or verified are counted. The result can be exported in the
+Prometheus text exposition format.
+
+Only back-channel requests, the ones the RP sends itself, are measured.
+Services whose request is a redirect of the user's browser, like
+authorization and end_session, are never counted. The RP only builds the
+URL for those, the request and how long it takes are out of its sight.
+
+By default clients use :py:data:`NO_METRICS` which does nothing. Give
+the RPHandler a :py:class:`Metrics` instance as its metrics argument to turn
+collection on.
+"""
+import bisect
+import logging
+import threading
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+def status_class(status_code, failed=False):
+    """
+    :param status_code: HTTP status code, None if there was no HTTP response
+    :param failed: Whether the request ended with an exception
+    :return: The status class, like '2xx'. 'error' if the request failed
+        without a HTTP response, 'none' if no HTTP request was needed.
+    """
+    if status_code:
+        return '{}xx'.format(status_code // 100)
+    if failed:
+        return 'error'
+    return 'none'
+
+
+class NoMetrics(object):
+    def observe(self, issuer, service, duration, status='2xx',
+                parse_failure=False):
+        pass
+
+    def exposition(self):
+        return ''
+
+
+NO_METRICS = NoMetrics()
+
+
+def _labels(**kwargs):
+    _escaped = []
+    for name, value in kwargs.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+        _escaped.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(_escaped) + '}'
+
+
+class Metrics(NoMetrics):
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='oidcrp'):
+        """
+        :param buckets: Upper bounds of the latency histogram buckets
+        :param prefix: Prefix of the metric names
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        # (issuer, service, status class) -> count
+        self._requests = {}
+        # (issuer, service) -> [[count per bucket], sum, count]
+        self._latency = {}
+        # (issuer, service) -> count
+        self._parse_failures = {}
+        self._lock = threading.Lock()
+
+    def observe(self, issuer, service, duration, status='2xx',
+                parse_failure=False):
+        """
+        Record a request.
+
+        :param issuer: Issuer ID
+        :param service: Service name
+        :param duration: Number of seconds the request, including parsing
+            and verifying the response, took
+        :param status: HTTP status class as returned by
+            :py:func:`status_class`
+        :param parse_failure: Whether parsing or verifying the response
+            failed
+        """
+        _key = (issuer, service)
+        _bucket = bisect.bisect_left(self.buckets, duration)
+        with self._lock:
+            _rkey = (issuer, service, status)
+            self._requests[_rkey] = self._requests.get(_rkey, 0) + 1
+
+            try:
+                _hist = self._latency[_key]
+            except KeyError:
+                _hist = self._latency[_key] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0]
+            _hist[0][_bucket] += 1
+            _hist[1] += duration
+            _hist[2] += 1
+
+            if parse_failure:
+                self._parse_failures[_key] = \
+                    self._parse_failures.get(_key, 0) + 1
+
+    def exposition(self):
+        """
+        :return: The metrics in Prometheus text format
+        """
+        with self._lock:
+            _requests = sorted(self._requests.items())
+            _latency = sorted(
+                (k, [list(v[0]), v[1], v[2]]) for k, v in self._latency.items())
+            _failures = sorted(self._parse_failures.items())
+
+        _name = '{}_requests_total'.format(self.prefix)
+        lines = [
+            '# HELP {} Back-channel requests sent to OPs/ASs.'.format(_name),
+            '# TYPE {} counter'.format(_name)]
+        for (issuer, service, status), count in _requests:
+            lines.append('{}{} {}'.format(
+                _name, _labels(issuer=issuer, service=service, status=status),
+                count))
+
+        _name = '{}_request_duration_seconds'.format(self.prefix)
+        lines.extend(['# HELP {} Request latency.'.format(_name),
+                      '# TYPE {} histogram'.format(_name)])
+        for (issuer, service), (counts, total, count) in _latency:
+            _cumulative = 0
+            for _bound, _count in zip(self.buckets + ('+Inf',), counts):
+                _cumulative += _count
+                lines.append('{}_bucket{} {}'.format(
+                    _name, _labels(issuer=issuer, service=service, le=_bound),
+                    _cumulative))
+            _lbl = _labels(issuer=issuer, service=service)
+            lines.append('{}_sum{} {}'.format(_name, _lbl, total))
+            lines.append('{}_count{} {}'.format(_name, _lbl, count))
+
+        _name = '{}_parse_failures_total'.format(self.prefix)
+        lines.extend([
+            '# HELP {} Responses that could not be parsed or verified.'.format(
+                _name),
+            '# TYPE {} counter'.format(_name)])
+        for (issuer, service), count in _failures:
+            lines.append('{}{} {}'.format(
+                _name, _labels(issuer=issuer, service=service), count))
+
+        return '\n'.join(lines) + '\n'
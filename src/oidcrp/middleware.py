@@ -0,0 +1,90 @@
+"""Middleware around the requests a client sends to its OP/AS.
+
+A middleware is a callable that is given the service that is used, the
+request information and the next step in the chain. It returns the parsed
+response, normally by calling the next step, but it may also return
+something else, like a cached response, or call the next step more than
+once, to retry::
+
+    class Timing(Middleware):
+        def __call__(self, service, info, call_next):
+            _start = time.time()
+            try:
+                return call_next(info)
+            finally:
+                logger.info('%s took %f', service.service_name,
+                            time.time() - _start)
+
+The request information is a dictionary with url, method, body, headers
+and response_body_type plus whatever extra arguments the service added.
+Middleware can change it before passing it on.
+
+Middleware is added to a client either in the code, using
+:py:meth:`oidcrp.oauth2.Client.add_middleware`, or in the client
+configuration::
+
+    'middleware': [
+        {
+            'class': 'mypackage.Timing',
+            'kwargs': {},
+            'services': ['accesstoken', 'userinfo']
+        }
+    ]
+
+Without 'services' the middleware is used for all services. The first
+middleware in the list is the outermost one.
+"""
+import logging
+
+from oidcrp.util import cached_importer
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+class Middleware(object):
+    def __call__(self, service, info, call_next):
+        """
+        :param service: A :py:class:`oidcservice.service.Service` instance
+        :param info: Request information
+        :param call_next: Callable that given the request information sends
+            the request and returns the parsed response.
+        :return: The parsed response
+        """
+        return call_next(info)
+
+
+def middleware_from_config(spec):
+    """
+    Instantiate a middleware from its configuration.
+
+    :param spec: Dictionary with 'class' and possibly 'kwargs' and
+        'services'
+    :return: A (middleware, service names) tuple, the service names are None
+        if the middleware applies to all services.
+    """
+    _cls = cached_importer(spec['class'])
+    return _cls(**spec.get('kwargs', {})), spec.get('services')
+
+
+def build_chain(middleware, service, handler):
+    """
+    Wrap a handler in layers of middleware.
+
+    :param middleware: Middleware instances, the outermost first
+    :param service: The service the chain is used for
+    :param handler: Callable that given the request information sends
+        the request and returns the parsed response.
+    :return: A callable that takes the request information
+    """
+    _next = handler
+    for _mw in reversed(middleware):
+        _next = _layer(_mw, service, _next)
+    return _next
+
+
+def _layer(middleware, service, call_next):
+    def _call(info):
+        return middleware(service, info, call_next)
+    return _call
@@ -1,4 +1,6 @@
 import logging
+import threading
+import time
 from json import JSONDecodeError
 
 from cryptojwt.key_jar import KeyJar
@@ -9,13 +11,22 @@ from oidcservice.exception import ParseError
 from oidcservice.oauth2 import DEFAULT_SERVICES
 from oidcservice.service import REQUEST_INFO
 from oidcservice.service import SUCCESSFUL
-from oidcservice.service import init_services
 from oidcservice.service_context import ServiceContext
-from oidcservice.state_interface import StateInterface
 
 from oidcrp.http import HTTPLib
+from oidcrp.metrics import NO_METRICS
+from oidcrp.metrics import status_class
+from oidcrp.middleware import build_chain
+from oidcrp.middleware import middleware_from_config
+from oidcrp.services import LazyServices
+from oidcrp.state_interface import StateInterface
 from oidcrp.util import do_add_ons
-from oidcrp.util import get_deserialization_method
+from oidcrp.util import Sanitized
+from oidcrp.util import content_type
+from oidcrp.util import deserialization_method
+from oidcrp.util import log_response
+from oidcrp.util import response_body
+from oidcrp.util import response_json
 
 __author__ = 'Roland Hedberg'
 
@@ -70,14 +81,22 @@ class Client(object):
 
         _srvs = services or DEFAULT_SERVICES
 
-        self.service = init_services(_srvs, self.service_context, state_db,
-                                     _cam)
+        # Services are instantiated when they are first used
+        self.service = LazyServices(_srvs, self.service_context, state_db, _cam)
 
         if 'add_ons' in config:
             do_add_ons(config['add_ons'], self.service)
 
+        # [(middleware, service names or None), ..] outermost first
+        self.middleware = []
+        for spec in config.get('middleware', []):
+            self.add_middleware(*middleware_from_config(spec))
+
         self.service_context.service = self.service
         self.verify_ssl = verify_ssl
+        self.metrics = NO_METRICS
+        # HTTP status of the latest response, per thread
+        self._http_status = threading.local()
 
     def do_request(self, request_type, response_body_type="", request_args=None,
                    **kwargs):
@@ -89,7 +108,7 @@ class Client(object):
         if not response_body_type:
             response_body_type = _srv.response_body_type
 
-        logger.debug('do_request info: {}'.format(_info))
+        logger.debug('do_request info: %s', _info)
 
         try:
             _state = kwargs['state']
@@ -98,6 +117,25 @@ class Client(object):
         return self.service_request(_srv, response_body_type=response_body_type,
                                     state=_state, **_info)
 
+    def add_middleware(self, middleware, services=None):
+        """
+        Add a middleware, inside the ones already added.
+
+        :param middleware: A :py:class:`oidcrp.middleware.Middleware`
+            instance or some other callable with the same signature.
+        :param services: Names of the services the middleware should be
+            used for, None means all services.
+        """
+        self.middleware.append((middleware, services))
+
+    def service_middleware(self, service_name):
+        """
+        :param service_name: Name of a service
+        :return: The middleware used for a service, outermost first
+        """
+        return [mw for mw, srvs in self.middleware
+                if srvs is None or service_name in srvs]
+
     def set_client_id(self, client_id):
         self.client_id = client_id
         self.service_context.client_id = client_id
@@ -117,9 +155,10 @@ class Client(object):
         try:
             resp = self.http(url, method, data=body, headers=headers)
         except Exception as err:
-            logger.error('Exception on request: {}'.format(err))
+            logger.error('Exception on request: %s', err)
             raise
 
+        self._http_status.code = resp.status_code
         if 300 <= resp.status_code < 400:
             return {'http_response': resp}
 
@@ -156,14 +195,28 @@ class Client(object):
         if headers is None:
             headers = {}
 
-        logger.debug(REQUEST_INFO.format(url, method, body, headers))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(REQUEST_INFO.format(url, method, body, headers))
+
+        _info = {'url': url, 'method': method, 'body': body,
+                 'response_body_type': response_body_type, 'headers': headers}
+        _info.update(kwargs)
 
+        self._http_status.code = None
+        _start = time.perf_counter()
+        _middleware = self.service_middleware(service.service_name)
         try:
-            response = service.get_response_ext(url, method, body, response_body_type, headers,
-                                                **kwargs)
-        except AttributeError:
-            response = self.get_response(service, url, method, body, response_body_type, headers,
-                                         **kwargs)
+            if _middleware:
+                _chain = build_chain(
+                    _middleware, service,
+                    lambda info: self._service_response(service, info))
+                response = _chain(_info)
+            else:
+                response = self._service_response(service, _info)
+        except Exception:
+            self._observe(service, _start, failed=True)
+            raise
+        self._observe(service, _start)
 
         if 'error' in response:
             pass
@@ -176,6 +229,42 @@ class Client(object):
             service.update_service_context(response, **kwargs)
         return response
 
+    def http_status_code(self):
+        """
+        :return: The HTTP status of the latest response this thread got,
+            None if no response arrived.
+        """
+        return getattr(self._http_status, 'code', None)
+
+    def _observe(self, service, start, failed=False):
+        # Only requests sent from here are measured, redirect services
+        # (authorization, end_session) never get this far.
+        _code = self.http_status_code()
+        # The response arrived but could not be parsed or verified
+        _parse_failure = failed and _code is not None and (
+                _code in SUCCESSFUL or 400 <= _code < 500)
+        self.metrics.observe(
+            self.service_context.issuer or '', service.service_name,
+            time.perf_counter() - start, status_class(_code, failed),
+            parse_failure=_parse_failure)
+
+    def _service_response(self, service, info):
+        """
+        Send a request and parse the response, the innermost step of the
+        middleware chain.
+
+        :param service: A :py:class:`oidcservice.service.Service` instance
+        :param info: Request information
+        :return: The parsed response
+        """
+        _kwargs = dict(info)
+        _args = [_kwargs.pop(k) for k in ['url', 'method', 'body',
+                                          'response_body_type', 'headers']]
+        try:
+            return service.get_response_ext(*_args, **_kwargs)
+        except AttributeError:
+            return self.get_response(service, *_args, **_kwargs)
+
     def parse_request_response(self, service, reqresp, response_body_type='',
                                state="", **kwargs):
         """
@@ -199,60 +288,85 @@ class Client(object):
         # if not response_body_type:
         #     response_body_type = self.response_body_type
 
+        if reqresp.status_code in [302, 303]:  # redirect
+            return reqresp
+
         if reqresp.status_code in SUCCESSFUL:
-            logger.debug('response_body_type: "{}"'.format(response_body_type))
-            _deser_method = get_deserialization_method(reqresp)
+            logger.debug('response_body_type: "%s"', response_body_type)
+            _deser_method = deserialization_method(content_type(reqresp))
 
             if _deser_method != response_body_type:
-                logger.warning(
-                    'Not the body type I expected: {} != {}'.format(
-                        _deser_method, response_body_type))
+                logger.warning('Not the body type I expected: %s != %s',
+                               _deser_method, response_body_type)
             if _deser_method in ['json', 'jwt', 'urlencoded']:
                 value_type = _deser_method
             else:
                 value_type = response_body_type
 
-            logger.debug('Successful response: {}'.format(reqresp.text))
+            _info = None
+            if value_type == 'json':
+                # Decoded here, by the JSON codec, straight from the bytes
+                try:
+                    _info = response_json(reqresp)
+                except ValueError:
+                    pass
+                else:
+                    if isinstance(_info, dict):
+                        value_type = 'dict'
+                    else:
+                        _info = None
+
+            # The body as text is only needed if it was not JSON or if it
+            # is to be logged.
+            _body = None
+            if _info is None or logger.isEnabledFor(logging.DEBUG):
+                _body = response_body(reqresp)
+                log_response(reqresp, _body)
+                logger.debug('Successful response: %s', Sanitized(_body))
+            if _info is None:
+                _info = _body
 
             try:
-                return service.parse_response(reqresp.text, value_type,
+                return service.parse_response(_info, value_type,
                                               state, **kwargs)
             except Exception as err:
                 logger.error(err)
                 raise
-        elif reqresp.status_code in [302, 303]:  # redirect
-            return reqresp
         elif reqresp.status_code == 500:
-            logger.error("(%d) %s" % (reqresp.status_code, reqresp.text))
-            raise ParseError("ERROR: Something went wrong: %s" % reqresp.text)
+            _body = response_body(reqresp)
+            logger.error("(%d) %s", reqresp.status_code, _body)
+            raise ParseError("ERROR: Something went wrong: %s" % _body)
         elif 400 <= reqresp.status_code < 500:
-            logger.error('Error response ({}): {}'.format(reqresp.status_code,
-                                                          reqresp.text))
+            _body = response_body(reqresp)
+            logger.error('Error response (%s): %s', reqresp.status_code,
+                         _body)
             # expecting an error response
-            _deser_method = get_deserialization_method(reqresp)
+            log_response(reqresp, _body)
+            _deser_method = deserialization_method(content_type(reqresp))
             if not _deser_method:
                 _deser_method = 'json'
 
             try:
-                err_resp = service.parse_response(reqresp.text, _deser_method)
+                err_resp = service.parse_response(_body, _deser_method)
             except FormatError:
                 if _deser_method != response_body_type:
                     try:
-                        err_resp = service.parse_response(reqresp.text,
+                        err_resp = service.parse_response(_body,
                                                           response_body_type)
                     except (OidcServiceError, FormatError):
                         raise OidcServiceError("HTTP ERROR: %s [%s] on %s" % (
-                            reqresp.text, reqresp.status_code, reqresp.url))
+                            _body, reqresp.status_code, reqresp.url))
                 else:
                     raise OidcServiceError("HTTP ERROR: %s [%s] on %s" % (
-                        reqresp.text, reqresp.status_code, reqresp.url))
+                        _body, reqresp.status_code, reqresp.url))
             except JSONDecodeError: # So it's not JSON assume text then
-                err_resp = {'error': reqresp.text}
+                err_resp = {'error': _body}
 
             err_resp['status_code'] = reqresp.status_code
             return err_resp
         else:
-            logger.error('Error response ({}): {}'.format(reqresp.status_code,
-                                                          reqresp.text))
+            _body = response_body(reqresp)
+            logger.error('Error response (%s): %s', reqresp.status_code,
+                         _body)
             raise OidcServiceError("HTTP ERROR: %s [%s] on %s" % (
-                reqresp.text, reqresp.status_code, reqresp.url))
+                _body, reqresp.status_code, reqresp.url))
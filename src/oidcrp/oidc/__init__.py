@@ -1,6 +1,12 @@
-import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 
+from cryptojwt.jws.jws import factory
+from oidcmsg.message import Message
+from oidcservice import OIDCONF_PATTERN
 from oidcservice.client_auth import BearerHeader
 from oidcservice.oidc import DEFAULT_SERVICES
 
@@ -12,6 +18,9 @@ else:
     _decode_err = JSONDecodeError
 
 from oidcrp import oauth2
+from oidcrp.claims_cache import ClaimsCache
+from oidcrp.key_refresh import RefreshingKeyJar
+from oidcrp.util import response_json
 
 __author__ = 'Roland Hedberg'
 
@@ -60,6 +69,14 @@ class FetchException(Exception):
     pass
 
 
+# What to do when a distributed claims source can not be used
+RAISE = 'raise'
+SKIP = 'skip'
+
+# Claims in an aggregated claims JWT that are about the JWT
+JWT_CLAIMS = ['iss', 'aud', 'exp', 'nbf', 'iat', 'jti']
+
+
 class RP(oauth2.Client):
     def __init__(self, state_db, client_authn_factory=None,
                  keyjar=None, verify_ssl=True, config=None,
@@ -71,57 +88,260 @@ class RP(oauth2.Client):
                                keyjar=keyjar, verify_ssl=verify_ssl, config=config,
                                httplib=httplib, services=_srvs, httpc_params=httpc_params)
 
-    def fetch_distributed_claims(self, userinfo, callback=None):
+        _conf = config.get('distributed_claims', {})
+        # Maximum number of claims sources fetched from at the same time
+        self.claims_workers = _conf.get('workers', 8)
+        # Seconds to wait for a claims source, None means no limit
+        self.claims_timeout = _conf.get('timeout')
+        self.claims_failure_policy = _conf.get('on_failure', RAISE)
+        self._claims_pool = None
+        self._claims_pool_lock = threading.Lock()
+        # Responses from claims sources are cached unless cache_size or
+        # cache_ttl is 0. source_ttl maps endpoints to their own ttl.
+        if _conf.get('cache_size', 1000) and _conf.get('cache_ttl', 300):
+            self.claims_cache = ClaimsCache(
+                max_size=_conf.get('cache_size', 1000),
+                ttl=_conf.get('cache_ttl', 300),
+                source_ttl=_conf.get('source_ttl'))
+        else:
+            self.claims_cache = None
+        # Verified aggregated claims are kept until the JWT expires
+        if _conf.get('cache_size', 1000):
+            self.aggregated_claims_cache = ClaimsCache(
+                max_size=_conf.get('cache_size', 1000),
+                ttl=_conf.get('cache_ttl', 300))
+        else:
+            self.aggregated_claims_cache = None
+
+        # Keys of the issuers of aggregated claims. Where an issuer
+        # publishes its keys is taken from claims_issuers, a dictionary of
+        # issuer ID and JWKS URL. Only those issuers and the OP/AS itself
+        # are trusted, unless discover_issuers is set. Then the keys of any
+        # issuer are found by discovery.
+        self.claims_keyjar = RefreshingKeyJar(verify_ssl=verify_ssl)
+        self.claims_issuers = _conf.get('claims_issuers', {})
+        self.discover_claims_issuers = _conf.get('discover_issuers', False)
+
+    def claims_pool(self):
+        """
+        :return: The thread pool used to fetch distributed claims
+        """
+        with self._claims_pool_lock:
+            if self._claims_pool is None:
+                self._claims_pool = ThreadPoolExecutor(
+                    max_workers=self.claims_workers)
+            return self._claims_pool
+
+    def fetch_claims(self, endpoint, token=None, timeout=None):
+        """
+        Fetch claims from a distributed claims source.
+
+        :param endpoint: The claims source endpoint
+        :param token: Access token, if any
+        :param timeout: Seconds to wait for the response, None for no limit
+        :return: A dictionary with the claims
+        """
+        httpc_params = {}
+        if token:
+            httpc_params = BearerHeader().construct(
+                service=self.service['userinfo'], access_token=token)
+        if timeout is not None:
+            httpc_params['timeout'] = timeout
+
+        _resp = self.http.send(endpoint, 'GET', **httpc_params)
+
+        if _resp.status_code == 200:
+            return response_json(_resp)
+        else:  # There shouldn't be any redirect
+            raise FetchException(
+                'HTTP error {}: {}'.format(_resp.status_code, _resp.reason))
+
+    def claims_issuer_jwks_uri(self, issuer):
+        """
+        Find out where the issuer of aggregated claims publishes its keys.
+        If it is not configured and discovery is allowed OpenID Connect
+        discovery is used, otherwise the issuer is not trusted.
+
+        :param issuer: Issuer ID
+        :return: The JWKS URL
+        """
+        try:
+            return self.claims_issuers[issuer]
+        except KeyError:
+            if not self.discover_claims_issuers:
+                raise FetchException(
+                    'Unknown claims issuer: {}'.format(issuer))
+
+        if issuer.endswith('/'):
+            _url = OIDCONF_PATTERN.format(issuer[:-1])
+        else:
+            _url = OIDCONF_PATTERN.format(issuer)
+
+        _resp = self.http.send(_url, 'GET')
+        if _resp.status_code != 200:
+            raise FetchException(
+                'HTTP error {}: {}'.format(_resp.status_code, _resp.reason))
+
+        _info = response_json(_resp)
+        if _info.get('issuer') != issuer:
+            raise FetchException(
+                'Provider info for {} names another issuer'.format(issuer))
+        try:
+            return _info['jwks_uri']
+        except KeyError:
+            raise FetchException('{} publishes no keys'.format(issuer))
+
+    def claims_issuer_keyjar(self, issuer):
+        """
+        The key jar with the keys of an issuer of aggregated claims. The
+        keys of an issuer that has not been seen before are fetched first.
+
+        :param issuer: Issuer ID
+        :return: A :py:class:`cryptojwt.key_jar.KeyJar` instance
+        """
+        if issuer == self.service_context.issuer:
+            return self.service_context.keyjar
+
+        self.claims_keyjar.load_issuer(issuer, self.claims_issuer_jwks_uri)
+        return self.claims_keyjar
+
+    def verify_aggregated_claims(self, jwt):
+        """
+        Verify a JWT with aggregated claims. Verified claims are remembered
+        until the JWT expires.
+
+        :param jwt: The signed JWT
+        :return: A dictionary with the claims, apart from those about the
+            JWT itself
         """
+        if self.aggregated_claims_cache is not None:
+            _claims = self.aggregated_claims_cache.get('', jwt)
+            if _claims is not None:
+                return _claims
+
+        _jws = factory(jwt)
+        if _jws is None or _jws.jwt.headers.get('alg', 'none') == 'none':
+            raise FetchException('Aggregated claims are not signed')
+
+        _payload = _jws.jwt.payload()
+        try:
+            _iss = _payload['iss']
+        except KeyError:
+            raise FetchException('Aggregated claims without issuer')
+
+        _exp = _payload.get('exp', 0)
+        if _exp and _exp <= time.time() - self.service_context.clock_skew:
+            raise FetchException('Aggregated claims have expired')
+
+        _msg = Message().from_jwt(jwt, keyjar=self.claims_issuer_keyjar(_iss))
+        _claims = dict(
+            (k, v) for k, v in _msg.items() if k not in JWT_CLAIMS)
+
+        if self.aggregated_claims_cache is not None:
+            self.aggregated_claims_cache.set('', jwt, _claims, expires_at=_exp)
+        return _claims
+
+    def fetch_distributed_claims(self, userinfo, callback=None, timeout=None,
+                                 on_failure=None):
+        """
+        Fetch the claims from the distributed claims sources and verify
+        the aggregated claims. If there are more than one distributed
+        claims source they are fetched concurrently. Responses that are
+        cached are used instead of asking again.
 
         :param userinfo: A :py:class:`oidcmsg.message.Message` sub class
             instance
         :param callback: A function that can be used to fetch things
+        :param timeout: Seconds to wait for each claims source, overrides
+            the configured value
+        :param on_failure: What to do if a claims source can not be used.
+            'raise' raises a FetchException, 'skip' leaves its claims out.
+            Overrides the configured value.
         :return: Updated userinfo instance
         """
         try:
             _csrc = userinfo["_claim_sources"]
         except KeyError:
-            pass
-        else:
-            for csrc, spec in _csrc.items():
-                if "endpoint" in spec:
-                    if "access_token" in spec:
-                        cauth = BearerHeader()
-                        httpc_params = cauth.construct(
-                            service=self.service['userinfo'],
-                            access_token=spec['access_token'])
-                        _resp = self.http.send(spec["endpoint"], 'GET',
-                                               **httpc_params)
-                    else:
-                        if callback:
-                            token = callback(spec['endpoint'])
-                            cauth = BearerHeader()
-                            httpc_params = cauth.construct(
-                                service=self.service['userinfo'],
-                                access_token=token)
-                            _resp = self.http.send(
-                                spec["endpoint"], 'GET', **httpc_params)
-                        else:
-                            _resp = self.http.send(spec["endpoint"], 'GET')
-
-                    if _resp.status_code == 200:
-                        _uinfo = json.loads(_resp.text)
-                    else:  # There shouldn't be any redirect
-                        raise FetchException(
-                            'HTTP error {}: {}'.format(_resp.status_code,
-                                                       _resp.reason))
-
-                    claims = [value for value, src in
-                              userinfo["_claim_names"].items() if src == csrc]
-
-                    if set(claims) != set(_uinfo.keys()):
-                        logger.warning(
-                            "Claims from claim source doesn't match what's in "
-                            "the userinfo")
-
-                    # only add those I expected
-                    for key in claims:
-                        userinfo[key] = _uinfo[key]
+            return userinfo
+
+        if timeout is None:
+            timeout = self.claims_timeout
+        on_failure = on_failure or self.claims_failure_policy
+
+        # source -> claims or the exception that prevented getting them
+        _result = {}
+        # (claims source, endpoint, access token)
+        _fetch = []
+        for csrc, spec in _csrc.items():
+            if "JWT" in spec:
+                try:
+                    _result[csrc] = self.verify_aggregated_claims(spec['JWT'])
+                except Exception as err:
+                    _result[csrc] = err
+            elif "endpoint" in spec:
+                if "access_token" in spec:
+                    token = spec['access_token']
+                elif callback:
+                    token = callback(spec['endpoint'])
+                else:
+                    token = None
+                _fetch.append((csrc, spec['endpoint'], token))
+
+        _missing = []
+        for csrc, endpoint, token in _fetch:
+            _claims = None
+            if self.claims_cache is not None:
+                _claims = self.claims_cache.get(endpoint, token)
+            if _claims is None:
+                _missing.append((csrc, endpoint, token))
+            else:
+                _result[csrc] = _claims
+
+        if len(_missing) == 1:
+            csrc, endpoint, token = _missing[0]
+            try:
+                _result[csrc] = self.fetch_claims(endpoint, token, timeout)
+            except Exception as err:
+                _result[csrc] = err
+        elif _missing:
+            _pool = self.claims_pool()
+            _futures = dict(
+                (_pool.submit(self.fetch_claims, endpoint, token, timeout),
+                 csrc) for csrc, endpoint, token in _missing)
+            _done, _not_done = wait(_futures, timeout=timeout)
+            for _future in _done:
+                try:
+                    _result[_futures[_future]] = _future.result()
+                except Exception as err:
+                    _result[_futures[_future]] = err
+            for _future in _not_done:
+                _future.cancel()
+                _result[_futures[_future]] = FetchException(
+                    'Timed out after {} seconds'.format(timeout))
+
+        if self.claims_cache is not None:
+            for csrc, endpoint, token in _missing:
+                if not isinstance(_result[csrc], Exception):
+                    self.claims_cache.set(endpoint, token, _result[csrc])
+
+        for csrc, _uinfo in _result.items():
+            if isinstance(_uinfo, Exception):
+                if on_failure == SKIP:
+                    logger.warning('Could not use claims source %s: %s',
+                                   csrc, _uinfo)
+                    continue
+                raise _uinfo
+
+            claims = [value for value, src in
+                      userinfo["_claim_names"].items() if src == csrc]
+
+            if set(claims) != set(_uinfo.keys()):
+                logger.warning(
+                    "Claims from claim source doesn't match what's in "
+                    "the userinfo")
+
+            # only add those I expected
+            for key in claims:
+                userinfo[key] = _uinfo[key]
 
         return userinfo
@@ -0,0 +1,184 @@
+"""Keeps the provider info of discovered OPs/ASs up to date.
+
+Provider info that was fetched using discovery is fetched again, at regular
+intervals, by a background thread. Until a new version has been fetched and
+verified, clients go on using the one they have. When it arrives only the
+service endpoints that have changed are updated and if the JWKS URI has
+changed the new one is loaded into the key jar.
+
+The keys fetched from the JWKS URI that is no longer used are removed. The
+background thread keeps them for a grace period first, so that tokens the
+OP/AS signed just before the change can still be verified.
+"""
+import logging
+import threading
+import time
+
+from oidcmsg.oauth2 import is_error_message
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+def discovered(client):
+    """
+    Whether the provider info of a client was fetched using discovery, as
+    opposed to being part of the configuration.
+
+    :param client: A Client instance
+    :return: True/False
+    """
+    _sc = client.service_context
+    return bool(_sc.provider_info) and not _sc.config.get('provider_info') \
+        and 'provider_info' in client.service
+
+
+def remove_jwks_uri(keyjar, issuer, jwks_uri):
+    """
+    Remove the keys of an issuer that were fetched from a JWKS URI.
+
+    :param keyjar: A :py:class:`cryptojwt.key_jar.KeyJar` instance
+    :param issuer: Issuer ID
+    :param jwks_uri: The JWKS URI
+    """
+    _bundles = keyjar.issuer_keys.get(issuer, [])
+    _keep = [kb for kb in _bundles if kb.source != jwks_uri]
+    if len(_keep) != len(_bundles):
+        keyjar.issuer_keys[issuer] = _keep
+        logger.info('Removed the keys of %s published at %s', issuer,
+                    jwks_uri)
+
+
+def refresh_provider_info(client, keep_old_keys=False):
+    """
+    Fetch the provider info again and apply what has changed.
+
+    :param client: A Client instance
+    :param keep_old_keys: If the JWKS URI has changed, whether to keep the
+        keys fetched from the old one. If so it is up to the caller to
+        remove them, by using :py:func:`remove_jwks_uri`.
+    :return: The names of the provider info parameters that changed
+    """
+    _sc = client.service_context
+    _srv = client.service['provider_info']
+    _info = _srv.get_request_parameters()
+    resp = client.get_response(_srv, _info['url'], method=_info['method'],
+                               response_body_type='json')
+    if is_error_message(resp) or 'http_response' in resp:
+        raise ValueError('Provider info refresh failed')
+
+    _old = _sc.provider_info
+    if resp.get('issuer') != _old.get('issuer'):
+        raise ValueError('Issuer changed from {} to {}'.format(
+            _old.get('issuer'), resp.get('issuer')))
+
+    changed = [k for k, v in resp.items() if _old.get(k) != v]
+    changed.extend(k for k in _old.keys() if k not in resp)
+    if not changed:
+        return changed
+
+    # Services instantiated from now on will pick up the new endpoints
+    _sc.provider_info = resp
+    for _service in client.service.values():
+        _name = _service.endpoint_name
+        if _name in changed:
+            _service.endpoint = resp.get(_name, '')
+
+    if 'jwks_uri' in changed:
+        if resp.get('jwks_uri'):
+            _sc.keyjar.load_keys(resp['issuer'], jwks_uri=resp['jwks_uri'])
+        if _old.get('jwks_uri') and not keep_old_keys:
+            remove_jwks_uri(_sc.keyjar, resp['issuer'], _old['jwks_uri'])
+
+    logger.info('Provider info for %s changed: %s', resp['issuer'], changed)
+    return changed
+
+
+class ProviderInfoRefresher(object):
+    def __init__(self, client_cache, interval=3600, tick=60, grace=3600):
+        """
+        :param client_cache: A :py:class:`oidcrp.client_cache.ClientCache`
+            instance
+        :param interval: Number of seconds between refreshes of the provider
+            info of a client
+        :param tick: How often, in seconds, the thread looks for clients due
+            for a refresh.
+        :param grace: Number of seconds the keys from a JWKS URI that is no
+            longer used are still trusted.
+        """
+        self.client_cache = client_cache
+        self.interval = interval
+        self.tick = min(tick, interval)
+        self.grace = grace
+        # issuer -> when the provider info was last refreshed
+        self._refreshed = {}
+        # [(remove at, issuer, client, old JWKS URI), ..] earliest first
+        self._retiring = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the background thread if it is not already running.
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def refresh_due(self, now=0):
+        """
+        Refresh the provider info of the live clients that are due for it.
+
+        :param now: Current time in seconds since the epoch
+        """
+        _now = now or time.time()
+        self.remove_retired(_now)
+        for issuer, client in self.client_cache.live_items():
+            if not discovered(client):
+                continue
+
+            _last = self._refreshed.setdefault(issuer, _now)
+            if _now - _last < self.interval:
+                continue
+
+            self._refreshed[issuer] = _now
+            _jwks_uri = client.service_context.provider_info.get('jwks_uri')
+            try:
+                changed = refresh_provider_info(client, keep_old_keys=True)
+            except Exception as err:
+                # Keep using what we have
+                logger.warning('Could not refresh provider info for %s: %s',
+                               issuer, err)
+                continue
+
+            if 'jwks_uri' in changed and _jwks_uri:
+                self._retiring.append(
+                    (_now + self.grace, issuer, client, _jwks_uri))
+
+    def remove_retired(self, now=0):
+        """
+        Remove the keys from old JWKS URIs whose grace period is over.
+
+        :param now: Current time in seconds since the epoch
+        """
+        _now = now or time.time()
+        while self._retiring and self._retiring[0][0] <= _now:
+            _, issuer, client, jwks_uri = self._retiring.pop(0)
+            _sc = client.service_context
+            # Unless the OP/AS has gone back to using it
+            if _sc.provider_info.get('jwks_uri') != jwks_uri:
+                remove_jwks_uri(_sc.keyjar, issuer, jwks_uri)
+
+    def _run(self):
+        while not self._stop.wait(self.tick):
+            try:
+                self.refresh_due()
+            except Exception as err:
+                logger.error('Provider info refresh: %s', err)
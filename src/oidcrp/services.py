@@ -0,0 +1,133 @@
+"""Service instances that are created when they are first used.
+
+A client is configured with many services but a login normally only uses a
+few of them. :py:class:`LazyServices` looks like the dictionary that
+:py:func:`oidcservice.service.init_services` returns but only instantiates
+a service when it is asked for.
+"""
+import copy
+import logging
+import threading
+
+from oidcrp.util import cached_importer
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+def service_class(service_configuration):
+    _cls = service_configuration['class']
+    if isinstance(_cls, str):
+        return cached_importer(_cls)
+    return _cls
+
+
+class LazyServices(object):
+    def __init__(self, service_definitions, service_context, state_db,
+                 client_authn_factory=None):
+        """
+        :param service_definitions: A dictionary containing service
+            definitions
+        :param service_context: A reference to the service context, this is
+            the same for all service instances.
+        :param state_db: A reference to the state database. Shared by all the
+            services.
+        :param client_authn_factory: A list of methods the services can use
+            to authenticate the client to a service.
+        """
+        self.service_context = service_context
+        self.state_db = state_db
+        self.client_authn_factory = client_authn_factory
+        # service name -> service configuration
+        self._conf = {}
+        for service_name, service_configuration in service_definitions.items():
+            _cls = service_class(service_configuration)
+            if not getattr(_cls, 'service_name', None):
+                raise ValueError("Could not load '{}'".format(service_name))
+            self._conf[_cls.service_name] = service_configuration
+        self._live = {}
+        self._lock = threading.Lock()
+
+    def _instantiate(self, name):
+        service_configuration = self._conf[name]
+        kwargs = copy.copy(service_configuration.get('kwargs', {}))
+        kwargs.update({'service_context': self.service_context,
+                       'state_db': self.state_db,
+                       'client_authn_factory': self.client_authn_factory})
+
+        _srv = service_class(service_configuration)(**kwargs)
+
+        for attr, construct in [('post_functions', _srv.post_construct),
+                                ('pre_functions', _srv.pre_construct)]:
+            for meth in service_configuration.get(attr, []):
+                if 'function' in meth:
+                    construct.append(cached_importer(meth['function']))
+
+        # Provider info may have arrived before the service was needed
+        if not _srv.endpoint:
+            try:
+                _srv.endpoint = self.service_context.provider_info[
+                    _srv.endpoint_name]
+            except (KeyError, TypeError):
+                pass
+
+        logger.debug('Instantiated service %s', name)
+        return _srv
+
+    def __getitem__(self, name):
+        try:
+            return self._live[name]
+        except KeyError:
+            pass
+
+        if name not in self._conf:
+            raise KeyError(name)
+
+        with self._lock:
+            if name not in self._live:
+                self._live[name] = self._instantiate(name)
+            return self._live[name]
+
+    def __setitem__(self, name, service):
+        self._live[name] = service
+        self._conf.setdefault(name, {'class': service.__class__})
+
+    def __contains__(self, name):
+        return name in self._conf
+
+    def __iter__(self):
+        return iter(self._conf)
+
+    def __len__(self):
+        return len(self._conf)
+
+    def keys(self):
+        return self._conf.keys()
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def values(self):
+        """
+        The services that have been instantiated. Services that are
+        instantiated later will pick up their endpoint from the provider
+        info so there is no need to touch them when it changes.
+        """
+        return list(self._live.values())
+
+    def items(self):
+        """
+        The services that have been instantiated and their names.
+        """
+        return list(self._live.items())
+
+    def instantiate_all(self):
+        """
+        Create every configured service.
+        """
+        for name in self._conf:
+            self[name]
@@ -0,0 +1,234 @@
+"""The RP's interface to the state database.
+
+Extends :py:class:`oidcservice.state_interface.StateInterface` so that a
+subject or session ID can be bound to more than one state, as happens when a
+user is logged in from several devices, and so that several states can be
+removed in one go.
+
+The list of states bound to a subject or session ID is locked while it is
+updated, so that concurrent logins do not drop each other's state.
+
+Removing states reads, rewrites and deletes many keys. If the state database
+has *get_many*, *set_many* and *delete_many* methods, like memcached's
+get_multi/set_multi/delete_multi or Redis's MGET/MSET/DEL, each of those is
+one call to the database. Otherwise it is one call per key, which is logged
+once as a warning.
+"""
+import json
+import logging
+from contextlib import ExitStack
+
+from oidcservice.state_interface import KEY_PATTERN
+from oidcservice.state_interface import StateInterface as ServiceStateInterface
+
+from oidcrp.state_lock import StateLock
+from oidcrp.util import has_method
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+# Types of values that may be bound to more than one state
+MULTI_STATE = ['session id', 'subject id']
+
+REF_PATTERN = 'ref{}ref'
+
+BATCH_METHODS = ['get_many', 'set_many', 'delete_many']
+
+# Whether it has been logged that the state database has no batch methods
+_warned = False
+
+
+class StateInterface(ServiceStateInterface):
+    def __init__(self, state_db, lock=None):
+        """
+        :param state_db: The state database. May have *get_many*, *set_many*
+            and *delete_many* methods, *get_many* returns a dictionary with
+            the values of the keys that are present.
+        :param lock: A :py:class:`oidcrp.state_lock.StateLock` instance
+            working on the same database. One is created if not given.
+        """
+        ServiceStateInterface.__init__(self, state_db)
+        self.lock = lock or StateLock(state_db)
+        self.batch = all(has_method(state_db, m) for m in BATCH_METHODS)
+        global _warned
+        if not self.batch and not _warned:
+            _warned = True
+            logger.warning(
+                'The state database is missing %s, removing states takes one '
+                'call per key',
+                ', '.join(m for m in BATCH_METHODS
+                          if not has_method(state_db, m)))
+
+    def _get(self, key):
+        try:
+            return self.state_db.get(key)
+        except KeyError:
+            return None
+
+    def _get_many(self, keys):
+        if not keys:
+            return {}
+        if self.batch:
+            return self.state_db.get_many(keys)
+        return {k: self._get(k) for k in keys}
+
+    def _set_many(self, items):
+        if not items:
+            return
+        if self.batch:
+            self.state_db.set_many(items)
+        else:
+            for key, value in items.items():
+                self.state_db.set(key, value)
+
+    def _delete_many(self, keys):
+        if not keys:
+            return
+        if self.batch:
+            self.state_db.delete_many(keys)
+        else:
+            for key in keys:
+                self.state_db.delete(key)
+
+    @staticmethod
+    def _states(value):
+        if not value:
+            return []
+        if value.startswith('['):
+            return json.loads(value)
+        # A single state stored by an earlier version
+        return [value]
+
+    def _get_states(self, key):
+        return self._states(self._get(key))
+
+    def store_x2state(self, value, state, xtyp):
+        """
+        Store the connection between some value (x) and a state value.
+        Subject and session IDs are added to the set of states already bound
+        to the value, all other types replace any earlier binding.
+
+        :param value: The value
+        :param state: The state value
+        :param xtyp: The type of value x is (e.g. nonce, ...)
+        """
+        if xtyp not in MULTI_STATE:
+            return ServiceStateInterface.store_x2state(self, value, state, xtyp)
+
+        _key = KEY_PATTERN[xtyp].format(value)
+        with self.lock.hold(_key):
+            _states = self._get_states(_key)
+            if state not in _states:
+                _states.append(state)
+                self.state_db.set(_key, json.dumps(_states))
+
+        _val = self._get(REF_PATTERN.format(state))
+        if _val is None:
+            refs = {xtyp: value}
+        else:
+            refs = json.loads(_val)
+            refs[xtyp] = value
+        self.state_db.set(REF_PATTERN.format(state), json.dumps(refs))
+
+    def get_states_by_x(self, value, xtyp):
+        """
+        Find all the state values bound to a x value.
+        Will raise an exception if the x value is absent from the state
+        data base.
+
+        :param value: The value
+        :param xtyp: The type of value
+        :return: A list of state values, oldest first
+        """
+        _states = self._get_states(KEY_PATTERN[xtyp].format(value))
+        if _states:
+            return _states
+
+        raise KeyError('Unknown {}: "{}"'.format(xtyp, value))
+
+    def get_state_by_x(self, value, xtyp):
+        """
+        Find the state value by providing the x value. If more than one
+        state is bound to the value the latest is returned.
+        Will raise an exception if the x value is absent from the state
+        data base.
+
+        :param value: The value
+        :param xtyp: The type of value
+        :return: The state value
+        """
+        if xtyp in MULTI_STATE:
+            return self.get_states_by_x(value, xtyp)[-1]
+        return ServiceStateInterface.get_state_by_x(self, value, xtyp)
+
+    def get_states_by_sid(self, sid):
+        """
+        Find all the state values bound to a session ID.
+
+        :param sid: The session ID value
+        :return: A list of state values
+        """
+        return self.get_states_by_x(sid, 'session id')
+
+    def get_states_by_sub(self, sub):
+        """
+        Find all the state values bound to a subject ID.
+
+        :param sub: The Subject ID value
+        :return: A list of state values
+        """
+        return self.get_states_by_x(sub, 'subject id')
+
+    def remove_states(self, states):
+        """
+        Remove a number of states and everything that refers to them.
+        The lists of states bound to subject and session IDs the states
+        appear in are locked while the states are removed, the lists are
+        updated and the states deleted together.
+
+        :param states: A list of keys to states
+        """
+        _ref_keys = [REF_PATTERN.format(state) for state in states]
+        _refs = self._get_many(_ref_keys)
+
+        _delete = list(states)
+        # index key -> states that should no longer be bound to it
+        _updated = {}
+        for state, _ref_key in zip(states, _ref_keys):
+            _val = _refs.get(_ref_key)
+            if not _val:
+                continue
+            _delete.append(_ref_key)
+            for xtyp, value in json.loads(_val).items():
+                _key = KEY_PATTERN[xtyp].format(value)
+                if xtyp in MULTI_STATE:
+                    _updated.setdefault(_key, set()).add(state)
+                else:
+                    _delete.append(_key)
+
+        with ExitStack() as stack:
+            # Always in the same order so that two removals can't deadlock
+            for _key in sorted(_updated):
+                stack.enter_context(self.lock.hold(_key))
+
+            _set = {}
+            _current = self._get_many(list(_updated))
+            for _key, _removed in _updated.items():
+                _states = [s for s in self._states(_current.get(_key))
+                           if s not in _removed]
+                if _states:
+                    _set[_key] = json.dumps(_states)
+                else:
+                    _delete.append(_key)
+
+            self._set_many(_set)
+            self._delete_many(_delete)
+
+    def remove_state(self, state):
+        """
+        Remove a state.
+
+        :param state: Key to the state
+        """
+        self.remove_states([state])
@@ -0,0 +1,179 @@
+"""Locks on session state values.
+
+A lock is held both in-process (one :py:class:`threading.Lock` per key) and
+in the state database, so that several worker processes sharing the same
+state database will not work on the same session at the same time.
+
+Taking a lock in the state database needs an atomic *add*. With a state
+database that has none, locks are only held in-process.
+
+Locks left behind by a process that died are only broken if the state
+database also has an atomic *compare_and_delete*, otherwise they stay until
+the database itself expires them. The same method is used to release a
+lock, without it a lock is only removed while it has not yet reached its
+lifetime, so that it can not be one another process has taken since.
+"""
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from oidcservice import rndstr
+
+from oidcrp.util import has_method
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+LOCK_PATTERN = 'lock{}lock'
+
+# Whether it has been logged that locks are only held in-process
+_warned = False
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class StateLock(object):
+    def __init__(self, state_db, lifetime=30, timeout=60, poll_interval=0.05):
+        """
+        :param state_db: The state database. Locks are only held across
+            processes if it has an *add* method that only sets a value if
+            the key is not already present, like memcached's add or Redis's
+            SETNX. Abandoned locks are only broken if it also has a
+            *compare_and_delete* method that only deletes a key if it has a
+            given value.
+        :param lifetime: Number of seconds after which a lock in the state
+            database is regarded as abandoned. A state database that
+            expires keys should keep them at least this long.
+        :param timeout: Maximum number of seconds to wait for a lock.
+        :param poll_interval: Seconds between attempts to take a lock held by
+            another process.
+        """
+        self.state_db = state_db
+        self.lifetime = lifetime
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._guard = threading.Lock()
+        # key -> [threading.Lock, number of threads using it]
+        self._local = {}
+        # token -> the value stored in the state database
+        self._held = {}
+        self.shared = has_method(state_db, 'add')
+        self.breakable = self.shared and has_method(state_db,
+                                                    'compare_and_delete')
+        global _warned
+        if not self.shared and not _warned:
+            _warned = True
+            logger.warning(
+                'The state database has no add method, locks are only held '
+                'within this process')
+
+    def _local_lock(self, key):
+        with self._guard:
+            try:
+                _entry = self._local[key]
+            except KeyError:
+                _entry = self._local[key] = [threading.Lock(), 0]
+            _entry[1] += 1
+        return _entry[0]
+
+    def _local_release(self, key):
+        with self._guard:
+            _entry = self._local[key]
+            _entry[1] -= 1
+            if _entry[1] == 0:
+                del self._local[key]
+
+    def _db_get(self, key):
+        try:
+            return self.state_db.get(key)
+        except KeyError:
+            return None
+
+    def _db_acquire(self, key, token):
+        _lock_key = LOCK_PATTERN.format(key)
+        _now = time.time()
+        _value = json.dumps({'token': token, 'exp': _now + self.lifetime})
+
+        if self.state_db.add(_lock_key, _value):
+            self._held[token] = _value
+            return True
+
+        if not self.breakable:
+            return False
+
+        _current = self._db_get(_lock_key)
+        if not _current or json.loads(_current)['exp'] > _now:
+            return False
+
+        # Only the one that deletes the abandoned lock may take it
+        if not self.state_db.compare_and_delete(_lock_key, _current):
+            return False
+        logger.warning('Broke abandoned lock on %s', key)
+        if self.state_db.add(_lock_key, _value):
+            self._held[token] = _value
+            return True
+        return False
+
+    def _db_release(self, key, token):
+        _lock_key = LOCK_PATTERN.format(key)
+        _value = self._held.pop(token)
+        if self.breakable:
+            self.state_db.compare_and_delete(_lock_key, _value)
+        elif json.loads(_value)['exp'] > time.time():
+            # Nobody else can have taken the lock before it expires
+            self.state_db.delete(_lock_key)
+
+    def acquire(self, key):
+        """
+        Take the lock on a key. Blocks until the lock is free or the timeout
+        is reached.
+
+        :param key: The key, typically a state value
+        :return: A token that must be handed to :py:meth:`release`
+        """
+        _deadline = time.time() + self.timeout
+        _lock = self._local_lock(key)
+        if not _lock.acquire(timeout=self.timeout):
+            self._local_release(key)
+            raise LockTimeout(key)
+
+        token = rndstr(16)
+        while self.shared and not self._db_acquire(key, token):
+            if time.time() > _deadline:
+                _lock.release()
+                self._local_release(key)
+                raise LockTimeout(key)
+            time.sleep(self.poll_interval)
+        return token
+
+    def release(self, key, token):
+        """
+        Release a lock taken with :py:meth:`acquire`.
+
+        :param key: The key
+        :param token: The token returned by :py:meth:`acquire`
+        """
+        try:
+            if self.shared:
+                self._db_release(key, token)
+        finally:
+            self._local[key][0].release()
+            self._local_release(key)
+
+    @contextmanager
+    def hold(self, key):
+        """
+        Context manager version of acquire/release.
+
+        :param key: The key
+        """
+        token = self.acquire(key)
+        try:
+            yield token
+        finally:
+            self.release(key, token)
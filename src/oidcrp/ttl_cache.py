@@ -0,0 +1,118 @@
+"""A bounded cache with entries that expire.
+
+The RP keeps a number of things in memory for a while: user info,
+responses from claims sources, which OP/AS a domain belongs to and the
+logout tokens it has seen. :py:class:`TTLCache` is what those caches have
+in common. Each entry has a time when it expires, when there are more
+entries than the cache may hold the least recently used are removed. It is
+safe to use from many threads.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    def __init__(self, max_size=1000):
+        """
+        :param max_size: Maximum number of entries. When there are more the
+            least recently used are removed.
+        """
+        self.max_size = max_size
+        # key -> (value, expires at), least recently used first
+        self._db = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """
+        Find an entry. Will raise a KeyError if there is none or it has
+        expired.
+
+        :param key: The key of the entry
+        :return: The value
+        """
+        with self._lock:
+            value, exp = self._db[key]
+            if exp and exp <= time.time():
+                self._remove(key)
+                raise KeyError(key)
+
+            self._db.move_to_end(key)
+            return value
+
+    def store(self, key, value, expires_at=0):
+        """
+        Add or replace an entry.
+
+        :param key: The key of the entry
+        :param value: The value
+        :param expires_at: When the entry expires, 0 if never
+        """
+        with self._lock:
+            self._put(key, value, expires_at)
+
+    def add(self, key, value, expires_at=0):
+        """
+        Add an entry unless there already is one that has not expired.
+
+        :param key: The key of the entry
+        :param value: The value
+        :param expires_at: When the entry expires, 0 if never
+        :return: True if the entry was added otherwise False
+        """
+        with self._lock:
+            try:
+                exp = self._db[key][1]
+            except KeyError:
+                pass
+            else:
+                if not exp or exp > time.time():
+                    return False
+            self._put(key, value, expires_at)
+            return True
+
+    def discard(self, key):
+        """
+        Remove an entry if there is one.
+
+        :param key: The key of the entry
+        """
+        with self._lock:
+            if key in self._db:
+                self._remove(key)
+
+    def _put(self, key, value, expires_at):
+        if key in self._db:
+            self._remove(key)
+        self._db[key] = (value, expires_at)
+
+        while len(self._db) > self.max_size:
+            _old = next(iter(self._db))
+            self._remove(_old)
+            logger.debug('%s evicted %s', self.__class__.__name__, _old)
+
+    def _remove(self, key):
+        self.removed(key, self._db.pop(key)[0])
+
+    def removed(self, key, value):
+        """
+        Called, with the lock held, when an entry is removed or replaced.
+        For subclasses that keep track of the entries in some other way.
+
+        :param key: The key of the entry
+        :param value: The value
+        """
+        pass
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._db):
+                self._remove(key)
+
+    def __len__(self):
+        return len(self._db)
@@ -0,0 +1,94 @@
+"""A cache for the responses from the userinfo endpoint.
+
+As long as the access token is the same the OP/AS is expected to return the
+same user info so there is no need to ask again. Responses are kept under
+the issuer ID and a hash of the access token, never the token itself, until
+the access token expires or the entry has reached its maximum age.
+"""
+import hashlib
+import logging
+import time
+
+from cryptojwt.utils import as_bytes
+
+from oidcrp.ttl_cache import TTLCache
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+def token_hash(access_token):
+    return hashlib.sha256(as_bytes(access_token)).hexdigest()
+
+
+class UserInfoCache(TTLCache):
+    def __init__(self, max_size=1000, max_age=0):
+        """
+        :param max_size: Maximum number of cached responses. When there are
+            more the least recently used are removed.
+        :param max_age: Maximum number of seconds a response is kept, 0 means
+            until the access token expires.
+        """
+        TTLCache.__init__(self, max_size)
+        self.max_age = max_age
+        # The entries are (issuer, token hash) -> (user info, state), this
+        # is state -> (issuer, token hash)
+        self._state2key = {}
+
+    def _expires_at(self, now, token_expires_at):
+        if self.max_age:
+            _exp = now + self.max_age
+            if token_expires_at:
+                return min(_exp, token_expires_at)
+            return _exp
+        return token_expires_at
+
+    def get(self, issuer, access_token):
+        """
+        Find a cached response.
+
+        :param issuer: Issuer ID
+        :param access_token: The access token the user info was fetched with
+        :return: The user info or None if there was none or it has expired
+        """
+        try:
+            return self.lookup((issuer, token_hash(access_token)))[0]
+        except KeyError:
+            return None
+
+    def set(self, issuer, access_token, userinfo, expires_at=0, state=''):
+        """
+        Cache a response.
+
+        :param issuer: Issuer ID
+        :param access_token: The access token the user info was fetched with
+        :param userinfo: The user info
+        :param expires_at: When the access token expires, 0 if never
+        :param state: The session the access token belongs to
+        """
+        _key = (issuer, token_hash(access_token))
+        _exp = self._expires_at(time.time(), expires_at)
+        with self._lock:
+            self._put(_key, (userinfo, state), _exp)
+            if state and _key in self._db:
+                self._state2key[state] = _key
+
+    def removed(self, key, value):
+        _state = value[1]
+        if _state and self._state2key.get(_state) == key:
+            del self._state2key[_state]
+
+    def invalidate(self, state):
+        """
+        Remove what is cached for a session. To be used when the access
+        token is refreshed or the session ends.
+
+        :param state: The state value of the session
+        """
+        with self._lock:
+            try:
+                _key = self._state2key[state]
+            except KeyError:
+                return
+            self._remove(_key)
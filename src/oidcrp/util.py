@@ -1,3 +1,4 @@
+import functools
 import importlib
 import io
 import json
@@ -13,6 +14,8 @@ from oidcservice.exception import TimeFormatError
 from oidcservice.exception import WrongContentType
 from oidcservice.util import importer
 
+from oidcrp import json_codec
+
 logger = logging.getLogger(__name__)
 
 __author__ = 'roland'
@@ -98,8 +101,8 @@ def set_cookie(cookiejar, kaka):
         except TimeFormatError:
             # Ignore cookie
             logger.info(
-                "Time format error on %s parameter in received cookie" % (
-                    sanitize(attr),))
+                "Time format error on %s parameter in received cookie",
+                Sanitized(attr))
             continue
 
         for att, spec in PAIRS.items():
@@ -129,67 +132,192 @@ def set_cookie(cookiejar, kaka):
             cookiejar.set_cookie(new_cookie)
 
 
-def verify_header(reqresp, body_type):
+class Sanitized(object):
+    """
+    Wraps a value that is to be logged. The value is only sanitized and
+    turned into a string if the log record is actually emitted.
+    """
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return '{}'.format(sanitize(self.value))
+
+
+def log_response(reqresp, text=None):
     """
+    Debug log the headers and the body of a HTTP response.
 
     :param reqresp: Class instance with attributes: ['status', 'text',
         'headers', 'url']
-    :param body_type: If information returned in the body part
-    :return: Verified body content type
+    :param text: The body of the response if it has already been decoded
     """
-    logger.debug("resp.headers: %s" % (sanitize(reqresp.headers),))
-    logger.debug("resp.txt: %s" % (sanitize(reqresp.text),))
+    if logger.isEnabledFor(logging.DEBUG):
+        if text is None:
+            text = reqresp.text
+        logger.debug("resp.headers: %s", Sanitized(reqresp.headers))
+        logger.debug("resp.txt: %s", Sanitized(text))
+
+
+# media type -> deserialization method
+DESERIALIZATION_METHODS = {
+    "application/json": "json",
+    "application/jrd+json": "json",
+    "application/jwt": "jwt",
+    "application/jose": "jose",
+    URL_ENCODED: "urlencoded"
+}
+
+# expected body type -> {media type: verified body type}
+VERIFIED_BODY_TYPES = {
+    "": {
+        "application/json": "json",
+        "application/jrd+json": "json",
+        "application/jwt": "jwt",
+        URL_ENCODED: "urlencoded"
+    },
+    "json": {
+        "application/json": "json",
+        "application/jrd+json": "json",
+        "application/jwt": "jwt"
+    },
+    "jwt": {"application/jwt": "jwt"},
+    "urlencoded": {
+        URL_ENCODED: "urlencoded",
+        # I can live with text/plain
+        "text/plain": "urlencoded"
+    },
+    "txt": {"text/plain": "txt", "text/html": "txt"}
+}
+
+
+def content_type(reqresp):
+    """
+    The Content-Type header of a HTTP response.
 
+    :param reqresp: Class instance with a headers attribute
+    :return: The header value or None if there is none
+    """
     try:
         _ctype = reqresp.headers["content-type"]
     except KeyError:
+        return None
+
+    if isinstance(_ctype, str):
+        return _ctype
+    # A list of values, the first one counts
+    return _ctype[0] if _ctype else None
+
+
+@functools.lru_cache(maxsize=128)
+def parse_content_type(ctype):
+    """
+    Split a Content-Type header value into media type and charset.
+    The number of different values seen is small so the result is cached.
+
+    :param ctype: Content-Type header value
+    :return: A (media type, charset) tuple, both in lower case. The charset
+        is an empty string if not given.
+    """
+    _parts = ctype.split(";")
+    _charset = ""
+    for _param in _parts[1:]:
+        _name, _, _value = _param.partition("=")
+        if _name.strip().lower() == "charset":
+            _charset = _value.strip().strip('"').lower()
+    return _parts[0].strip().lower(), _charset
+
+
+def response_body(reqresp):
+    """
+    The body of a HTTP response as text. JSON and JWTs are UTF-8 if nothing
+    else is said, which saves the HTTP library from guessing the encoding.
+
+    :param reqresp: Class instance with attributes: ['status', 'text',
+        'headers', 'url'] and possibly 'content'
+    :return: The body as a string
+    """
+    _content = getattr(reqresp, "content", None)
+    _ctype = content_type(reqresp)
+    if _ctype and isinstance(_content, bytes):
+        _mtype, _charset = parse_content_type(_ctype)
+        if not _charset and _mtype in DESERIALIZATION_METHODS:
+            _charset = "utf-8"
+        if _charset:
+            try:
+                return _content.decode(_charset)
+            except (LookupError, UnicodeDecodeError):
+                pass
+    return reqresp.text
+
+
+def response_json(reqresp):
+    """
+    Decode a HTTP response body that is a JSON document. If possible
+    directly from the raw bytes.
+
+    :param reqresp: Class instance with attributes: ['status', 'text',
+        'headers', 'url'] and possibly 'content'
+    :return: The decoded document
+    """
+    _content = getattr(reqresp, "content", None)
+    if isinstance(_content, bytes):
+        _ctype = content_type(reqresp)
+        _charset = parse_content_type(_ctype)[1] if _ctype else ""
+        if _charset in ["", "utf-8", "utf8"]:
+            return json_codec.loads(_content)
+    return json_codec.loads(response_body(reqresp))
+
+
+def verify_header(reqresp, body_type):
+    """
+
+    :param reqresp: Class instance with attributes: ['status', 'text',
+        'headers', 'url']
+    :param body_type: If information returned in the body part
+    :return: Verified body content type
+    """
+    log_response(reqresp)
+
+    _ctype = content_type(reqresp)
+    if _ctype is None:
         if body_type:
             return body_type
         else:
             return 'txt'  # reasonable default ??
 
-    logger.debug('Expected body type: "{}"'.format(body_type))
+    logger.debug('Expected body type: "%s"', body_type)
 
-    if body_type == "":
-        if match_to_("application/json", _ctype) or match_to_(
-                'application/jrd+json', _ctype):
-            body_type = 'json'
-        elif match_to_("application/jwt", _ctype):
-            body_type = "jwt"
-        elif match_to_(URL_ENCODED, _ctype):
-            body_type = 'urlencoded'
-        else:
-            body_type = 'txt'  # reasonable default ??
-    elif body_type == "json":
-        if match_to_("application/json", _ctype) or match_to_(
-                'application/jrd+json', _ctype):
-            pass
-        elif match_to_("application/jwt", _ctype):
-            body_type = "jwt"
-        else:
-            raise WrongContentType(_ctype)
-    elif body_type == "jwt":
-        if not match_to_("application/jwt", _ctype):
-            raise WrongContentType(_ctype)
-    elif body_type == "urlencoded":
-        if not match_to_(DEFAULT_POST_CONTENT_TYPE, _ctype):
-            # I can live with text/plain
-            if not match_to_("text/plain", _ctype):
-                raise WrongContentType(_ctype)
-    elif body_type == 'txt':
-        if match_to_("text/plain", _ctype):
-            pass
-        elif match_to_("text/html", _ctype):
-            pass
-        else:
-            raise WrongContentType(_ctype)
-    else:
+    try:
+        _verified = VERIFIED_BODY_TYPES[body_type]
+    except KeyError:
         raise ValueError("Unknown return format: %s" % body_type)
 
-    logger.debug('Got body type: "{}"'.format(body_type))
+    try:
+        body_type = _verified[parse_content_type(_ctype)[0]]
+    except KeyError:
+        if body_type:
+            raise WrongContentType(_ctype)
+        body_type = 'txt'  # reasonable default ??
+
+    logger.debug('Got body type: "%s"', body_type)
     return body_type
 
 
+def deserialization_method(ctype):
+    """
+    Map a Content-Type header value to a deserialization method.
+
+    :param ctype: Content-Type header value, None if there was none
+    :return: Deserialization method
+    """
+    if ctype is None:
+        return 'urlencoded'  # reasonable default ??
+    return DESERIALIZATION_METHODS.get(parse_content_type(ctype)[0], '')
+
+
 def get_deserialization_method(reqresp):
     """
 
@@ -197,29 +325,8 @@ def get_deserialization_method(reqresp):
         'headers', 'url']
     :return: Verified body content type
     """
-    logger.debug("resp.headers: %s" % (sanitize(reqresp.headers),))
-    logger.debug("resp.txt: %s" % (sanitize(reqresp.text),))
-
-    try:
-        _ctype = reqresp.headers["content-type"]
-    except KeyError:
-        return 'urlencoded'  # reasonable default ??
-
-    if match_to_("application/json", _ctype) or match_to_(
-            'application/jrd+json', _ctype):
-        deser_method = 'json'
-    elif match_to_("application/jwt", _ctype):
-        deser_method = "jwt"
-    elif match_to_("application/jose", _ctype):
-        deser_method = "jose"
-    elif match_to_(URL_ENCODED, _ctype):
-        deser_method = 'urlencoded'
-    elif match_to_("text/plain", _ctype) or match_to_("test/html", _ctype):
-        deser_method = ''
-    else:
-        deser_method = ''  # reasonable default ??
-
-    return deser_method
+    log_response(reqresp)
+    return deserialization_method(content_type(reqresp))
 
 
 def get_value_type(http_response, body_type):
@@ -250,15 +357,21 @@ def load_configuration(filename):
     return conf
 
 
+@functools.lru_cache(maxsize=None)
+def cached_importer(name):
+    """Import by name, only done once per process for every name"""
+    return importer(name)
+
+
 def do_add_ons(add_ons, services):
     for key, spec in add_ons.items():
-        _func = importer(spec['function'])
+        _func = cached_importer(spec['function'])
         _func(services, **spec['kwargs'])
 
 
 def load_json(file_name):
-    with open(file_name) as fp:
-        js = json.load(fp)
+    with open(file_name, 'rb') as fp:
+        js = json_codec.loads(fp.read())
     return js
 
 
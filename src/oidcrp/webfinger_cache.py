@@ -0,0 +1,74 @@
+"""Remembers which OP/AS the users of a domain belong to.
+
+Looking up the issuer for a user identifier means a webfinger request to
+the host the identifier points to. Users from the same domain normally use
+the same OP/AS so the answer is kept for a while. That a domain has no
+OP/AS is also remembered, for a shorter time, but only when the host said
+so. A request that failed tells nothing about the domain.
+"""
+import logging
+import time
+from urllib.parse import urlsplit
+
+from oidcrp.ttl_cache import TTLCache
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+def resource_domain(resource):
+    """
+    The host a webfinger request for a resource would be sent to.
+
+    :param resource: A user identifier, like an e-mail address, an acct URI
+        or a URL.
+    :return: The host (and port) in lower case
+    """
+    if resource.startswith('acct:'):
+        resource = resource[5:]
+
+    if '://' in resource:
+        return urlsplit(resource).netloc.lower()
+
+    for c in ['/', '?', '#']:
+        resource = resource.split(c)[0]
+
+    return resource.rsplit('@', 1)[-1].lower()
+
+
+class WebFingerCache(TTLCache):
+    def __init__(self, ttl=3600, negative_ttl=300, max_size=10000):
+        """
+        :param ttl: Number of seconds a domain to issuer mapping is kept
+        :param negative_ttl: Number of seconds it is remembered that a domain
+            has no OP/AS
+        :param max_size: Maximum number of domains remembered
+        """
+        TTLCache.__init__(self, max_size)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    def get(self, domain):
+        """
+        Find the issuer for a domain. Will raise a KeyError if the domain
+        is unknown or what was known has expired.
+
+        :param domain: Domain name
+        :return: The issuer ID or None if the domain is known not to have
+            an OP/AS
+        """
+        return self.lookup(domain)
+
+    def set(self, domain, issuer):
+        """
+        Remember which issuer a domain belongs to.
+
+        :param domain: Domain name
+        :param issuer: The issuer ID, None if there is none
+        """
+        _ttl = self.ttl if issuer else self.negative_ttl
+        if not _ttl:
+            return
+
+        self.store(domain, issuer, time.time() + _ttl)
@@ -1,15 +1,25 @@
+import base64
 import datetime
+import string
+import time
 from http.cookies import SimpleCookie
 
 import pytest
 from oidcrp.cookie import make_cookie
 
 from oidcservice.exception import ImproperlyConfigured
+from oidcrp.cookie import FLAG_COMPRESSED
+from oidcrp.cookie import FLAG_ENCRYPTED
 from oidcrp.cookie import CookieDealer
+from oidcrp.cookie import CookieKeys
 from oidcrp.cookie import InvalidCookieSign
+from oidcrp.cookie import cookie_cipher
 from oidcrp.cookie import cookie_parts
 from oidcrp.cookie import cookie_signature
+from oidcrp.cookie import make_kid
 from oidcrp.cookie import parse_cookie
+from oidcrp.cookie import parse_cookie_header
+from oidcrp.cookie import unpack_compact_cookie
 from oidcrp.cookie import verify_cookie_signature
 
 __author__ = 'roland'
@@ -167,3 +177,293 @@ def test_cookie_not_secure():
 def test_cookie_same_site_none():
     kaka = make_cookie('test', "data", b"1234567890abcdefg", same_site="None")
     assert "SameSite=None" in kaka[1]
+
+
+def test_cookie_cipher_cached():
+    _cipher = cookie_cipher(b"0123456789012345", b"1234567890abcdefg")
+    assert cookie_cipher(b"0123456789012345", "1234567890abcdefg") is _cipher
+    assert cookie_cipher(b"0123456789012345", b"") is not _cipher
+
+
+def test_encrypted_cookie_roundtrip():
+    for _ in range(2):
+        kaka = make_cookie('test', "data", b"1234567890abcdefg",
+                           enc_key=b"0123456789012345")
+        assert parse_cookie('test', b"1234567890abcdefg", kaka[1],
+                            b"0123456789012345")[0] == "data"
+
+
+@pytest.mark.parametrize('enc_key', [None, b"0123456789012345"])
+def test_legacy_cookie_with_kid_roundtrip(enc_key):
+    kaka = make_cookie('test', "data", b"1234567890abcdefg", enc_key=enc_key,
+                       timestamp="1600000000", kid="abcdefgh", compact=False)
+    assert cookie_parts('test', kaka[1])[0] == "abcdefgh"
+    assert parse_cookie('test', b"1234567890abcdefg", kaka[1],
+                        enc_key) == ("data", "1600000000")
+
+
+def test_no_cookie_keys():
+    with pytest.raises(ImproperlyConfigured):
+        CookieKeys().current()
+
+
+def test_server_set_later():
+    class DummyServer():
+        def __init__(self):
+            self.symkey = b"0123456789012345"
+            self.cookie_name = "Foobar"
+
+    dealer = CookieDealer(None)
+    dealer.srv = DummyServer()
+    kaka = dealer.create_cookie("value", "sso")
+    assert dealer.get_cookie_value(kaka[1], "Foobar")[0] == "value"
+
+    # The keys of the server, rotated ones are kept as long as it is
+    _kid = dealer.rotate_keys()
+    dealer.srv = dealer.srv
+    assert dealer.keys.current()[0] == _kid
+
+
+class TestCookieKeyRotation(object):
+    @pytest.fixture(autouse=True)
+    def create_dealer(self):
+        class DummyServer():
+            def __init__(self):
+                self.symkey = b"0123456789012345"
+                self.cookie_name = "Foobar"
+
+        self.dealer = CookieDealer(DummyServer(), compact=True)
+
+    def test_kid_in_cookie(self):
+        kaka = self.dealer.create_cookie("value", "sso")
+        _kid = self.dealer.keys.current()[0]
+        assert len(_kid) == 8
+        _value = cookie_parts("Foobar", kaka[1])[0]
+        assert unpack_compact_cookie(_value)[2] == _kid
+
+    def test_kid_in_legacy_cookie(self):
+        self.dealer.compact = False
+        kaka = self.dealer.create_cookie("value", "sso")
+        _kid = self.dealer.keys.current()[0]
+        assert cookie_parts("Foobar", kaka[1])[0] == _kid
+        assert self.dealer.get_cookie_value(kaka[1], "Foobar")[0] == "value"
+
+    def test_same_keys_same_kid(self):
+        assert make_kid(b"seed", b"0123456789012345") == make_kid(
+            b"seed", b"0123456789012345")
+        assert make_kid(b"seed", b"0123456789012345") != make_kid(
+            b"seed", b"0123456789012346")
+
+    def test_rotate(self):
+        old = self.dealer.create_cookie("old", "sso")
+        _old_kid = self.dealer.keys.current()[0]
+        _kid = self.dealer.rotate_keys()
+        assert _kid != _old_kid
+        assert self.dealer.keys.kids() == [_old_kid, _kid]
+        assert self.dealer.srv.symkey != b"0123456789012345"
+
+        new = self.dealer.create_cookie("new", "sso")
+        assert unpack_compact_cookie(
+            cookie_parts("Foobar", new[1])[0])[2] == _kid
+        assert self.dealer.get_cookie_value(old[1], "Foobar")[0] == "old"
+        assert self.dealer.get_cookie_value(new[1], "Foobar")[0] == "new"
+
+        self.dealer.retire_keys(_old_kid)
+        assert self.dealer.get_cookie_value(old[1], "Foobar") is None
+        assert self.dealer.get_cookie_value(new[1], "Foobar")[0] == "new"
+
+    @pytest.mark.parametrize('signed_only', [False, True])
+    def test_retired_legacy_cookie(self, signed_only):
+        class SignServer():
+            def __init__(self):
+                self.seed = b"1234567890abcdefg"
+                self.cookie_name = "Foobar"
+
+        dealer = CookieDealer(SignServer()) if signed_only else self.dealer
+        dealer.compact = False
+        kaka = dealer.create_cookie("value", "sso")
+        _old_kid = dealer.keys.current()[0]
+        dealer.rotate_keys()
+        dealer.retire_keys(_old_kid)
+
+        assert dealer.get_cookie_value(kaka[1], "Foobar") is None
+        header = kaka[1].split(";")[0]
+        assert dealer.get_cookie_values(header, ["Foobar"]) == {}
+
+    @pytest.mark.parametrize('value', [
+        'a|b', 'a|b|c|d', '1600000000|!!|!!|!!', 'a|b|c|d|e|f'])
+    def test_garbled_legacy_cookie(self, value):
+        header = 'Foobar={}'.format(value)
+        assert self.dealer.get_cookie_value(header, "Foobar") is None
+        assert self.dealer.get_cookie_values(header, ["Foobar"]) == {}
+
+    def test_keys_in_use_not_retired(self):
+        with pytest.raises(ValueError):
+            self.dealer.retire_keys(self.dealer.keys.current()[0])
+
+    def test_untagged_cookie(self):
+        _, seed, symkey = self.dealer.keys.current()
+        kaka = make_cookie("Foobar", "value::{}::sso".format(1600000000),
+                           seed, timestamp="1600000000", enc_key=symkey,
+                           compact=False)
+        assert self.dealer.get_cookie_value(kaka[1], "Foobar") == (
+            "value", "1600000000", "sso")
+
+    def test_signed_only(self):
+        class SignServer():
+            def __init__(self):
+                self.seed = b"1234567890abcdefg"
+                self.cookie_name = "Foobar"
+
+        dealer = CookieDealer(SignServer())
+        old = dealer.create_cookie("old", "sso")
+        dealer.rotate_keys(seed=b"abcdefg1234567890")
+        assert dealer.keys.current()[2] is None
+        assert dealer.get_cookie_value(old[1], "Foobar")[0] == "old"
+        new = dealer.create_cookie("new", "sso")
+        assert dealer.get_cookie_value(new[1], "Foobar")[0] == "new"
+
+    def test_tampered(self):
+        self.dealer.compact = False
+        kaka = self.dealer.create_cookie("value", "sso")
+        _parts = cookie_parts("Foobar", kaka[1])
+        _parts[3] = _parts[3][:-4] + ("AAAA" if _parts[3][-4:] != "AAAA"
+                                      else "BBBB")
+        with pytest.raises(InvalidCookieSign):
+            self.dealer.get_cookie_value(
+                'Foobar="{}"'.format("|".join(_parts)), "Foobar")
+
+
+def _flip(value, index):
+    blob = bytearray(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+    blob[index] ^= 1
+    return base64.urlsafe_b64encode(bytes(blob)).rstrip(b'=').decode()
+
+
+class TestCompactCookie(object):
+    seed = b"1234567890abcdefg"
+    enc_key = b"0123456789012345"
+
+    def test_legacy_by_default(self, cookie_dealer):
+        kaka = make_cookie('test', "data", self.seed, enc_key=self.enc_key)
+        assert len(cookie_parts('test', kaka[1])) == 4
+        kaka = cookie_dealer.create_cookie("value", "sso", "test")
+        # with the key identifier
+        assert len(cookie_parts('test', kaka[1])) == 5
+
+    def test_encrypted(self):
+        kaka = make_cookie('test', "data", self.seed, enc_key=self.enc_key,
+                           timestamp="1600000000", kid="k1", compact=True)
+        _value = cookie_parts('test', kaka[1])[0]
+        assert '"' not in kaka[1]
+        assert set(_value) <= set(string.ascii_letters + string.digits + '-_')
+        flags, timestamp, kid, _, _ = unpack_compact_cookie(_value)
+        assert (flags, timestamp, kid) == (FLAG_ENCRYPTED, 1600000000, "k1")
+        assert parse_cookie('test', self.seed, kaka[1], self.enc_key) == (
+            "data", "1600000000")
+
+    def test_signed(self):
+        kaka = make_cookie('test', "data", self.seed, timestamp="1600000000",
+                           compact=True)
+        assert parse_cookie('test', self.seed, kaka[1]) == (
+            "data", "1600000000")
+        with pytest.raises(InvalidCookieSign):
+            parse_cookie('test', b"another seed", kaka[1])
+
+    def test_smaller(self):
+        for enc_key in [None, self.enc_key]:
+            compact = make_cookie('test', "data::sso", self.seed,
+                                  enc_key=enc_key, compact=True)
+            legacy = make_cookie('test', "data::1600000000::sso", self.seed,
+                                 enc_key=enc_key, compact=False)
+            assert len(compact[1]) < len(legacy[1])
+
+    def test_compressed(self):
+        _load = "claims " * 50
+        for enc_key in [None, self.enc_key]:
+            kaka = make_cookie('test', _load, self.seed, enc_key=enc_key,
+                               compact=True, compress=True)
+            plain = make_cookie('test', _load, self.seed, enc_key=enc_key,
+                                compact=True)
+            assert len(kaka[1]) < len(plain[1])
+            _value = cookie_parts('test', kaka[1])[0]
+            assert unpack_compact_cookie(_value)[0] & FLAG_COMPRESSED
+            assert parse_cookie('test', self.seed, kaka[1], enc_key)[0] == _load
+
+    def test_not_compressed_if_larger(self):
+        kaka = make_cookie('test', "x", self.seed, compact=True,
+                           compress=True)
+        _value = cookie_parts('test', kaka[1])[0]
+        assert not unpack_compact_cookie(_value)[0] & FLAG_COMPRESSED
+
+    def test_tampered(self):
+        for enc_key in [None, self.enc_key]:
+            kaka = make_cookie('test', "data", self.seed, enc_key=enc_key,
+                               timestamp="1600000000", compact=True)
+            _value = cookie_parts('test', kaka[1])[0]
+            # timestamp, payload and signature/tag
+            for index in [3, 9, -1]:
+                with pytest.raises(InvalidCookieSign):
+                    parse_cookie('test', self.seed,
+                                 'test={}'.format(_flip(_value, index)),
+                                 enc_key)
+
+    def test_unknown_version(self):
+        kaka = make_cookie('test', "data", self.seed, compact=True)
+        _value = cookie_parts('test', kaka[1])[0]
+        assert parse_cookie('test', self.seed,
+                            'test={}'.format(_flip(_value, 0))) is None
+        assert parse_cookie('test', self.seed, 'test=garbage!') is None
+
+    def test_dealer_compressed(self):
+        class DummyServer():
+            def __init__(self):
+                self.symkey = b"0123456789012345"
+
+        dealer = CookieDealer(DummyServer(), compact=True, compress=True)
+        kaka = dealer.create_cookie("value " * 20, "sso", "Foobar")
+        value, timestamp, typ = dealer.get_cookie_value(kaka[1], "Foobar")
+        assert (value, typ) == ("value " * 20, "sso")
+        assert abs(int(timestamp) - time.time()) < 5
+
+
+@pytest.mark.parametrize("header", [
+    'pyoidc=bjmc::1463043535::upm|1463043535|18a201305fa1',
+    'a=1; b=2;c=3',
+    'a="quoted value"; b="with\\"escape\\073"; c=plain',
+    'a=1; b=',
+    'a=b=c; junk; d="x"',
+    make_cookie('Foobar', "data", b"1234567890abcdefg", compact=False,
+                enc_key=b"0123456789012345", path="/", domain="rp.org")[1],
+])
+def test_parse_cookie_header_as_simple_cookie(header):
+    _simple = SimpleCookie()
+    _simple.load(header)
+    _parsed = parse_cookie_header(header)
+    for name, morsel in _simple.items():
+        assert _parsed[name] == morsel.value
+
+
+def test_parse_cookie_header_names():
+    header = 'a=1; b=2; c=3; d=4'
+    assert parse_cookie_header(header, ['b', 'd', 'x']) == {'b': '2', 'd': '4'}
+    assert parse_cookie_header(header, []) == {}
+    assert parse_cookie_header('', ['a']) == {}
+    assert parse_cookie_header(b'a=1', ['a']) == {'a': '1'}
+    # Browsers send the cookie with the most specific path first
+    assert parse_cookie_header('a=1; a=2', ['a']) == {'a': '1'}
+
+
+def test_get_cookie_values(cookie_dealer):
+    kakas = [cookie_dealer.create_cookie("value_{}".format(n), "sso",
+                                         "cookie_{}".format(n))
+             for n in range(3)]
+    _bad = _flip(cookie_parts("cookie_2", kakas[2][1])[0], -1)
+    header = "; ".join([k[1].split(";")[0] for k in kakas[:2]] +
+                       ["cookie_2={}".format(_bad), "other=x"])
+    res = cookie_dealer.get_cookie_values(
+        header, ["cookie_0", "cookie_1", "cookie_2", "missing"])
+    assert set(res) == {"cookie_0", "cookie_1"}
+    assert res["cookie_0"][0] == "value_0"
+    assert res["cookie_1"][2] == "sso"
+    assert cookie_dealer.get_cookie_values(header, []) == {}
@@ -1,3 +1,5 @@
+import logging
+
 import pytest
 
 from http.cookiejar import FileCookieJar
@@ -175,3 +177,63 @@ def test_verify_no_content_type():
     resp = FakeResponse('text/html')
     del resp.headers['content-type']
     assert util.verify_header(resp, 'txt') == 'txt'
+
+
+def test_sanitized_deferred(monkeypatch):
+    calls = []
+
+    def _sanitize(value):
+        calls.append(value)
+        return value
+
+    monkeypatch.setattr(util, 'sanitize', _sanitize)
+    resp = FakeResponse('application/json')
+
+    util.logger.setLevel(logging.INFO)
+    try:
+        assert get_deserialization_method(resp) == 'json'
+        assert calls == []
+    finally:
+        util.logger.setLevel(logging.NOTSET)
+
+    assert str(util.Sanitized('secret')) == 'secret'
+    assert calls == ['secret']
+
+
+def test_parse_content_type():
+    assert util.parse_content_type('application/json') == (
+        'application/json', '')
+    assert util.parse_content_type(
+        'Application/JSON; Charset="UTF-8"') == ('application/json', 'utf-8')
+    assert util.parse_content_type('text/html;q=0.9;charset=latin-1') == (
+        'text/html', 'latin-1')
+
+
+def test_verify_header_charset():
+    _resp = FakeResponse('Application/Json; charset=utf-8')
+    assert util.verify_header(_resp, 'json') == 'json'
+    assert util.verify_header(FakeResponse('application/jose'), '') == 'txt'
+    with pytest.raises(WrongContentType):
+        util.verify_header(FakeResponse('text/html'), 'jwt')
+
+
+class FakeBytesResponse(FakeResponse):
+    def __init__(self, header, content):
+        FakeResponse.__init__(self, header)
+        self.content = content
+
+
+def test_response_body():
+    _text = '{"name": "Åsa"}'
+    _resp = FakeBytesResponse('application/json', _text.encode('utf-8'))
+    assert util.response_body(_resp) == _text
+
+    _resp = FakeBytesResponse('text/html; charset=iso-8859-1',
+                              _text.encode('iso-8859-1'))
+    assert util.response_body(_resp) == _text
+
+    # Unknown encoding, leave it to the HTTP library
+    _resp = FakeBytesResponse('text/html', _text.encode('utf-8'))
+    assert util.response_body(_resp) == 'TEST_RESPONSE'
+    assert util.response_body(FakeResponse('application/json')) == \
+        'TEST_RESPONSE'
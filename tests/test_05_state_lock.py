@@ -0,0 +1,143 @@
+import json
+import threading
+import time
+
+import pytest
+from oidcservice.state_interface import InMemoryStateDataBase
+
+from oidcrp import state_lock
+from oidcrp.state_lock import LOCK_PATTERN
+from oidcrp.state_lock import LockTimeout
+from oidcrp.state_lock import StateLock
+
+
+class AddDB(InMemoryStateDataBase):
+    def add(self, key, value):
+        if key in self._db:
+            return False
+        self._db[key] = value
+        return True
+
+
+class CASDB(AddDB):
+    def compare_and_delete(self, key, value):
+        if self._db.get(key) != value:
+            return False
+        del self._db[key]
+        return True
+
+
+def test_acquire_release():
+    db = AddDB()
+    lock = StateLock(db)
+    token = lock.acquire('state')
+    assert json.loads(db.get(LOCK_PATTERN.format('state')))['token'] == token
+    lock.release('state', token)
+    assert db.get(LOCK_PATTERN.format('state')) is None
+    assert lock._local == {}
+
+
+def test_hold_with_add():
+    db = AddDB()
+    lock = StateLock(db)
+    with lock.hold('state'):
+        assert db.get(LOCK_PATTERN.format('state'))
+    assert db.get(LOCK_PATTERN.format('state')) is None
+
+
+def test_other_process_holds_lock():
+    db = AddDB()
+    other = StateLock(db)
+    token = other.acquire('state')
+
+    lock = StateLock(db, timeout=0.2, poll_interval=0.01)
+    with pytest.raises(LockTimeout):
+        lock.acquire('state')
+
+    other.release('state', token)
+    with lock.hold('state'):
+        pass
+
+
+def _abandon(db):
+    db.set(LOCK_PATTERN.format('state'),
+           json.dumps({'token': 'old', 'exp': time.time() - 1}))
+
+
+def test_abandoned_lock_is_broken():
+    db = CASDB()
+    _abandon(db)
+    lock = StateLock(db, timeout=0.2)
+    with lock.hold('state') as token:
+        assert token != 'old'
+    assert db.get(LOCK_PATTERN.format('state')) is None
+
+
+def test_abandoned_lock_broken_once():
+    db = CASDB()
+    _abandon(db)
+    _stale = db.get(LOCK_PATTERN.format('state'))
+    first = StateLock(db)
+    second = StateLock(db)
+    assert first._db_acquire('state', 'first')
+
+    # The second process saw the abandoned lock before it was broken
+    second._db_get = lambda key: _stale
+    assert not second._db_acquire('state', 'second')
+    assert json.loads(db.get(LOCK_PATTERN.format('state')))['token'] == 'first'
+
+
+def test_abandoned_lock_kept_without_compare_and_delete():
+    db = AddDB()
+    _abandon(db)
+    lock = StateLock(db, timeout=0.2, poll_interval=0.01)
+    assert not lock.breakable
+    with pytest.raises(LockTimeout):
+        lock.acquire('state')
+
+
+@pytest.mark.parametrize('db_class', [AddDB, CASDB])
+def test_release_leaves_lock_taken_by_other(db_class):
+    db = db_class()
+    lock = StateLock(db, lifetime=0.05)
+    token = lock.acquire('state')
+    time.sleep(0.1)
+    # The lock expired and another process took it
+    _other = json.dumps({'token': 'other', 'exp': time.time() + 30})
+    db.set(LOCK_PATTERN.format('state'), _other)
+    lock.release('state', token)
+    assert db.get(LOCK_PATTERN.format('state')) == _other
+
+
+def test_without_add_only_in_process(caplog, monkeypatch):
+    monkeypatch.setattr(state_lock, '_warned', False)
+    db = InMemoryStateDataBase()
+    lock = StateLock(db)
+    StateLock(db)
+    assert caplog.text.count('only held within this process') == 1
+    assert not lock.shared
+    with lock.hold('state'):
+        assert db.get(LOCK_PATTERN.format('state')) is None
+
+
+def test_threads_are_serialized():
+    lock = StateLock(InMemoryStateDataBase())
+    inside = []
+    overlap = []
+
+    def work():
+        with lock.hold('state'):
+            if inside:
+                overlap.append(True)
+            inside.append(True)
+            time.sleep(0.01)
+            inside.pop()
+
+    threads = [threading.Thread(target=work) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert overlap == []
+    assert lock._local == {}
@@ -0,0 +1,215 @@
+import logging
+import os
+import threading
+import time
+
+import pytest
+from cryptojwt.key_jar import init_key_jar
+from oidcmsg.oidc.session import BACK_CHANNEL_LOGOUT_EVENT
+from oidcmsg.oidc.session import LogoutToken
+from oidcmsg.time_util import utc_time_sans_frac
+from oidcservice import rndstr
+from oidcservice.state_interface import InMemoryStateDataBase
+
+from oidcrp import backchannel_logout
+from oidcrp import backchannel_logout_states
+from oidcrp import state_interface
+from oidcrp.oidc import RP
+from oidcrp.state_interface import StateInterface
+
+ISS = 'https://op.example.org'
+
+KEYDEFS = [{"type": "RSA", "use": ["sig"]}]
+
+_dirname = os.path.dirname(os.path.abspath(__file__))
+
+OP_KEY = init_key_jar(
+    public_path='{}/pub_op_logout.jwks'.format(_dirname),
+    private_path='{}/priv_op_logout.jwks'.format(_dirname),
+    key_defs=KEYDEFS, owner=ISS)
+
+
+class BatchDB(InMemoryStateDataBase):
+    def __init__(self):
+        InMemoryStateDataBase.__init__(self)
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append('get')
+        return InMemoryStateDataBase.get(self, key)
+
+    def set(self, key, value):
+        self.calls.append('set')
+        InMemoryStateDataBase.set(self, key, value)
+
+    def delete(self, key):
+        self.calls.append('delete')
+        InMemoryStateDataBase.delete(self, key)
+
+    def get_many(self, keys):
+        self.calls.append('get_many')
+        return {k: self._db[k] for k in keys if k in self._db}
+
+    def set_many(self, items):
+        self.calls.append('set_many')
+        self._db.update(items)
+
+    def delete_many(self, keys):
+        self.calls.append('delete_many')
+        for key in keys:
+            self._db.pop(key, None)
+
+
+class SlowDB(InMemoryStateDataBase):
+    """Makes concurrent read-modify-writes interleave"""
+
+    def add(self, key, value):
+        if key in self._db:
+            return False
+        self._db[key] = value
+        return True
+
+    def get(self, key):
+        _val = InMemoryStateDataBase.get(self, key)
+        time.sleep(0.01)
+        return _val
+
+
+def test_concurrent_logins_keep_all_states():
+    _db = SlowDB()
+    states = []
+
+    def login():
+        # Every worker has its own interface on the shared database
+        _si = StateInterface(_db)
+        _state = _si.create_state(ISS)
+        _si.store_sub2state('diana', _state)
+        states.append(_state)
+
+    threads = [threading.Thread(target=login) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(StateInterface(_db).get_states_by_sub('diana')) == sorted(
+        states)
+
+
+class TestStateInterface(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.db = BatchDB()
+        self.session_interface = StateInterface(self.db)
+
+    def _login(self, sub, sid=''):
+        _state = self.session_interface.create_state(ISS)
+        self.session_interface.store_nonce2state(rndstr(), _state)
+        self.session_interface.store_sub2state(sub, _state)
+        if sid:
+            self.session_interface.store_sid2state(sid, _state)
+        return _state
+
+    def test_many_states_per_sub(self):
+        s1 = self._login('diana', 'sid1')
+        s2 = self._login('diana', 'sid2')
+        assert self.session_interface.get_states_by_sub('diana') == [s1, s2]
+        assert self.session_interface.get_state_by_sub('diana') == s2
+        assert self.session_interface.get_states_by_sid('sid1') == [s1]
+
+    def test_old_single_state_format(self):
+        self.db.set('==diana==', 'state1')
+        assert self.session_interface.get_states_by_sub('diana') == ['state1']
+        s2 = self._login('diana')
+        assert self.session_interface.get_states_by_sub('diana') == [
+            'state1', s2]
+
+    def test_remove_states(self):
+        s1 = self._login('diana', 'sid1')
+        s2 = self._login('diana', 'sid2')
+        s3 = self._login('diana', 'sid3')
+
+        self.db.calls = []
+        self.session_interface.remove_states([s1, s2])
+        # refs, then sub/sid lists, then the rewrite and all the deletes
+        assert self.db.calls == ['get_many', 'get_many', 'set_many',
+                                 'delete_many']
+        assert self.session_interface.get_states_by_sub('diana') == [s3]
+        with pytest.raises(KeyError):
+            self.session_interface.get_states_by_sid('sid1')
+        with pytest.raises(KeyError):
+            self.session_interface.get_state(s1)
+
+        self.session_interface.remove_state(s3)
+        with pytest.raises(KeyError):
+            self.session_interface.get_states_by_sub('diana')
+        # Nothing left behind
+        assert self.db._db == {}
+
+
+def test_remove_states_without_batch_methods(caplog, monkeypatch):
+    monkeypatch.setattr(state_interface, '_warned', False)
+    _db = InMemoryStateDataBase()
+    with caplog.at_level(logging.WARNING):
+        _si = StateInterface(_db)
+        StateInterface(_db)
+    _warnings = [r for r in caplog.records
+                 if r.name == 'oidcrp.state_interface']
+    assert len(_warnings) == 1
+    assert 'get_many, set_many, delete_many' in _warnings[0].getMessage()
+
+    _states = []
+    for sid in ['sid1', 'sid2']:
+        _state = _si.create_state(ISS)
+        _si.store_sub2state('diana', _state)
+        _si.store_sid2state(sid, _state)
+        _states.append(_state)
+
+    _si.remove_states(_states[:1])
+    assert _si.get_states_by_sub('diana') == _states[1:]
+    _si.remove_states(_states[1:])
+    assert _db._db == {}
+
+
+def _logout_request(**kwargs):
+    _token = LogoutToken(iss=ISS, aud=['client_id'], iat=utc_time_sans_frac(),
+                         jti=rndstr(),
+                         events={BACK_CHANNEL_LOGOUT_EVENT: {}}, **kwargs)
+    _jws = _token.to_jwt(key=OP_KEY.get_signing_key('rsa', owner=ISS),
+                         algorithm='RS256')
+    return 'logout_token={}'.format(_jws)
+
+
+class TestBackChannelLogout(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.client = RP(InMemoryStateDataBase(),
+                         config={'client_id': 'client_id', 'issuer': ISS})
+        self.client.service_context.keyjar.import_jwks(
+            OP_KEY.export_jwks(issuer=ISS), ISS)
+        _si = self.client.session_interface
+        self.states = []
+        for sid in ['sid1', 'sid2']:
+            _state = _si.create_state(ISS)
+            _si.store_sub2state('diana', _state)
+            _si.store_sid2state(sid, _state)
+            self.states.append(_state)
+
+    def test_all_sessions_of_subject(self):
+        _states = backchannel_logout_states(self.client,
+                                            _logout_request(sub='diana'))
+        assert _states == self.states
+
+        self.client.session_interface.remove_states(_states)
+        with pytest.raises(KeyError):
+            self.client.session_interface.get_states_by_sub('diana')
+
+    def test_one_session(self):
+        _states = backchannel_logout_states(self.client,
+                                            _logout_request(sub='diana',
+                                                            sid='sid2'))
+        assert _states == [self.states[1]]
+
+    def test_backchannel_logout_latest_state(self):
+        _state = backchannel_logout(self.client, _logout_request(sub='diana'))
+        assert _state == self.states[1]
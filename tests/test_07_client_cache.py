@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+from oidcrp.client_cache import ClientCache
+
+
+class Client(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def snapshot(issuer, client):
+    return {'name': client.name}
+
+
+def rehydrate(issuer, snapshot):
+    return Client(snapshot['name'])
+
+
+def test_dict_like():
+    cache = ClientCache(snapshot, rehydrate)
+    _client = Client('a')
+    cache['https://a.example.org'] = _client
+    assert cache['https://a.example.org'] is _client
+    assert 'https://a.example.org' in cache
+    assert list(cache.keys()) == ['https://a.example.org']
+    assert cache.get('https://b.example.org') is None
+    with pytest.raises(KeyError):
+        cache['https://b.example.org']
+
+
+def test_lru_eviction():
+    cache = ClientCache(snapshot, rehydrate, max_size=2)
+    for name in ['a', 'b', 'c']:
+        cache[name] = Client(name)
+
+    assert not cache.is_live('a')
+    assert cache.is_live('b') and cache.is_live('c')
+    assert len(cache) == 3
+
+    # rehydrated from the snapshot, evicts b
+    assert cache['a'].name == 'a'
+    assert cache.is_live('a')
+    assert not cache.is_live('b')
+
+
+def test_idle_eviction():
+    cache = ClientCache(snapshot, rehydrate, max_idle=60)
+    cache['a'] = Client('a')
+    cache['b'] = Client('b')
+    cache._live['a'][1] = time.time() - 120
+
+    cache.expire()
+    assert not cache.is_live('a')
+    assert cache.is_live('b')
+    assert cache['a'].name == 'a'
+
+
+def test_no_snapshot():
+    cache = ClientCache(max_size=1)
+    cache['a'] = Client('a')
+    cache['b'] = Client('b')
+    assert 'a' not in cache
+
+
+def test_items_only_live():
+    cache = ClientCache(snapshot, rehydrate, max_size=1)
+    cache['a'] = Client('a')
+    cache['b'] = Client('b')
+    assert [i for i, _ in cache.items()] == ['b']
+    assert [c.name for c in cache.values()] == ['b']
+    assert not cache.is_live('a')
+    assert sorted(cache.keys()) == ['a', 'b']
+
+
+def test_rehydrate_outside_lock():
+    _started = threading.Event()
+    _go = threading.Event()
+    _calls = []
+
+    def slow_rehydrate(issuer, snapshot):
+        _calls.append(issuer)
+        if issuer == 'a':
+            _started.set()
+            _go.wait(5)
+        return Client(snapshot['name'])
+
+    cache = ClientCache(snapshot, slow_rehydrate)
+    for name in ['a', 'b']:
+        cache[name] = Client(name)
+        cache.evict(name)
+
+    _found = []
+    threads = [threading.Thread(target=lambda: _found.append(cache['a']))
+               for _ in range(2)]
+    for t in threads:
+        t.start()
+    assert _started.wait(5)
+
+    # Not held up by a client for another issuer being rehydrated
+    assert cache['b'].name == 'b'
+    assert not cache.is_live('a')
+
+    _go.set()
+    for t in threads:
+        t.join()
+    # Only rehydrated once
+    assert _calls.count('a') == 1
+    assert _found[0] is _found[1]
+    assert not cache._loading
@@ -0,0 +1,73 @@
+import pytest
+from oidcservice.service_context import ServiceContext
+from oidcservice.state_interface import InMemoryStateDataBase
+
+from oidcrp.services import LazyServices
+from oidcrp.util import cached_importer
+from oidcrp.util import do_add_ons
+
+SERVICES = {
+    'authorization': {
+        'class': 'oidcservice.oidc.authorization.Authorization'
+    },
+    'access_token': {
+        'class': 'oidcservice.oidc.access_token.AccessToken',
+        'kwargs': {'conf': {'default_authn_method': ''}}
+    },
+    'userinfo': {
+        'class': 'oidcservice.oidc.userinfo.UserInfo'
+    }
+}
+
+
+class TestLazyServices(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.service_context = ServiceContext(
+            provider_info={
+                'authorization_endpoint': 'https://op.example.org/authz',
+                'token_endpoint': 'https://op.example.org/token'
+            })
+        self.services = LazyServices(SERVICES, self.service_context,
+                                     InMemoryStateDataBase())
+
+    def test_nothing_instantiated(self):
+        assert set(self.services.keys()) == {'authorization', 'accesstoken',
+                                             'userinfo'}
+        assert 'userinfo' in self.services
+        assert self.services.values() == []
+
+    def test_instantiate_on_use(self):
+        _srv = self.services['accesstoken']
+        assert _srv is self.services['accesstoken']
+        assert _srv.endpoint == 'https://op.example.org/token'
+        assert _srv.default_authn_method == ''
+        assert self.services.values() == [_srv]
+        # The service configuration is left untouched
+        assert set(SERVICES['access_token']['kwargs'].keys()) == {'conf'}
+
+    def test_unknown_service(self):
+        with pytest.raises(KeyError):
+            self.services['registration']
+        assert self.services.get('registration') is None
+
+    def test_add_ons(self):
+        add_ons = {
+            "pkce": {
+                "function": "oidcservice.oidc.add_on.pkce.add_pkce_support",
+                "kwargs": {
+                    "code_challenge_length": 64,
+                    "code_challenge_method": "S256"
+                }
+            }
+        }
+        do_add_ons(add_ons, self.services)
+        assert 'pkce' in self.service_context.add_on
+        assert set(dict(self.services.items()).keys()) == {'authorization',
+                                                           'accesstoken'}
+
+
+def test_cached_importer():
+    _func = cached_importer('oidcservice.oidc.add_on.pkce.add_pkce_support')
+    assert _func is cached_importer(
+        'oidcservice.oidc.add_on.pkce.add_pkce_support')
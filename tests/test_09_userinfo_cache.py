@@ -0,0 +1,70 @@
+import time
+
+from oidcrp.userinfo_cache import UserInfoCache
+
+ISSUER = 'https://op.example.org'
+
+
+def test_get_set():
+    cache = UserInfoCache()
+    assert cache.get(ISSUER, 'token') is None
+    cache.set(ISSUER, 'token', {'sub': 'diana'})
+    assert cache.get(ISSUER, 'token') == {'sub': 'diana'}
+    assert cache.get(ISSUER, 'other') is None
+    assert cache.get('https://other.example.org', 'token') is None
+
+
+def test_token_not_kept():
+    cache = UserInfoCache()
+    cache.set(ISSUER, 'token', {'sub': 'diana'})
+    assert ISSUER in list(cache._db.keys())[0]
+    assert 'token' not in list(cache._db.keys())[0]
+
+
+def test_token_expiry():
+    cache = UserInfoCache()
+    cache.set(ISSUER, 'token', {'sub': 'diana'}, expires_at=time.time() - 1)
+    assert cache.get(ISSUER, 'token') is None
+    assert len(cache) == 0
+
+
+def test_max_age():
+    cache = UserInfoCache(max_age=60)
+    cache.set(ISSUER, 'token', {'sub': 'diana'},
+              expires_at=time.time() + 3600)
+    assert cache._db[list(cache._db)[0]][1] <= time.time() + 60
+
+    cache = UserInfoCache(max_age=0.05)
+    cache.set(ISSUER, 'token', {'sub': 'diana'})
+    assert cache.get(ISSUER, 'token') == {'sub': 'diana'}
+    time.sleep(0.1)
+    assert cache.get(ISSUER, 'token') is None
+
+
+def test_evicted_state_forgotten():
+    cache = UserInfoCache(max_size=2)
+    cache.set(ISSUER, 'a', {'sub': 'a'}, state='A')
+    cache.set(ISSUER, 'b', {'sub': 'b'}, state='B')
+    cache.get(ISSUER, 'a')
+    cache.set(ISSUER, 'c', {'sub': 'c'}, state='C')
+
+    assert cache.get(ISSUER, 'b') is None
+    assert cache.get(ISSUER, 'a') == {'sub': 'a'}
+    assert 'B' not in cache._state2key
+
+
+def test_invalidate():
+    cache = UserInfoCache()
+    cache.set(ISSUER, 'token', {'sub': 'diana'}, state='state')
+    cache.invalidate('state')
+    assert cache.get(ISSUER, 'token') is None
+    cache.invalidate('unknown')
+
+
+def test_new_token_for_state():
+    cache = UserInfoCache()
+    cache.set(ISSUER, 'a', {'sub': 'diana'}, state='state')
+    cache.set(ISSUER, 'b', {'sub': 'diana'}, state='state')
+    cache.invalidate('state')
+    assert cache.get(ISSUER, 'b') is None
+    assert cache.get(ISSUER, 'a') == {'sub': 'diana'}
@@ -0,0 +1,100 @@
+import os
+import queue
+
+import pytest
+from cryptojwt.key_jar import init_key_jar
+from oidcmsg.oidc.session import BACK_CHANNEL_LOGOUT_EVENT
+from oidcmsg.oidc.session import LogoutToken
+from oidcmsg.time_util import utc_time_sans_frac
+from oidcservice import rndstr
+from oidcservice.state_interface import InMemoryStateDataBase
+
+from oidcrp.logout_queue import BackChannelLogoutQueue
+from oidcrp.logout_queue import ReplayCache
+from oidcrp.oidc import RP
+
+ISS = 'https://op.example.org'
+
+KEYDEFS = [{"type": "RSA", "use": ["sig"]}]
+
+_dirname = os.path.dirname(os.path.abspath(__file__))
+
+OP_KEY = init_key_jar(
+    public_path='{}/pub_op_logout.jwks'.format(_dirname),
+    private_path='{}/priv_op_logout.jwks'.format(_dirname),
+    key_defs=KEYDEFS, owner=ISS)
+
+
+def _logout_request(jti='', **kwargs):
+    _token = LogoutToken(iss=ISS, aud=['client_id'], iat=utc_time_sans_frac(),
+                         jti=jti or rndstr(),
+                         events={BACK_CHANNEL_LOGOUT_EVENT: {}}, **kwargs)
+    _jws = _token.to_jwt(key=OP_KEY.get_signing_key('rsa', owner=ISS),
+                         algorithm='RS256')
+    return 'logout_token={}'.format(_jws)
+
+
+def test_replay_cache():
+    cache = ReplayCache(max_size=2)
+    assert not cache.seen(ISS, 'a')
+    assert cache.seen(ISS, 'a')
+    assert not cache.seen('https://other.example.org', 'a')
+    assert not cache.seen(ISS, 'b')
+    # 'a' from ISS is forgotten
+    assert len(cache) == 2
+    assert not cache.seen(ISS, 'a')
+
+
+class TestBackChannelLogoutQueue(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.client = RP(InMemoryStateDataBase(),
+                         config={'client_id': 'client_id', 'issuer': ISS})
+        self.client.service_context.keyjar.import_jwks(
+            OP_KEY.export_jwks(issuer=ISS), ISS)
+        _si = self.client.session_interface
+        self.states = {}
+        for sub in ['diana', 'eric', 'fiona']:
+            _state = _si.create_state(ISS)
+            _si.store_sub2state(sub, _state)
+            self.states[sub] = _state
+
+        self.batches = []
+        self.queue = BackChannelLogoutQueue(self.remove_states, workers=2,
+                                            batch_interval=0.2)
+
+    def remove_states(self, states):
+        self.batches.append(states)
+        self.client.session_interface.remove_states(states)
+
+    def test_logout(self):
+        for sub in ['diana', 'eric']:
+            self.queue.submit(self.client, _logout_request(sub=sub))
+        self.queue.join()
+
+        assert len(self.batches) == 1
+        assert set(self.batches[0]) == {self.states['diana'],
+                                        self.states['eric']}
+        with pytest.raises(KeyError):
+            self.client.session_interface.get_state(self.states['diana'])
+        assert self.client.session_interface.get_state(self.states['fiona'])
+
+    def test_replay(self):
+        _request = _logout_request(sub='diana', jti='abcdef')
+        self.queue.submit(self.client, _request)
+        self.queue.join()
+        self.queue.submit(self.client, _request)
+        self.queue.join()
+        assert len(self.batches) == 1
+
+    def test_bogus_request(self):
+        self.queue.submit(self.client, 'logout_token=bogus')
+        self.queue.join()
+        assert self.batches == []
+
+    def test_full(self):
+        _queue = BackChannelLogoutQueue(self.remove_states, workers=0,
+                                        max_queue=1)
+        _queue.submit(self.client, _logout_request(sub='diana'))
+        with pytest.raises(queue.Full):
+            _queue.submit(self.client, _logout_request(sub='eric'))
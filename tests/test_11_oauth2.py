@@ -1,3 +1,4 @@
+import logging
 import os
 import pytest
 import sys
@@ -19,6 +20,7 @@ from oidcmsg.time_util import utc_time_sans_frac
 from oidcservice.exception import OidcServiceError
 from oidcservice.exception import ParseError
 
+from oidcrp import oauth2
 from oidcrp.oauth2 import Client
 
 sys.path.insert(0, '.')
@@ -158,6 +160,31 @@ class TestClient(object):
             self.client.parse_request_response(
                 self.client.service['authorization'], http_resp)
 
+    def test_json_response_decoded_once(self, monkeypatch, caplog):
+        _decoded = []
+
+        def response_body(reqresp):
+            _decoded.append(reqresp)
+            return reqresp.text
+
+        monkeypatch.setattr(oauth2, 'response_body', response_body)
+        _info = AccessTokenResponse(access_token='access', token_type='Bearer')
+        http_resp = MockResponse(200, _info.to_json(),
+                                 {'content-type': 'application/json'})
+        http_resp.content = http_resp.text.encode('utf-8')
+
+        caplog.set_level(logging.INFO, logger='oidcrp')
+        resp = self.client.parse_request_response(
+            self.client.service['accesstoken'], http_resp, 'json')
+        assert resp['access_token'] == 'access'
+        assert _decoded == []
+
+        # The text is needed when the body is logged
+        caplog.set_level(logging.DEBUG, logger='oidcrp')
+        self.client.parse_request_response(
+            self.client.service['accesstoken'], http_resp, 'json')
+        assert _decoded == [http_resp]
+
     def test_error_response_2(self):
         err = ResponseMessage(error='Illegal')
         http_resp = MockResponse(
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from oidcrp.webfinger_cache import WebFingerCache
+from oidcrp.webfinger_cache import resource_domain
+
+
+@pytest.mark.parametrize('resource, domain', [
+    ('acct:joe@example.com', 'example.com'),
+    ('joe@Example.com', 'example.com'),
+    ('https://example.com/joe', 'example.com'),
+    ('example.com:8080', 'example.com:8080'),
+    ('example.com/joe', 'example.com'),
+    ('acct:joe@example.com/path', 'example.com')
+])
+def test_resource_domain(resource, domain):
+    assert resource_domain(resource) == domain
+
+
+def test_get_set():
+    cache = WebFingerCache()
+    with pytest.raises(KeyError):
+        cache.get('example.com')
+    cache.set('example.com', 'https://op.example.com')
+    assert cache.get('example.com') == 'https://op.example.com'
+
+
+def test_negative():
+    cache = WebFingerCache(negative_ttl=60)
+    cache.set('example.com', None)
+    assert cache.get('example.com') is None
+
+    cache = WebFingerCache(negative_ttl=0)
+    cache.set('example.com', None)
+    with pytest.raises(KeyError):
+        cache.get('example.com')
+
+
+def test_expired():
+    cache = WebFingerCache(ttl=60)
+    cache.set('example.com', 'https://op.example.com')
+    cache._db['example.com'] = ('https://op.example.com', time.time() - 1)
+    with pytest.raises(KeyError):
+        cache.get('example.com')
+    assert len(cache) == 0
+
+
+def test_negative_expires_first():
+    cache = WebFingerCache(ttl=60, negative_ttl=5)
+    cache.set('a.example.com', None)
+    cache.set('b.example.com', 'https://op.example.com')
+    assert cache._db['a.example.com'][1] <= time.time() + 5
+    assert cache._db['b.example.com'][1] > time.time() + 55
+
+
+def test_max_size():
+    cache = WebFingerCache(max_size=2)
+    for domain in ['a.example.com', 'b.example.com', 'c.example.com']:
+        cache.set(domain, 'https://op.example.com')
+    assert len(cache) == 2
+    with pytest.raises(KeyError):
+        cache.get('a.example.com')
@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+from oidcservice.state_interface import InMemoryStateDataBase
+
+from oidcrp.issuer_registry import IssuerRegistry
+from oidcrp.state_lock import LockTimeout
+from oidcrp.state_lock import StateLock
+
+ISSUER = 'https://op.example.org'
+
+
+def test_get_set():
+    registry = IssuerRegistry(InMemoryStateDataBase())
+    assert registry.get(ISSUER) is None
+    registry.set(ISSUER, {'issuer': ISSUER, 'client_id': 'client'})
+    assert registry.get(ISSUER) == {'issuer': ISSUER, 'client_id': 'client'}
+    registry.delete(ISSUER)
+    assert registry.get(ISSUER) is None
+
+
+def test_shared_db():
+    _db = InMemoryStateDataBase()
+    IssuerRegistry(_db).set(ISSUER, {'issuer': ISSUER})
+    IssuerRegistry(_db).set_callback_issuer('abcdef', ISSUER)
+
+    registry = IssuerRegistry(_db)
+    assert registry.get(ISSUER) == {'issuer': ISSUER}
+    assert registry.get_callback_issuer('abcdef') == ISSUER
+    assert registry.get_callback_issuer('012345') is None
+
+
+def test_one_at_the_time():
+    registry = IssuerRegistry(InMemoryStateDataBase())
+    registrations = []
+
+    def setup():
+        with registry.hold(ISSUER):
+            if registry.get(ISSUER) is None:
+                registrations.append(1)
+                registry.set(ISSUER, {'issuer': ISSUER})
+
+    threads = [threading.Thread(target=setup) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(registrations) == 1
+
+
+class AddDB(InMemoryStateDataBase):
+    def add(self, key, value):
+        if key in self._db:
+            return False
+        self._db[key] = value
+        return True
+
+
+def test_held_across_processes():
+    _db = AddDB()
+    worker = IssuerRegistry(_db)
+    other = IssuerRegistry(_db, lock=StateLock(_db, timeout=0.1,
+                                               poll_interval=0.01))
+    with worker.hold(ISSUER):
+        with pytest.raises(LockTimeout):
+            with other.hold(ISSUER):
+                pass
+    with other.hold(ISSUER):
+        pass
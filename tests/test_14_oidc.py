@@ -4,7 +4,9 @@ import sys
 import time
 
 import pytest
+from cryptojwt.jwk.ec import new_ec_key
 from cryptojwt.jwk.rsa import import_private_rsa_key_from_file
+from cryptojwt.jws.jws import JWS
 from cryptojwt.key_bundle import KeyBundle
 from oidcmsg.oauth2 import AccessTokenRequest
 from oidcmsg.oauth2 import AccessTokenResponse
@@ -15,6 +17,7 @@ from oidcmsg.oidc import IdToken
 from oidcmsg.oidc import OpenIDSchema
 from oidcmsg.time_util import utc_time_sans_frac
 
+from oidcrp.oidc import FetchException
 from oidcrp.oidc import RP
 
 sys.path.insert(0, '.')
@@ -37,6 +40,81 @@ def access_token_callback(endpoint):
         return 'access_token'
 
 
+class MockResponse():
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {'content-type': 'application/json'}
+        self.reason = ''
+        self.url = ''
+
+
+class SlowClaimsSources(object):
+    """Claims sources that take some time to answer"""
+
+    def __init__(self, sources):
+        # endpoint -> (delay, status code, claims)
+        self.sources = sources
+        self.calls = []
+
+    def send(self, url, method="GET", **kwargs):
+        self.calls.append((url, kwargs))
+        _delay, _status, _claims = self.sources[url]
+        time.sleep(_delay)
+        return MockResponse(_status, json.dumps(_claims))
+
+
+def distributed_userinfo(sources):
+    return OpenIDSchema(**{
+        "sub": 'jane_doe',
+        "_claim_names": dict(
+            ('claim_{}'.format(src), src) for src in sources),
+        "_claim_sources": dict(
+            (src, {'endpoint': 'https://{}.example.org'.format(src),
+                   'access_token': 'token_{}'.format(src)})
+            for src in sources)
+    })
+
+
+class ClaimsIssuer(object):
+    """An issuer of aggregated claims, publishing its keys"""
+
+    def __init__(self, issuer='https://claims.example.org'):
+        self.issuer = issuer
+        self.key = new_ec_key('P-256', kid='c1')
+        self.jwks_calls = 0
+        self.discovery_calls = 0
+
+    def jwt(self, claims, lifetime=3600, alg='ES256'):
+        _payload = dict(claims, iss=self.issuer)
+        if lifetime:
+            _payload['exp'] = int(time.time()) + lifetime
+        _jws = JWS(json.dumps(_payload), alg=alg)
+        return _jws.sign_compact([self.key])
+
+    # Used as the key jar's HTTP client
+    def __call__(self, method, url, **kwargs):
+        self.jwks_calls += 1
+        return MockResponse(200, json.dumps({'keys': [self.key.serialize()]}))
+
+    # Used as the RP's HTTP client
+    def send(self, url, method="GET", **kwargs):
+        self.discovery_calls += 1
+        assert url == '{}/.well-known/openid-configuration'.format(
+            self.issuer)
+        return MockResponse(200, json.dumps({
+            'issuer': self.issuer,
+            'jwks_uri': '{}/jwks.json'.format(self.issuer)}))
+
+
+def aggregated_userinfo(jwt):
+    return OpenIDSchema(**{
+        "sub": 'jane_doe',
+        "_claim_names": {"credit_score": "src1"},
+        "_claim_sources": {"src1": {"JWT": jwt}}
+    })
+
+
 class DB(object):
     def __init__(self):
         self.db = {}
@@ -259,3 +337,175 @@ class TestClient(object):
             uinfo, callback=access_token_callback)
 
         assert 'credit_score' in res
+
+    def test_fetch_distributed_claims_concurrently(self):
+        self.client.http = SlowClaimsSources(dict(
+            ('https://{}.example.org'.format(src),
+             (0.2, 200, {'claim_{}'.format(src): src}))
+            for src in ['a', 'b', 'c', 'd']))
+
+        _start = time.time()
+        res = self.client.fetch_distributed_claims(
+            distributed_userinfo(['a', 'b', 'c', 'd']))
+        assert time.time() - _start < 0.6
+        for src in ['a', 'b', 'c', 'd']:
+            assert res['claim_{}'.format(src)] == src
+        assert len(self.client.http.calls) == 4
+        _headers = dict(self.client.http.calls)['https://a.example.org']
+        assert _headers['headers'] == {'Authorization': 'Bearer token_a'}
+
+    def test_fetch_distributed_claims_timeout(self):
+        self.client.http = SlowClaimsSources({
+            'https://a.example.org': (0, 200, {'claim_a': 'a'}),
+            'https://b.example.org': (1, 200, {'claim_b': 'b'})
+        })
+        self.client.claims_cache = None
+        _uinfo = distributed_userinfo(['a', 'b'])
+        with pytest.raises(FetchException):
+            self.client.fetch_distributed_claims(_uinfo, timeout=0.2)
+
+        res = self.client.fetch_distributed_claims(
+            distributed_userinfo(['a', 'b']), timeout=0.2, on_failure='skip')
+        assert res['claim_a'] == 'a'
+        assert 'claim_b' not in res
+        assert self.client.http.calls[0][1]['timeout'] == 0.2
+
+    def test_fetch_distributed_claims_partial_failure(self):
+        self.client.http = SlowClaimsSources({
+            'https://a.example.org': (0, 200, {'claim_a': 'a'}),
+            'https://b.example.org': (0, 500, {})
+        })
+        with pytest.raises(FetchException):
+            self.client.fetch_distributed_claims(
+                distributed_userinfo(['a', 'b']))
+
+        self.client.claims_failure_policy = 'skip'
+        res = self.client.fetch_distributed_claims(
+            distributed_userinfo(['a', 'b']))
+        assert res['claim_a'] == 'a'
+        assert 'claim_b' not in res
+
+    def test_fetch_distributed_claims_cached(self):
+        self.client.http = SlowClaimsSources({
+            'https://a.example.org': (0, 200, {'claim_a': 'a'}),
+            'https://b.example.org': (0, 500, {})
+        })
+        self.client.claims_failure_policy = 'skip'
+        for _ in range(3):
+            res = self.client.fetch_distributed_claims(
+                distributed_userinfo(['a', 'b']))
+            assert res['claim_a'] == 'a'
+        # Failures are not cached
+        _urls = [url for url, _ in self.client.http.calls]
+        assert _urls.count('https://a.example.org') == 1
+        assert _urls.count('https://b.example.org') == 3
+
+    def test_fetch_distributed_claims_not_cached(self):
+        conf = {
+            'client_id': 'client_1',
+            'client_secret': 'abcdefghijklmnop',
+            'distributed_claims': {'cache_ttl': 0}
+        }
+        client = RP(DB(), config=conf)
+        assert client.claims_cache is None
+        client.http = SlowClaimsSources({
+            'https://a.example.org': (0, 200, {'claim_a': 'a'})
+        })
+        for _ in range(2):
+            client.fetch_distributed_claims(distributed_userinfo(['a']))
+        assert len(client.http.calls) == 2
+
+
+class TestAggregatedClaims(object):
+    @pytest.fixture(autouse=True)
+    def create_client(self):
+        conf = {
+            'client_id': 'client_1',
+            'client_secret': 'abcdefghijklmnop',
+            'distributed_claims': {'discover_issuers': True}
+        }
+        self.client = RP(DB(), config=conf)
+        self.issuer = ClaimsIssuer()
+        self.client.http = self.issuer
+        self.client.claims_keyjar.httpc = self.issuer
+
+    def test_verified(self):
+        _jwt = self.issuer.jwt({'credit_score': 650})
+        res = self.client.fetch_distributed_claims(aggregated_userinfo(_jwt))
+        assert res['credit_score'] == 650
+        assert 'iss' not in res
+        assert self.issuer.discovery_calls == 1
+        assert self.issuer.jwks_calls == 1
+
+    def test_memoized(self):
+        _jwt = self.issuer.jwt({'credit_score': 650})
+        _calls = []
+        _keyjar = self.client.claims_issuer_keyjar
+
+        def keyjar(issuer):
+            _calls.append(issuer)
+            return _keyjar(issuer)
+
+        self.client.claims_issuer_keyjar = keyjar
+        for _ in range(3):
+            res = self.client.fetch_distributed_claims(
+                aggregated_userinfo(_jwt))
+            assert res['credit_score'] == 650
+        assert _calls == [self.issuer.issuer]
+
+        # Another JWT from the same issuer, keys are not fetched again
+        _jwt = self.issuer.jwt({'credit_score': 700}, lifetime=60)
+        res = self.client.fetch_distributed_claims(aggregated_userinfo(_jwt))
+        assert res['credit_score'] == 700
+        assert self.issuer.discovery_calls == 1
+        assert self.issuer.jwks_calls == 1
+
+    def test_kept_for_jwt_lifetime(self):
+        _jwt = self.issuer.jwt({'credit_score': 650}, lifetime=60)
+        self.client.verify_aggregated_claims(_jwt)
+        _exp = list(self.client.aggregated_claims_cache._db.values())[0][1]
+        assert time.time() + 55 < _exp <= time.time() + 60
+
+    def test_expired(self):
+        _jwt = self.issuer.jwt({'credit_score': 650}, lifetime=-3600)
+        with pytest.raises(FetchException):
+            self.client.fetch_distributed_claims(aggregated_userinfo(_jwt))
+
+    def test_unsigned(self):
+        _jwt = self.issuer.jwt({'credit_score': 650}, alg='none')
+        with pytest.raises(FetchException):
+            self.client.fetch_distributed_claims(aggregated_userinfo(_jwt))
+        res = self.client.fetch_distributed_claims(
+            aggregated_userinfo(_jwt), on_failure='skip')
+        assert 'credit_score' not in res
+
+    def test_wrong_key(self):
+        _jwt = ClaimsIssuer().jwt({'credit_score': 650})
+        with pytest.raises(Exception):
+            self.client.fetch_distributed_claims(aggregated_userinfo(_jwt))
+        assert len(self.client.aggregated_claims_cache) == 0
+
+    def test_no_discovery_by_default(self):
+        client = RP(DB(), config={'client_id': 'client_1',
+                                  'client_secret': 'abcdefghijklmnop'})
+        client.http = self.issuer
+        client.claims_keyjar.httpc = self.issuer
+        _jwt = self.issuer.jwt({'credit_score': 650})
+        with pytest.raises(FetchException):
+            client.fetch_distributed_claims(aggregated_userinfo(_jwt))
+        assert self.issuer.discovery_calls == 0
+        assert self.issuer.jwks_calls == 0
+
+    def test_configured_issuer(self):
+        self.client.claims_issuers = {
+            self.issuer.issuer: '{}/jwks.json'.format(self.issuer.issuer)}
+        self.client.discover_claims_issuers = False
+        _jwt = self.issuer.jwt({'credit_score': 650})
+        res = self.client.fetch_distributed_claims(aggregated_userinfo(_jwt))
+        assert res['credit_score'] == 650
+        assert self.issuer.discovery_calls == 0
+
+        _other = ClaimsIssuer('https://other.example.org')
+        with pytest.raises(FetchException):
+            self.client.fetch_distributed_claims(
+                aggregated_userinfo(_other.jwt({'credit_score': 1})))
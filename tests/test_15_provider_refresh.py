@@ -0,0 +1,203 @@
+import json
+
+import pytest
+from cryptojwt.jwk.rsa import new_rsa_key
+from cryptojwt.jws.jws import JWS
+from cryptojwt.jws.jws import factory
+from cryptojwt.key_jar import KeyJar
+from oidcservice.state_interface import InMemoryStateDataBase
+
+from oidcrp.client_cache import ClientCache
+from oidcrp.oidc import RP
+from oidcrp.provider_refresh import ProviderInfoRefresher
+from oidcrp.provider_refresh import discovered
+from oidcrp.provider_refresh import refresh_provider_info
+from oidcrp.provider_refresh import remove_jwks_uri
+
+ISS = 'https://op.example.org'
+
+PROVIDER_INFO = {
+    'issuer': ISS,
+    'authorization_endpoint': '{}/authorization'.format(ISS),
+    'token_endpoint': '{}/token'.format(ISS),
+    'userinfo_endpoint': '{}/userinfo'.format(ISS),
+    'jwks_uri': '{}/jwks.json'.format(ISS),
+    'response_types_supported': ['code'],
+    'subject_types_supported': ['public'],
+    'id_token_signing_alg_values_supported': ['RS256']
+}
+
+
+class MockResponse():
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        self.url = ''
+
+
+class MockOP(object):
+    def __init__(self, provider_info, jwks=None):
+        self.provider_info = provider_info
+        # JWKS URI -> keys published there
+        self.jwks = jwks or {}
+        self.calls = 0
+
+    def __call__(self, url, method="GET", data=None, headers=None, **kwargs):
+        if url in self.jwks:
+            _jwks = {'keys': [k.serialize() for k in self.jwks[url]]}
+            return MockResponse(200, json.dumps(_jwks),
+                                {'Content-Type': 'application/json'})
+        self.calls += 1
+        if self.provider_info is None:
+            return MockResponse(500, 'Internal error')
+        return MockResponse(200, json.dumps(self.provider_info),
+                            {'content-type': 'application/json'})
+
+
+class TestRefresh(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.op = MockOP(dict(PROVIDER_INFO))
+        self.client = RP(InMemoryStateDataBase(), httplib=self.op,
+                         config={'issuer': ISS, 'client_id': 'client'})
+        self.client.do_request('provider_info')
+
+    def test_discovered(self):
+        assert discovered(self.client)
+        _client = RP(InMemoryStateDataBase(),
+                     config={'issuer': ISS, 'provider_info': PROVIDER_INFO})
+        assert not discovered(_client)
+
+    def test_nothing_changed(self):
+        _pi = self.client.service_context.provider_info
+        assert refresh_provider_info(self.client) == []
+        assert self.client.service_context.provider_info is _pi
+
+    def test_endpoint_changed(self):
+        _authz = self.client.service['authorization']
+        _token = self.client.service['accesstoken']
+        self.op.provider_info['token_endpoint'] = '{}/token2'.format(ISS)
+
+        assert refresh_provider_info(self.client) == ['token_endpoint']
+        assert _token.endpoint == '{}/token2'.format(ISS)
+        assert _authz.endpoint == '{}/authorization'.format(ISS)
+        assert self.client.service_context.provider_info[
+            'token_endpoint'] == '{}/token2'.format(ISS)
+
+    def test_issuer_changed(self):
+        self.op.provider_info['issuer'] = 'https://other.example.org'
+        with pytest.raises(Exception):
+            refresh_provider_info(self.client)
+        assert self.client.service_context.provider_info['issuer'] == ISS
+
+    def test_refresher(self):
+        cache = ClientCache()
+        cache[ISS] = self.client
+        refresher = ProviderInfoRefresher(cache, interval=60)
+        self.op.provider_info['token_endpoint'] = '{}/token2'.format(ISS)
+        _calls = self.op.calls
+
+        refresher.refresh_due(now=1000)
+        assert self.op.calls == _calls
+        refresher.refresh_due(now=1030)
+        assert self.op.calls == _calls
+        refresher.refresh_due(now=1060)
+        assert self.op.calls == _calls + 1
+        assert self.client.service['accesstoken'].endpoint == \
+            '{}/token2'.format(ISS)
+
+    def test_refresher_keeps_stale(self):
+        cache = ClientCache()
+        cache[ISS] = self.client
+        refresher = ProviderInfoRefresher(cache, interval=60)
+        self.op.provider_info = None
+
+        refresher.refresh_due(now=1000)
+        refresher.refresh_due(now=1060)
+        assert self.client.service_context.provider_info[
+            'token_endpoint'] == '{}/token'.format(ISS)
+
+
+def signed_jwt(key):
+    _jws = JWS(json.dumps({'iss': ISS, 'sub': 'diana'}), alg='RS256')
+    return _jws.sign_compact([key])
+
+
+class TestJWKSURIChanged(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.old_uri = PROVIDER_INFO['jwks_uri']
+        self.new_uri = '{}/jwks2.json'.format(ISS)
+        self.old_key = new_rsa_key(kid='k1')
+        self.new_key = new_rsa_key(kid='k2')
+        self.op = MockOP(dict(PROVIDER_INFO), {self.old_uri: [self.old_key],
+                                               self.new_uri: [self.new_key]})
+        self.client = RP(InMemoryStateDataBase(), httplib=self.op,
+                         config={'issuer': ISS, 'client_id': 'client'})
+        self.client.service_context.keyjar = KeyJar(
+            httpc=lambda method, url, **kwargs: self.op(url, method))
+        self.client.do_request('provider_info')
+
+    def _verify(self, token):
+        _jwt = factory(token)
+        keys = self.client.service_context.keyjar.get_jwt_verify_keys(
+            _jwt.jwt)
+        return _jwt.verify_compact(token, keys)
+
+    def test_old_keys_removed(self):
+        assert self._verify(signed_jwt(self.old_key))['sub'] == 'diana'
+        self.op.provider_info['jwks_uri'] = self.new_uri
+
+        assert refresh_provider_info(self.client) == ['jwks_uri']
+        assert self._verify(signed_jwt(self.new_key))['sub'] == 'diana'
+        with pytest.raises(Exception):
+            self._verify(signed_jwt(self.old_key))
+
+    def test_old_keys_kept_for_grace_period(self):
+        cache = ClientCache()
+        cache[ISS] = self.client
+        refresher = ProviderInfoRefresher(cache, interval=60, grace=300)
+        refresher.refresh_due(now=1000)
+        self.op.provider_info['jwks_uri'] = self.new_uri
+
+        refresher.refresh_due(now=1060)
+        assert self._verify(signed_jwt(self.new_key))['sub'] == 'diana'
+        # Within the grace period
+        assert self._verify(signed_jwt(self.old_key))['sub'] == 'diana'
+        refresher.remove_retired(now=1359)
+        assert self._verify(signed_jwt(self.old_key))['sub'] == 'diana'
+
+        refresher.remove_retired(now=1360)
+        with pytest.raises(Exception):
+            self._verify(signed_jwt(self.old_key))
+        assert self._verify(signed_jwt(self.new_key))['sub'] == 'diana'
+
+    def test_back_to_old_uri(self):
+        cache = ClientCache()
+        cache[ISS] = self.client
+        refresher = ProviderInfoRefresher(cache, interval=60, grace=300)
+        refresher.refresh_due(now=1000)
+        self.op.provider_info['jwks_uri'] = self.new_uri
+        refresher.refresh_due(now=1060)
+        self.op.provider_info['jwks_uri'] = self.old_uri
+        refresher.refresh_due(now=1120)
+
+        refresher.remove_retired(now=1360)
+        assert self._verify(signed_jwt(self.old_key))['sub'] == 'diana'
+        refresher.remove_retired(now=1420)
+        with pytest.raises(Exception):
+            self._verify(signed_jwt(self.new_key))
+        assert self._verify(signed_jwt(self.old_key))['sub'] == 'diana'
+
+
+def test_remove_jwks_uri():
+    keyjar = KeyJar()
+    keyjar.add_url(ISS, 'https://op.example.org/jwks.json')
+    keyjar.add_url(ISS, 'https://op.example.org/jwks2.json')
+    remove_jwks_uri(keyjar, ISS, 'https://op.example.org/jwks.json')
+    assert [kb.source for kb in keyjar.issuer_keys[ISS]] == [
+        'https://op.example.org/jwks2.json']
+    # Nothing to remove
+    remove_jwks_uri(keyjar, 'https://other.example.org',
+                    'https://op.example.org/jwks.json')
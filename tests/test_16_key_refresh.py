@@ -0,0 +1,202 @@
+import json
+import threading
+import time
+
+import pytest
+from cryptojwt.jwk.rsa import new_rsa_key
+from cryptojwt.jws.jws import JWS
+from cryptojwt.jws.jws import factory
+from cryptojwt.key_jar import KeyJar
+
+from oidcrp.key_refresh import CachedKeyBundle
+from oidcrp.key_refresh import RefreshingKeyJar
+
+ISS = 'https://op.example.org'
+JWKS_URI = '{}/jwks.json'.format(ISS)
+
+
+class MockResponse():
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        self.url = ''
+
+
+class MockJWKS(object):
+    def __init__(self, keys, delay=0):
+        self.keys = keys
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self, method, url, **kwargs):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        _jwks = {'keys': [k.serialize() for k in self.keys]}
+        return MockResponse(200, json.dumps(_jwks),
+                            {'Content-Type': 'application/json'})
+
+
+def signed_jwt(key):
+    _jws = JWS(json.dumps({'iss': ISS, 'sub': 'diana'}), alg='RS256')
+    return _jws.sign_compact([key])
+
+
+class TestCachedKeyBundle(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.op = MockJWKS([new_rsa_key(kid='k1')])
+        self.kb = CachedKeyBundle(source=JWKS_URI, httpc=self.op)
+        self.kb.update()
+
+    def test_no_fetch_while_fresh(self):
+        assert self.op.calls == 1
+        for _ in range(10):
+            assert len(self.kb.get('rsa')) == 1
+        assert self.op.calls == 1
+
+    def test_fetch_when_stale(self):
+        self.kb.time_out = time.time() - 1
+        self.kb.get('rsa')
+        assert self.op.calls == 2
+        self.kb.get('rsa')
+        assert self.op.calls == 2
+
+    def test_keys_kept_during_fetch(self):
+        self.op.keys = [new_rsa_key(kid='k2')]
+        self.op.delay = 0.3
+        _fetch = threading.Thread(target=self.kb.refetch)
+        _fetch.start()
+        time.sleep(0.1)
+
+        _start = time.time()
+        _kids = [k.kid for k in self.kb.get('rsa')]
+        _waited = time.time() - _start
+        _fetch.join()
+
+        assert _kids == ['k1']
+        assert _waited < 0.1
+        assert [k.kid for k in self.kb.get('rsa')] == ['k2']
+        assert [k.kid for k in self.kb.get('rsa', only_active=False)] == [
+            'k2', 'k1']
+
+    def test_failed_fetch_keeps_keys(self):
+        self.op.keys = []
+        self.op.delay = 0
+
+        def broken(method, url, **kwargs):
+            raise ConnectionError(url)
+
+        self.kb.httpc = broken
+        assert self.kb.refetch() is False
+        assert [k.kid for k in self.kb.get('rsa')] == ['k1']
+
+    def test_copy(self):
+        _kb = self.kb.copy()
+        assert isinstance(_kb, CachedKeyBundle)
+        assert _kb.httpc is self.op
+        assert _kb.time_out == self.kb.time_out
+        _kb.get('rsa')
+        assert self.op.calls == 1
+
+
+class TestRefreshingKeyJar(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.old_key = new_rsa_key(kid='k1')
+        self.new_key = new_rsa_key(kid='k2')
+        self.op = MockJWKS([self.old_key])
+        self.keyjar = RefreshingKeyJar(min_interval=60, httpc=self.op)
+        self.keyjar.add_url(ISS, JWKS_URI)
+
+    def _verify(self, token):
+        _jwt = factory(token)
+        keys = self.keyjar.get_jwt_verify_keys(_jwt.jwt)
+        return _jwt.verify_compact(token, keys)
+
+    def test_bundle_class(self):
+        assert isinstance(self.keyjar[ISS][0], CachedKeyBundle)
+        assert isinstance(self.keyjar.copy(), RefreshingKeyJar)
+
+    def test_known_kid(self):
+        assert self._verify(signed_jwt(self.old_key))['sub'] == 'diana'
+        assert self.op.calls == 1
+
+    def test_unknown_kid(self):
+        self.op.keys = [self.old_key, self.new_key]
+        assert self._verify(signed_jwt(self.new_key))['sub'] == 'diana'
+        assert self.op.calls == 2
+
+    def test_unknown_kid_throttled(self):
+        _token = signed_jwt(new_rsa_key(kid='k3'))
+        for _ in range(5):
+            with pytest.raises(Exception):
+                self._verify(_token)
+        assert self.op.calls == 2
+
+    def test_concurrent_unknown_kid(self):
+        self.op.keys = [self.old_key, self.new_key]
+        self.op.delay = 0.2
+        _token = signed_jwt(self.new_key)
+        res = []
+
+        def verify():
+            res.append(self._verify(_token)['sub'])
+
+        _threads = [threading.Thread(target=verify) for _ in range(5)]
+        for _thread in _threads:
+            _thread.start()
+        for _thread in _threads:
+            _thread.join()
+
+        assert res == ['diana'] * 5
+        assert self.op.calls == 2
+
+    def test_known_kid_during_refresh(self):
+        self.keyjar.get_issuer_keys(ISS)
+        self.op.keys = [self.old_key, self.new_key]
+        self.op.delay = 0.3
+        _refresh = threading.Thread(target=self.keyjar.refresh,
+                                    args=(ISS,), kwargs={'force': True})
+        _refresh.start()
+        time.sleep(0.1)
+
+        _start = time.time()
+        assert self._verify(signed_jwt(self.old_key))['sub'] == 'diana'
+        _waited = time.time() - _start
+        _refresh.join()
+
+        assert _waited < 0.1
+        assert self.op.calls == 2
+
+    def test_load_issuer(self):
+        _found = []
+
+        def find_url(issuer):
+            _found.append(issuer)
+            return 'https://other.example.org/jwks.json'
+
+        self.keyjar.load_issuer(ISS, find_url)
+        assert _found == []
+        for _ in range(2):
+            self.keyjar.load_issuer('https://other.example.org', find_url)
+        assert _found == ['https://other.example.org']
+        assert self.op.calls == 2
+        assert 'https://other.example.org' in self.keyjar
+
+    def test_refresh_stale(self):
+        self.keyjar.refresh_stale()
+        assert self.op.calls == 1
+        self.keyjar.refresh_stale(ahead=3600)
+        assert self.op.calls == 2
+
+
+def test_plain_keyjar_refetches():
+    # What RefreshingKeyJar is there to prevent
+    op = MockJWKS([new_rsa_key(kid='k1')])
+    keyjar = KeyJar(httpc=op)
+    keyjar.add_url(ISS, JWKS_URI)
+    for _ in range(3):
+        keyjar.get_issuer_keys(ISS)
+    assert op.calls > 1
@@ -0,0 +1,108 @@
+import json
+import os
+import stat
+import time
+
+import pytest
+from cryptojwt.key_jar import init_key_jar
+
+from oidcrp.key_rotation import KeyRotation
+
+KEYDEFS = [
+    {"type": "RSA", "key": '', "use": ["sig"]},
+    {"type": "EC", "crv": "P-256", "use": ["sig"]}
+]
+
+# Keys that survive being exported as a private JWKS and read back
+EC_KEYDEFS = [
+    {"type": "EC", "crv": "P-256", "use": ["sig"]},
+    {"type": "EC", "crv": "P-384", "use": ["sig"]}
+]
+
+
+class TestKeyRotation(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.keyjar = init_key_jar(key_defs=KEYDEFS)
+        self.client_keyjar = self.keyjar.copy()
+        self.client_keyjar.add_symmetric('', 'a long enough client secret')
+        self.rotation = KeyRotation(
+            self.keyjar, client_keyjars=lambda: [self.client_keyjar],
+            overlap=600, max_age=300)
+
+    def _kids(self, keyjar):
+        return set(k.kid for k in keyjar.get_issuer_keys('') if k.kid)
+
+    def test_rotate(self):
+        _old = self._kids(self.keyjar)
+        _now = time.time()
+        _bundle = self.rotation.rotate(key_defs=KEYDEFS, now=_now)
+        _new = set(_bundle.kids())
+        assert _old.isdisjoint(_new)
+
+        # Both old and new are published and present in all key jars
+        _published = json.loads(self.rotation.jwks(now=_now)[0])
+        assert set(k['kid'] for k in _published['keys']) == _old | _new
+        assert self._kids(self.client_keyjar) == _old | _new
+        assert self.rotation.next_retirement() == _now + 600
+
+        # The old keys still sign
+        assert self.keyjar.get_signing_key('rsa')[0].kid in _old
+
+        assert self.rotation.retire_due(now=_now + 601)
+        _published = json.loads(self.rotation.jwks(now=_now + 601)[0])
+        assert set(k['kid'] for k in _published['keys']) == _new
+        assert self._kids(self.keyjar) == _new
+        assert self._kids(self.client_keyjar) == _new
+        assert self.keyjar.get_signing_key('rsa')[0].kid in _new
+        # The client secret is left alone
+        assert self.client_keyjar.get_signing_key('oct')
+
+    def test_rotate_jwks(self):
+        _jwks = init_key_jar(key_defs=EC_KEYDEFS).export_jwks(private=True)
+        _bundle = self.rotation.rotate(jwks=_jwks, now=time.time())
+        assert set(_bundle.kids()) == set(k['kid'] for k in _jwks['keys'])
+
+    def test_rotate_twice(self):
+        _now = time.time()
+        _first = set(self.rotation.rotate(key_defs=KEYDEFS, now=_now).kids())
+        self.rotation.rotate(key_defs=KEYDEFS, now=_now + 100)
+        self.rotation.retire_due(now=_now + 601)
+        assert _first <= self._kids(self.keyjar)
+        self.rotation.retire_due(now=_now + 701)
+        assert _first.isdisjoint(self._kids(self.keyjar))
+
+    def test_jwks_headers(self):
+        _body, _headers = self.rotation.jwks()
+        assert _headers['Cache-Control'] == 'public, max-age=300'
+        assert self.rotation.jwks()[1]['ETag'] == _headers['ETag']
+        self.rotation.rotate(key_defs=KEYDEFS, now=time.time())
+        assert self.rotation.jwks()[1]['ETag'] != _headers['ETag']
+
+    def test_private_path(self, tmpdir):
+        _path = str(tmpdir.join('private.jwks'))
+        self.rotation.private_path = _path
+        _bundle = self.rotation.rotate(key_defs=EC_KEYDEFS, now=time.time())
+        _kj = init_key_jar(private_path=_path)
+        assert set(_bundle.kids()) <= self._kids(_kj)
+        assert stat.S_IMODE(os.stat(_path).st_mode) == 0o600
+        # No temporary files left behind
+        assert os.listdir(str(tmpdir)) == ['private.jwks']
+
+    def test_private_path_failed_write(self, tmpdir, monkeypatch):
+        _path = str(tmpdir.join('private.jwks'))
+        self.rotation.private_path = _path
+        self.rotation.rotate(key_defs=EC_KEYDEFS, now=time.time())
+        with open(_path) as fp:
+            _before = fp.read()
+
+        def fail(*args):
+            raise OSError('disk full')
+
+        monkeypatch.setattr(os, 'fsync', fail)
+        with pytest.raises(OSError):
+            self.rotation.rotate(key_defs=EC_KEYDEFS, now=time.time())
+        # The earlier file is untouched
+        with open(_path) as fp:
+            assert fp.read() == _before
+        assert os.listdir(str(tmpdir)) == ['private.jwks']
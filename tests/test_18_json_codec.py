@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+from oidcrp import json_codec
+from oidcrp import util
+
+DOC = {'sub': 'diana', 'email': 'diana@example.org', 'numbers': [1, 2.5],
+       'nested': {'ok': True, 'nothing': None}}
+
+
+@pytest.fixture(params=sorted(json_codec.CODECS))
+def codec(request):
+    _name = json_codec.codec_name()
+    json_codec.use_codec(request.param)
+    yield request.param
+    json_codec.use_codec(_name)
+
+
+def test_loads(codec):
+    _doc = json.dumps(DOC)
+    assert json_codec.loads(_doc) == DOC
+    assert json_codec.loads(_doc.encode('utf-8')) == DOC
+
+
+def test_dumps(codec):
+    assert json.loads(json_codec.dumps(DOC)) == DOC
+    assert isinstance(json_codec.dumps(DOC), str)
+
+
+def test_not_json(codec):
+    with pytest.raises(json.JSONDecodeError):
+        json_codec.loads(b'not json')
+
+
+@pytest.mark.parametrize('number', [2 ** 64, -2 ** 63 - 1,
+                                    123456789012345678901234567890])
+def test_big_integers(codec, number):
+    _doc = '{{"n": {}}}'.format(number)
+    assert json_codec.loads(_doc)['n'] == number
+    assert json_codec.loads(_doc.encode('utf-8'))['n'] == number
+
+
+def test_dumps_fallback(codec):
+    assert json.loads(json_codec.dumps({1: 'one'})) == {'1': 'one'}
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        json_codec.use_codec('xml')
+
+
+def test_register_codec():
+    _name = json_codec.codec_name()
+    _calls = []
+
+    def _loads(doc):
+        _calls.append(doc)
+        return json.loads(doc)
+
+    json_codec.register_codec('counting', _loads, json.dumps)
+    try:
+        json_codec.use_codec('counting')
+        assert json_codec.loads('[1]') == [1]
+        assert _calls == ['[1]']
+    finally:
+        json_codec.use_codec(_name)
+        del json_codec.CODECS['counting']
+
+
+class FakeResponse():
+    def __init__(self, header, content, encoding='utf-8'):
+        self.headers = {"content-type": header}
+        self.content = content
+        self.text = content.decode(encoding)
+
+
+def test_response_json():
+    _resp = FakeResponse('application/json', json.dumps(DOC).encode('utf-8'))
+    assert util.response_json(_resp) == DOC
+    _resp = FakeResponse('application/json; charset=utf-16',
+                         json.dumps(DOC).encode('utf-16'), 'utf-16')
+    assert util.response_json(_resp) == DOC
+
+
+def test_load_json(tmpdir):
+    _file = tmpdir.join('conf.json')
+    _file.write(json.dumps(DOC))
+    assert util.load_json(str(_file)) == DOC
@@ -0,0 +1,143 @@
+import json
+
+import pytest
+from oidcservice.state_interface import InMemoryStateDataBase
+
+from oidcrp.middleware import Middleware
+from oidcrp.middleware import build_chain
+from oidcrp.oidc import RP
+
+ISS = 'https://op.example.org'
+
+PROVIDER_INFO = {
+    'issuer': ISS,
+    'authorization_endpoint': '{}/authorization'.format(ISS),
+    'token_endpoint': '{}/token'.format(ISS),
+    'jwks_uri': '{}/jwks.json'.format(ISS),
+    'response_types_supported': ['code'],
+    'subject_types_supported': ['public'],
+    'id_token_signing_alg_values_supported': ['RS256']
+}
+
+CALLS = []
+
+
+class MockResponse():
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        self.url = ''
+
+
+class MockOP(object):
+    def __init__(self):
+        self.requests = []
+
+    def __call__(self, url, method="GET", data=None, headers=None, **kwargs):
+        self.requests.append((url, headers))
+        return MockResponse(200, json.dumps(PROVIDER_INFO),
+                            {'content-type': 'application/json'})
+
+
+class Recorder(Middleware):
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, service, info, call_next):
+        CALLS.append(('before', self.name, service.service_name, info['url']))
+        response = call_next(info)
+        CALLS.append(('after', self.name, response['issuer']))
+        return response
+
+
+class AddHeader(Middleware):
+    def __call__(self, service, info, call_next):
+        info['headers']['X-Trace'] = 'abc'
+        return call_next(info)
+
+
+class Cached(Middleware):
+    def __init__(self):
+        self.response = None
+
+    def __call__(self, service, info, call_next):
+        if self.response is None:
+            self.response = call_next(info)
+        return self.response
+
+
+class TestMiddleware(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        del CALLS[:]
+        self.op = MockOP()
+
+    def _client(self, middleware=None):
+        _conf = {'issuer': ISS, 'client_id': 'client'}
+        if middleware:
+            _conf['middleware'] = middleware
+        return RP(InMemoryStateDataBase(), httplib=self.op, config=_conf)
+
+    def test_no_middleware(self):
+        _client = self._client()
+        assert _client.do_request('provider_info')['issuer'] == ISS
+
+    def test_order(self):
+        _client = self._client()
+        _client.add_middleware(Recorder('outer'))
+        _client.add_middleware(Recorder('inner'))
+        _client.do_request('provider_info')
+        _url = '{}/.well-known/openid-configuration'.format(ISS)
+        assert CALLS == [('before', 'outer', 'provider_info', _url),
+                         ('before', 'inner', 'provider_info', _url),
+                         ('after', 'inner', ISS),
+                         ('after', 'outer', ISS)]
+        # The response went through the normal processing
+        assert _client.service_context.provider_info['issuer'] == ISS
+
+    def test_change_request(self):
+        _client = self._client()
+        _client.add_middleware(AddHeader())
+        _client.do_request('provider_info')
+        assert self.op.requests[0][1]['X-Trace'] == 'abc'
+
+    def test_short_circuit(self):
+        _client = self._client()
+        _client.add_middleware(Cached())
+        _client.do_request('provider_info')
+        _client.do_request('provider_info')
+        assert len(self.op.requests) == 1
+
+    def test_per_service(self):
+        _client = self._client()
+        _client.add_middleware(Recorder('userinfo'), services=['userinfo'])
+        _client.do_request('provider_info')
+        assert CALLS == []
+        assert _client.service_middleware('provider_info') == []
+
+    def test_from_config(self):
+        _client = self._client([
+            {'class': 'test_19_middleware.Recorder',
+             'kwargs': {'name': 'conf'},
+             'services': ['provider_info']}
+        ])
+        _client.do_request('provider_info')
+        assert [c[1] for c in CALLS] == ['conf', 'conf']
+
+
+def test_build_chain():
+    def handler(info):
+        return info['steps'] + ['handler']
+
+    class Step(Middleware):
+        def __init__(self, name):
+            self.name = name
+
+        def __call__(self, service, info, call_next):
+            info['steps'] = info['steps'] + [self.name]
+            return call_next(info)
+
+    _chain = build_chain([Step('a'), Step('b')], None, handler)
+    assert _chain({'steps': []}) == ['a', 'b', 'handler']
+    assert build_chain([], None, handler)({'steps': []}) == ['handler']
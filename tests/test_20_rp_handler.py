@@ -1,5 +1,7 @@
 import json
 import os
+import threading
+import time
 from urllib.parse import parse_qs
 from urllib.parse import urlparse
 from urllib.parse import urlsplit
@@ -14,10 +16,14 @@ from oidcmsg.oidc import JRD
 from oidcmsg.oidc import Link
 from oidcmsg.oidc import OpenIDSchema
 from oidcmsg.oidc import ProviderConfigurationResponse
+from oidcservice.exception import OidcServiceError
 from oidcservice.service import init_services
 from oidcservice.service_context import ServiceContext
+from oidcservice.state_interface import InMemoryStateDataBase
 
 from oidcrp import RPHandler
+from oidcrp.key_refresh import RefreshingKeyJar
+from oidcrp.userinfo_cache import UserInfoCache
 
 BASE_URL = 'https://example.com/rp'
 
@@ -251,6 +257,8 @@ class TestRPHandler(object):
         assert list(_context.keyjar.owners()) == ['', _github_id]
         keys = _context.keyjar.get_issuer_keys('')
         assert len(keys) == 2
+        assert isinstance(_context.keyjar, RefreshingKeyJar)
+        assert client.claims_keyjar is self.rph.claims_keyjar
 
         assert _context.base_url == BASE_URL
 
@@ -316,13 +324,45 @@ class TestRPHandler(object):
                 '7f729285244adafbf5412e06b097e0e1f92049bfc432fed0a13cbcb5661b137d'
         }
 
-        assert list(self.rph.hash2issuer.keys()) == [
-            '7f729285244adafbf5412e06b097e0e1f92049bfc432fed0a13cbcb5661b137d']
+        assert '7f729285244adafbf5412e06b097e0e1f92049bfc432fed0a13cbcb5661b137d' \
+               in self.rph.hash2issuer
 
         assert self.rph.hash2issuer[
                    '7f729285244adafbf5412e06b097e0e1f92049bfc432fed0a13cbcb5661b137d'
                ] == 'https://op.example.com/'
 
+    def test_callback_routing(self):
+        # Computed when the RPHandler is created
+        assert self.rph.hash2issuer['github'] == iss_id('github')
+        assert self.rph.hash2issuer['linkedin'] == iss_id('linkedin')
+        assert iss_id('github') not in self.rph.issuer2rp
+
+        client = self.rph.get_client_by_hash('github')
+        assert client.service_context.issuer == iss_id('github')
+        assert self.rph.issuer2rp[iss_id('github')] is client
+        assert self.rph.get_client_by_hash('github') is client
+
+        with pytest.raises(KeyError):
+            self.rph.get_client_by_hash('unknown')
+
+    def test_callback_routing_hashed(self):
+        _conf = {
+            'op': {
+                'issuer': 'https://op.example.org/',
+                'client_id': 'client',
+                'provider_info': {
+                    'authorization_endpoint': 'https://op.example.org/authz'
+                }
+            }
+        }
+        rph = RPHandler(base_url=BASE_URL, client_configs=_conf,
+                        keyjar=CLI_KEY)
+        _hex = rph.issuer_hash('https://op.example.org/')
+        assert rph.hash2issuer == {_hex: 'https://op.example.org/'}
+
+        client = rph.get_client_by_hash(_hex)
+        assert client.service_context.callbacks['__hex'] == _hex
+
     def test_begin(self):
         res = self.rph.begin(issuer_id='github')
         assert set(res.keys()) == {'url', 'state'}
@@ -349,6 +389,48 @@ class TestRPHandler(object):
         assert query['response_type'] == ['code']
         assert query['scope'] == ['user public_repo openid']
 
+    def test_begin_template(self):
+        client = self.rph.client_setup('github')
+        _context = client.service_context
+        _context.config = dict(_context.config)
+        _request_args = {'claims': {'id_token': {'acr': {'essential': True}}}}
+        _context.config['request_args'] = _request_args
+
+        res1 = self.rph.begin(issuer_id='github')
+        _template = self.rph.authorization_templates[client]
+        res2 = self.rph.begin(issuer_id='github')
+        # same client, same template
+        assert self.rph.authorization_templates[client] is _template
+        assert res1['state'] != res2['state']
+
+        query = parse_qs(urlsplit(res2['url']).query)
+        assert query['scope'] == ['user public_repo openid']
+        assert json.loads(query['claims'][0]) == _request_args['claims']
+        # The configuration is left as it was
+        assert isinstance(_request_args['claims'], dict)
+        assert _context.behaviour['scope'] == ['user', 'public_repo']
+
+        # A change in behaviour means a new template
+        _context.behaviour = dict(_context.behaviour, scope=['user'])
+        res3 = self.rph.begin(issuer_id='github')
+        query = parse_qs(urlsplit(res3['url']).query)
+        assert query['scope'] == ['user openid']
+
+    def test_begin_template_not_shared(self):
+        client = self.rph.client_setup('github')
+        _context = client.service_context
+        _context.config = dict(_context.config)
+        _context.config['request_args'] = {
+            'claims': {'id_token': {'acr': {'essential': True}}}}
+
+        _args = self.rph.authorization_template(client)
+        _args['claims']['id_token']['acr'] = {'essential': False}
+        _args['scope'].append('email')
+
+        _args = self.rph.authorization_template(client)
+        assert _args['claims']['id_token']['acr'] == {'essential': True}
+        assert 'email' not in _args['scope']
+
     def test_get_session_information(self):
         res = self.rph.begin(issuer_id='github')
         _session = self.rph.get_session_information(res['state'])
@@ -366,6 +448,53 @@ class TestRPHandler(object):
         cli2.service_context.redirect_uris = []
         self.rph.do_client_registration(state=res['state'])
 
+    def test_evicted_client(self):
+        res = self.rph.begin(issuer_id='github')
+        _github_id = iss_id('github')
+        cli1 = self.rph.issuer2rp[_github_id]
+
+        self.rph.issuer2rp.evict(_github_id)
+        assert not self.rph.issuer2rp.is_live(_github_id)
+
+        cli2 = self.rph.get_client_from_session_key(state=res['state'])
+        assert cli2 is not cli1
+        assert self.rph.issuer2rp.is_live(_github_id)
+        _context = cli2.service_context
+        assert _context.client_id == 'eeeeeeeee'
+        assert _context.client_secret == 'aaaaaaaaaaaaaaaaaaaa'
+        assert _context.redirect_uris == cli1.service_context.redirect_uris
+        for service_type in ['authorization', 'accesstoken', 'userinfo']:
+            _srv = cli2.service[service_type]
+            assert _srv.endpoint == cli1.service[service_type].endpoint
+
+    def test_client_cache_size(self):
+        self.rph.issuer2rp.max_size = 1
+        self.rph.begin(issuer_id='github')
+        res = self.rph.begin(issuer_id='linkedin')
+        assert not self.rph.issuer2rp.is_live(iss_id('github'))
+
+        res = self.rph.begin(issuer_id='github')
+        assert self.rph.issuer2rp.is_live(iss_id('github'))
+        assert not self.rph.issuer2rp.is_live(iss_id('linkedin'))
+        assert res['url'].startswith(
+            CLIENT_CONFIG['github']['provider_info']['authorization_endpoint'])
+
+    def test_rotate_keys(self):
+        rph = RPHandler(base_url=BASE_URL, client_configs=CLIENT_CONFIG,
+                        keyjar=init_key_jar(key_defs=KEYDEFS),
+                        jwks_path='static/jwks.json')
+        rph.begin(issuer_id='github')
+        _keyjar = rph.issuer2rp[iss_id('github')].service_context.keyjar
+        _etag = rph.jwks()[1]['ETag']
+
+        _bundle = rph.rotate_keys(key_defs=KEYDEFS)
+        _kids = [k.kid for k in _keyjar.get_issuer_keys('')]
+        assert set(_bundle.kids()) <= set(_kids)
+        _body, _headers = rph.jwks()
+        assert _headers['ETag'] != _etag
+        assert set(_bundle.kids()) <= set(
+            k['kid'] for k in json.loads(_body)['keys'])
+
     def test_finalize_auth(self):
         res = self.rph.begin(issuer_id='linkedin')
         _session = self.rph.get_session_information(res['state'])
@@ -690,6 +819,39 @@ class TestRPHandlerTier2(object):
                                             'openid email')
         assert res['access_token'] == '2nd_accessTok'
 
+    def test_refresh_access_token_single_flight(self):
+        _session = self.rph.get_session_information(self.state)
+        client = self.rph.issuer2rp[_session['iss']]
+
+        calls = []
+
+        def slow_op(url, method="GET", data=None, headers=None, **kwargs):
+            calls.append(url)
+            time.sleep(0.1)
+            _info = {
+                "access_token": "token_{}".format(len(calls)),
+                "token_type": "Bearer", "expires_in": 3600
+            }
+            return MockResponse(200, AccessTokenResponse(**_info).to_json(),
+                                {'content-type': 'application/json'})
+
+        client.http = slow_op
+        client.service['refresh_token'].endpoint = 'https://example.com/token'
+
+        results = []
+
+        def refresh():
+            results.append(self.rph.refresh_access_token(self.state, client))
+
+        threads = [threading.Thread(target=refresh) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(calls) == 1
+        assert [r['access_token'] for r in results] == ['token_1'] * 4
+
     def test_get_user_info(self, httpserver):
         _session = self.rph.get_session_information(self.state)
         client = self.rph.issuer2rp[_session['iss']]
@@ -703,6 +865,39 @@ class TestRPHandlerTier2(object):
         assert set(resp.keys()) == {'sub', 'mail'}
         assert resp['mail'] == 'foo@example.com'
 
+    def test_get_user_info_cached(self):
+        _session = self.rph.get_session_information(self.state)
+        client = self.rph.issuer2rp[_session['iss']]
+        self.rph.userinfo_cache = UserInfoCache(max_size=10)
+
+        calls = []
+
+        def userinfo_op(url, method="GET", data=None, headers=None, **kwargs):
+            calls.append(url)
+            if url.endswith('/token'):
+                _info = {"access_token": "2nd_accessTok",
+                         "token_type": "Bearer", "expires_in": 3600}
+                return MockResponse(200, AccessTokenResponse(**_info).to_json(),
+                                    {'content-type': 'application/json'})
+            return MockResponse(
+                200, '{"sub":"EndUserSubject", "mail":"foo@example.com"}',
+                {'content-type': 'application/json'})
+
+        client.http = userinfo_op
+        client.service['userinfo'].endpoint = 'https://example.com/userinfo'
+        client.service['refresh_token'].endpoint = 'https://example.com/token'
+
+        resp1 = self.rph.get_user_info(self.state, client)
+        resp2 = self.rph.get_user_info(self.state, client)
+        assert resp1 is resp2
+        assert len(calls) == 1
+
+        # A new access token means new user info
+        self.rph.refresh_access_token(self.state, client)
+        assert len(self.rph.userinfo_cache) == 0
+        self.rph.get_user_info(self.state, client)
+        assert len(calls) == 3
+
     def test_has_active_authentication(self):
         assert self.rph.has_active_authentication(self.state)
 
@@ -804,7 +999,7 @@ class TestRPHandlerWithMockOP(object):
             base_url=BASE_URL, client_configs=CLIENT_CONFIG,
             http_lib=self.mock_op, keyjar=KeyJar())
 
-    def test_finalize(self):
+    def run_finalize(self):
         auth_query = self.rph.begin(issuer_id='github')
         #  The authorization query is sent and after successful authentication
         client = self.rph.get_client_from_session_key(
@@ -852,12 +1047,25 @@ class TestRPHandlerWithMockOP(object):
 
         # do the rest (= get access token and user info)
         # assume code flow
-        resp = self.rph.finalize(_session['iss'], auth_response.to_dict())
+        return self.rph.finalize(_session['iss'], auth_response.to_dict())
 
+    def test_finalize(self):
+        resp = self.run_finalize()
         assert set(resp.keys()) == {'userinfo', 'state', 'token', 'id_token'}
 
-    def test_dynamic_setup(self):
-        user_id = 'acct:foobar@example.com'
+    def test_finalize_caches_user_info_until_token_expires(self):
+        self.rph.userinfo_cache = UserInfoCache(max_size=10)
+        resp = self.run_finalize()
+
+        _token = self.rph.session_interface.get_item(
+            AccessTokenResponse, 'token_response', resp['state'])
+        assert _token['__expires_at']
+
+        assert len(self.rph.userinfo_cache) == 1
+        _cached = list(self.rph.userinfo_cache._db.values())[0]
+        assert _cached[1] == _token['__expires_at']
+
+    def dynamic_op(self, user_id):
         _link = Link(rel="http://openid.net/specs/connect/1.0/issuer",
                      href="https://server.example.com")
         webfinger_response = JRD(subject=user_id,
@@ -909,5 +1117,87 @@ class TestRPHandlerWithMockOP(object):
             '/connect/register', registration_callback, 200,
             {'content-type': "application/json"})
 
+    def test_dynamic_setup(self):
+        user_id = 'acct:foobar@example.com'
+        self.dynamic_op(user_id)
+
         auth_query = self.rph.begin(user_id=user_id)
         assert auth_query
+
+        assert self.rph.webfinger_cache.get(
+            'example.com') == 'https://server.example.com'
+
+        # Another user from the same domain, no webfinger and no new client
+        def init_client(issuer):
+            raise AssertionError('Unexpected client construction')
+
+        self.rph.init_client = init_client
+        auth_query = self.rph.begin(user_id='acct:another@example.com')
+        assert auth_query['url'].startswith(
+            'https://server.example.com/connect/authorize')
+
+    def test_webfinger_not_found_is_remembered(self):
+        self.mock_op.register_get_response(
+            '/.well-known/webfinger', 'Not Found', 404,
+            {'content-type': 'text/plain'})
+
+        with pytest.raises(OidcServiceError):
+            self.rph.begin(user_id='acct:foobar@example.com')
+        assert self.rph.webfinger_cache.get('example.com') is None
+
+    @pytest.mark.parametrize('status_code', [429, 500, 503])
+    def test_webfinger_failure_is_not_remembered(self, status_code):
+        self.mock_op.register_get_response(
+            '/.well-known/webfinger', '{"error": "temporarily_unavailable"}',
+            status_code, {'content-type': 'application/json'})
+
+        with pytest.raises(Exception):
+            self.rph.begin(user_id='acct:foobar@example.com')
+        with pytest.raises(KeyError):
+            self.rph.webfinger_cache.get('example.com')
+
+        # The next try goes to the OP/AS again
+        self.dynamic_op('acct:foobar@example.com')
+        assert self.rph.begin(user_id='acct:foobar@example.com')
+
+    def test_shared_issuer_registry(self):
+        registry_db = InMemoryStateDataBase()
+        self.rph = RPHandler(
+            base_url=BASE_URL, client_configs=CLIENT_CONFIG,
+            http_lib=self.mock_op, keyjar=KeyJar(), registry_db=registry_db)
+        user_id = 'acct:foobar@example.com'
+        self.dynamic_op(user_id)
+
+        registrations = []
+        _register = self.mock_op.post_response['/connect/register'].text
+
+        def count_registrations(data):
+            registrations.append(data)
+            return _register(data)
+
+        self.mock_op.post_response['/connect/register'].text = \
+            count_registrations
+
+        self.rph.begin(user_id=user_id)
+        client = self.rph.issuer2rp['https://server.example.com']
+        _hex = client.service_context.callbacks['__hex']
+        assert len(registrations) == 1
+
+        # Another worker sharing the registry
+        rph2 = RPHandler(
+            base_url=BASE_URL, client_configs=CLIENT_CONFIG,
+            http_lib=self.mock_op, keyjar=KeyJar(), registry_db=registry_db)
+
+        # A callback to a worker that has not seen the OP
+        client2 = rph2.get_client_by_hash(_hex)
+        assert len(registrations) == 1
+        _sc = client2.service_context
+        assert _sc.client_id == 'client1'
+        assert _sc.redirect_uris == client.service_context.redirect_uris
+        assert client2.service['authorization'].endpoint == \
+            'https://server.example.com/connect/authorize'
+
+        auth_query = rph2.begin(user_id='acct:another@example.com')
+        assert len(registrations) == 1
+        assert auth_query['url'].startswith(
+            'https://server.example.com/connect/authorize')
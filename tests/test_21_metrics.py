@@ -0,0 +1,133 @@
+import json
+
+import pytest
+from oidcservice.state_interface import InMemoryStateDataBase
+
+from oidcrp.metrics import NO_METRICS
+from oidcrp.metrics import Metrics
+from oidcrp.metrics import status_class
+from oidcrp.middleware import Middleware
+from oidcrp.oidc import RP
+
+ISS = 'https://op.example.org'
+
+PROVIDER_INFO = {
+    'issuer': ISS,
+    'authorization_endpoint': '{}/authorization'.format(ISS),
+    'token_endpoint': '{}/token'.format(ISS),
+    'jwks_uri': '{}/jwks.json'.format(ISS),
+    'response_types_supported': ['code'],
+    'subject_types_supported': ['public'],
+    'id_token_signing_alg_values_supported': ['RS256']
+}
+
+
+class MockResponse():
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        self.url = ''
+
+
+class MockOP(object):
+    def __init__(self, status_code=200, text=json.dumps(PROVIDER_INFO)):
+        self.status_code = status_code
+        self.text = text
+
+    def __call__(self, url, method="GET", data=None, headers=None, **kwargs):
+        return MockResponse(self.status_code, self.text,
+                            {'content-type': 'application/json'})
+
+
+class Unreachable(Middleware):
+    def __call__(self, service, info, call_next):
+        raise ConnectionError('unreachable')
+
+
+def test_status_class():
+    assert status_class(200) == '2xx'
+    assert status_class(503, True) == '5xx'
+    assert status_class(None, True) == 'error'
+    assert status_class(None) == 'none'
+
+
+def test_no_metrics():
+    NO_METRICS.observe(ISS, 'userinfo', 0.1)
+    assert NO_METRICS.exposition() == ''
+
+
+def test_exposition():
+    metrics = Metrics(buckets=(0.1, 1.0))
+    metrics.observe(ISS, 'userinfo', 0.05)
+    metrics.observe(ISS, 'userinfo', 0.5, '4xx', parse_failure=True)
+    metrics.observe(ISS, 'userinfo', 5)
+    _lines = metrics.exposition().split('\n')
+
+    _lbl = 'issuer="{}",service="userinfo"'.format(ISS)
+    assert 'oidcrp_requests_total{%s,status="2xx"} 2' % _lbl in _lines
+    assert 'oidcrp_requests_total{%s,status="4xx"} 1' % _lbl in _lines
+    assert 'oidcrp_request_duration_seconds_bucket{%s,le="0.1"} 1' % (
+        _lbl) in _lines
+    assert 'oidcrp_request_duration_seconds_bucket{%s,le="1.0"} 2' % (
+        _lbl) in _lines
+    assert 'oidcrp_request_duration_seconds_bucket{%s,le="+Inf"} 3' % (
+        _lbl) in _lines
+    assert 'oidcrp_request_duration_seconds_sum{%s} 5.55' % _lbl in _lines
+    assert 'oidcrp_request_duration_seconds_count{%s} 3' % _lbl in _lines
+    assert 'oidcrp_parse_failures_total{%s} 1' % _lbl in _lines
+    assert '# TYPE oidcrp_request_duration_seconds histogram' in _lines
+
+
+def test_label_escaping():
+    metrics = Metrics()
+    metrics.observe('a"b\\c', 'userinfo', 0.1)
+    assert 'issuer="a\\"b\\\\c"' in metrics.exposition()
+
+
+class TestClientMetrics(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.op = MockOP()
+        self.client = RP(InMemoryStateDataBase(), httplib=self.op,
+                         config={'issuer': ISS, 'client_id': 'client'})
+        self.client.metrics = Metrics()
+
+    def _count(self, status):
+        return self.client.metrics._requests.get(
+            (ISS, 'provider_info', status), 0)
+
+    def test_success(self):
+        self.client.do_request('provider_info')
+        assert self._count('2xx') == 1
+        assert self.client.metrics._latency[(ISS, 'provider_info')][2] == 1
+
+    def test_parse_failure(self):
+        self.op.text = json.dumps({'issuer': 'https://other.example.org'})
+        with pytest.raises(Exception):
+            self.client.do_request('provider_info')
+        assert self._count('2xx') == 1
+        assert self.client.metrics._parse_failures[(ISS, 'provider_info')] == 1
+
+    def test_server_error(self):
+        self.op.status_code = 500
+        with pytest.raises(Exception):
+            self.client.do_request('provider_info')
+        assert self._count('5xx') == 1
+        assert not self.client.metrics._parse_failures
+
+    def test_no_response(self):
+        self.client.add_middleware(Unreachable())
+        with pytest.raises(ConnectionError):
+            self.client.do_request('provider_info')
+        assert self._count('error') == 1
+
+    def test_redirect_service_not_counted(self):
+        self.client.do_request('provider_info')
+        _srv = self.client.service['authorization']
+        _srv.get_request_parameters(request_args={
+            'redirect_uri': 'https://rp.example.com/cb',
+            'response_type': 'code', 'state': 'state', 'nonce': 'nonce'})
+        assert not [k for k in self.client.metrics._requests
+                    if k[1] == 'authorization']
+        assert '"authorization"' not in self.client.metrics.exposition()
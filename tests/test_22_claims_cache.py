@@ -0,0 +1,33 @@
+import time
+
+from oidcrp.claims_cache import ClaimsCache
+
+ENDPOINT = 'https://claims.example.org'
+
+
+def test_no_token():
+    cache = ClaimsCache()
+    cache.set(ENDPOINT, None, {'credit_score': 650})
+    assert cache.get(ENDPOINT) == {'credit_score': 650}
+    assert cache.get(ENDPOINT, 'token') is None
+    assert cache.get('https://other.example.org') is None
+
+
+def test_source_ttl():
+    cache = ClaimsCache(ttl=60, source_ttl={ENDPOINT: 5,
+                                            'https://nocache.example.org': 0})
+    assert cache.ttl_for(ENDPOINT) == 5
+    assert cache.ttl_for('https://other.example.org') == 60
+    cache.set(ENDPOINT, 'token', {'credit_score': 650})
+    assert cache._db[list(cache._db)[0]][1] <= time.time() + 5
+    cache.set('https://nocache.example.org', 'token', {'a': 'b'})
+    assert cache.get('https://nocache.example.org', 'token') is None
+    assert len(cache) == 1
+
+
+def test_expires_at():
+    cache = ClaimsCache(ttl=60, source_ttl={ENDPOINT: 0})
+    _exp = time.time() + 3600
+    cache.set(ENDPOINT, 'jwt', {'credit_score': 650}, expires_at=_exp)
+    assert cache.get(ENDPOINT, 'jwt') == {'credit_score': 650}
+    assert cache._db[list(cache._db)[0]][1] == _exp
@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+
+from oidcrp.ttl_cache import TTLCache
+
+
+def test_lookup_store():
+    cache = TTLCache()
+    with pytest.raises(KeyError):
+        cache.lookup('a')
+    cache.store('a', 'A')
+    assert cache.lookup('a') == 'A'
+    cache.store('a', 'AA')
+    assert cache.lookup('a') == 'AA'
+    assert len(cache) == 1
+
+
+def test_expired():
+    cache = TTLCache()
+    cache.store('a', 'A', expires_at=time.time() - 1)
+    with pytest.raises(KeyError):
+        cache.lookup('a')
+    assert len(cache) == 0
+
+    cache.store('b', 'B', expires_at=time.time() + 60)
+    assert cache.lookup('b') == 'B'
+
+
+def test_lru():
+    cache = TTLCache(max_size=2)
+    cache.store('a', 'A')
+    cache.store('b', 'B')
+    cache.lookup('a')
+    cache.store('c', 'C')
+
+    assert len(cache) == 2
+    with pytest.raises(KeyError):
+        cache.lookup('b')
+    assert cache.lookup('a') == 'A'
+    assert cache.lookup('c') == 'C'
+
+
+def test_add():
+    cache = TTLCache()
+    assert cache.add('a', 'A')
+    assert not cache.add('a', 'AA')
+    assert cache.lookup('a') == 'A'
+
+    cache.store('b', 'B', expires_at=time.time() - 1)
+    assert cache.add('b', 'BB')
+    assert cache.lookup('b') == 'BB'
+
+
+def test_concurrent_add():
+    cache = TTLCache()
+    added = []
+
+    def add():
+        for n in range(1000):
+            if cache.add(n, True):
+                added.append(n)
+
+    _threads = [threading.Thread(target=add) for _ in range(4)]
+    for _thread in _threads:
+        _thread.start()
+    for _thread in _threads:
+        _thread.join()
+
+    assert sorted(added) == list(range(1000))
+
+
+def test_removed():
+    class Tracking(TTLCache):
+        def __init__(self, max_size):
+            TTLCache.__init__(self, max_size)
+            self.gone = []
+
+        def removed(self, key, value):
+            self.gone.append((key, value))
+
+    cache = Tracking(max_size=2)
+    cache.store('a', 'A')
+    cache.store('a', 'AA')
+    cache.store('b', 'B')
+    cache.store('c', 'C')
+    cache.discard('b')
+    cache.discard('unknown')
+    cache.store('d', 'D', expires_at=time.time() - 1)
+    with pytest.raises(KeyError):
+        cache.lookup('d')
+    assert cache.gone == [('a', 'A'), ('a', 'AA'), ('b', 'B'), ('d', 'D')]
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.gone[-1] == ('c', 'C')